@@ -0,0 +1,147 @@
+"""
+Encoding and decoding of piece sets
+
+Bit fields are byte strings where the most significant bit of the first byte
+represents the first sequence. Uses NumPy if it's available. Ranges are
+lists of (first, last) tuples of contiguous sequences.
+
+Encoding has to go through every piece of the set, so it costs about 50 ns
+per piece with NumPy and 100 ns without it (50 and 100 ms for a million
+pieces, see tests/manualtests/bitfield_benchmark.py). Peers only encode the
+pieces of their advertise window, which keeps bit fields to thousands of
+pieces.
+"""
+
+import binascii
+import itertools
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['encode_bitfield', 'decode_bitfield', 'pieces_to_ranges',
+           'ranges_to_pieces']
+
+_ONES_RUN = re.compile('1+')
+
+def encode_bitfield(pieces, use_numpy=None):
+    """
+    Encodes a set of sequences.
+
+    Returns a tuple (first, last, bitfield) with the first and last sequence
+    of the set and the bit field starting on the first one.
+    """
+
+    if len(pieces) == 0:
+        return 0, 0, ''
+
+    if _use_numpy(use_numpy):
+        return _encode_numpy(pieces)
+    return _encode_python(pieces)
+
+def decode_bitfield(first, bitfield, use_numpy=None):
+    """Returns the set of sequences in a bit field starting on first"""
+
+    if len(bitfield) == 0:
+        return set()
+
+    if _use_numpy(use_numpy):
+        return _decode_numpy(first, bitfield)
+    return _decode_python(first, bitfield)
+
+def pieces_to_ranges(pieces):
+    """Returns the sorted list of ranges of contiguous sequences"""
+
+    ranges = []
+
+    for piece in sorted(pieces):
+        if ranges and ranges[-1][1] == piece - 1:
+            ranges[-1] = (ranges[-1][0], piece)
+        else:
+            ranges.append((piece, piece))
+
+    return ranges
+
+def ranges_to_pieces(ranges, lower=None, upper=None):
+    """
+    Returns the set of sequences in a list of ranges. If given, only the
+    sequences between lower and upper (both included) are returned.
+    """
+
+    pieces = set()
+    for first, last in ranges:
+        if lower is not None:
+            first = max(first, lower)
+        if upper is not None:
+            last = min(last, upper)
+        pieces.update(xrange(first, last + 1))
+    return pieces
+
+def _use_numpy(use_numpy):
+    if use_numpy is None:
+        return numpy is not None
+    return use_numpy
+
+def _encode_python(pieces):
+    first = min(pieces)
+    last = max(pieces)
+    length = last - first + 1
+
+    # Builds a string of '0' and '1' characters looping over the pieces or
+    # over the holes, whatever is shorter, and converts it in bulk.
+    if len(pieces) * 2 < length:
+        bits = bytearray('0') * length
+        for piece in pieces:
+            bits[piece - first] = '1'
+    elif len(pieces) == length:
+        bits = bytearray('1') * length
+    else:
+        bits = bytearray('1') * length
+        holes = itertools.ifilterfalse(pieces.__contains__,
+                                       xrange(first, last + 1))
+        for piece in holes:
+            bits[piece - first] = '0'
+
+    size = (length + 7) // 8
+    bits.extend('0' * (size * 8 - length))
+    value = int(str(bits), 2)
+
+    bitfield = binascii.unhexlify('{0:0{1}x}'.format(value, size * 2))
+
+    return first, last, bitfield
+
+def _decode_python(first, bitfield):
+    value = int(binascii.hexlify(bitfield), 16)
+    bits = bin(value)[2:].zfill(len(bitfield) * 8)
+
+    pieces = set()
+    for run in _ONES_RUN.finditer(bits):
+        pieces.update(xrange(first + run.start(), first + run.end()))
+
+    return pieces
+
+def _encode_numpy(pieces):
+    sequences = numpy.fromiter(pieces, dtype=numpy.int64, count=len(pieces))
+    first = int(sequences.min())
+    last = int(sequences.max())
+
+    bits = numpy.zeros(last - first + 1, dtype=numpy.uint8)
+    bits[sequences - first] = 1
+
+    return first, last, numpy.packbits(bits).tostring()
+
+def _decode_numpy(first, bitfield):
+    bits = numpy.unpackbits(numpy.frombuffer(bitfield, dtype=numpy.uint8))
+
+    # Runs of ones start where the bits go up and end where they go down
+    changes = numpy.diff(numpy.concatenate(([0], bits, [0])).astype(numpy.int8))
+    starts = numpy.flatnonzero(changes == 1) + first
+    ends = numpy.flatnonzero(changes == -1) + first
+
+    pieces = set()
+    for start, end in itertools.izip(starts.tolist(), ends.tolist()):
+        pieces.update(xrange(start, end))
+
+    return pieces
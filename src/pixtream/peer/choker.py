@@ -0,0 +1,138 @@
+"""
+Chooses the partners that are allowed to download from the peer
+"""
+
+import random
+
+__all__ = ['Choker']
+
+class Choker(object):
+    """
+    Tit-for-tat choking algorithm.
+
+    Every round, the partners that contributed the most data since the
+    previous round are unchoked. One more slot is given to a random partner
+    (the optimistic unchoke) so that new partners get a chance to show what
+    they can contribute. The optimistic partner is rotated every few rounds.
+    """
+
+    # FIXME: use configuration system
+    UNCHOKE_SLOTS = 4
+    OPTIMISTIC_ROUNDS = 3
+
+    def __init__(self, slots=None, optimistic_rounds=None):
+        """
+        Creates the choker.
+
+        :param slots: Number of partners unchoked by contribution.
+        :param optimistic_rounds: Rounds between optimistic unchoke rotations.
+        """
+
+        self.slots = self.UNCHOKE_SLOTS if slots is None else slots
+        self.optimistic_rounds = (self.OPTIMISTIC_ROUNDS
+                                  if optimistic_rounds is None
+                                  else optimistic_rounds)
+
+        self.unchoked = set()
+        self.optimistic = None
+        self.contributions = {}
+
+        self.rounds = 0
+        self.rotations = 0
+        self.chokes = 0
+        self.unchokes = 0
+
+        self._last_utility = {}
+
+    def admit(self, partner_id):
+        """
+        Unchokes a new partner if there is a free slot. Returns True if the
+        partner was unchoked.
+        """
+
+        if len(self.unchoked) >= self.slots + 1:
+            return False
+
+        self.unchoked.add(partner_id)
+        self.unchokes += 1
+        return True
+
+    def remove_partner(self, partner_id):
+        """Forgets a disconnected partner"""
+
+        self.unchoked.discard(partner_id)
+        self._last_utility.pop(partner_id, None)
+        if self.optimistic == partner_id:
+            self.optimistic = None
+
+    def run(self, partners, utility_by_peer):
+        """
+        Runs a choking round.
+
+        :param partners: The ids of the partners interested in our pieces.
+                         Unchoked partners not in the list are choked.
+        :param utility_by_peer: Total bytes received from every partner.
+
+        Returns the sets of partners to choke and to unchoke.
+        """
+
+        partners = set(partners)
+        self.contributions = self._contributions(partners, utility_by_peer)
+
+        def rank(partner_id):
+            return (self.contributions[partner_id],
+                    partner_id in self.unchoked,
+                    random.random())
+
+        ranked = sorted(partners, key=rank, reverse=True)
+        best = set(ranked[:self.slots])
+
+        candidates = partners - best
+        if (self.rounds % self.optimistic_rounds == 0 or
+            self.optimistic not in candidates):
+            self._rotate_optimistic(candidates)
+
+        unchoked = set(best)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        to_choke = self.unchoked - unchoked
+        to_unchoke = unchoked - self.unchoked
+
+        self.chokes += len(to_choke)
+        self.unchokes += len(to_unchoke)
+        self.unchoked = unchoked
+        self.rounds += 1
+
+        return to_choke, to_unchoke
+
+    def stats(self):
+        """Returns a dict with the state of the choker"""
+
+        return {'unchoked': sorted(self.unchoked),
+                'optimistic': self.optimistic,
+                'contributions': dict(self.contributions),
+                'rounds': self.rounds,
+                'rotations': self.rotations,
+                'chokes': self.chokes,
+                'unchokes': self.unchokes}
+
+    def _rotate_optimistic(self, candidates):
+        others = list(candidates - set([self.optimistic]))
+
+        if others:
+            self.optimistic = random.choice(others)
+            self.rotations += 1
+        elif self.optimistic not in candidates:
+            self.optimistic = None
+
+    def _contributions(self, partners, utility_by_peer):
+        """Bytes received from every partner since the last round"""
+
+        contributions = {}
+        for partner_id in partners:
+            total = utility_by_peer.get(partner_id, 0)
+            last = self._last_utility.get(partner_id, 0)
+            contributions[partner_id] = total - last
+            self._last_utility[partner_id] = total
+        return contributions
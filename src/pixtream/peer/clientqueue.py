@@ -0,0 +1,106 @@
+"""
+Queue of stream data waiting to be written to an output client
+"""
+
+from collections import deque
+
+from zope.interface import implements
+from twisted.internet.interfaces import IPushProducer
+
+__all__ = ['ClientQueue']
+
+class ClientQueue(object):
+    """
+    Writes stream data to a consumer, queueing it while the consumer is
+    paused.
+
+    Keeps the bytes queued and since when the queue has been too long, so
+    the stream server can drop lagging clients or fast-forward them to the
+    live stream (the DROP and SKIP lag policies).
+    """
+
+    implements(IPushProducer)
+
+    DROP, SKIP = 'drop', 'skip'
+
+    def __init__(self, consumer, client_address, on_drop=None):
+        """
+        :param consumer: Object with a write method receiving the data.
+        :param client_address: Description of the client, for the logs.
+        :param on_drop: Function called with the queue when it is dropped.
+        """
+
+        self.consumer = consumer
+        self.client_address = client_address
+        self.on_drop = on_drop
+
+        self.queued_bytes = 0
+        self.lagging_since = None
+        self.failed = False
+
+        self._queue = deque()
+        self._paused = False
+
+    def send_stream(self, data):
+        if self.failed:
+            return
+
+        if self._paused:
+            self._queue.append(data)
+            self.queued_bytes += len(data)
+        else:
+            self.consumer.write(data)
+
+    def check_lag(self, max_queue, timeout, policy, now):
+        """
+        Applies the lag policy if the queue has been longer than max_queue
+        bytes for more than timeout seconds. Returns True if it was applied.
+        """
+
+        if self.queued_bytes <= max_queue:
+            self.lagging_since = None
+            return False
+
+        if self.lagging_since is None:
+            self.lagging_since = now
+            return False
+
+        if now - self.lagging_since < timeout:
+            return False
+
+        self.lagging_since = None
+        if policy == self.SKIP:
+            self.discard_queue()
+        else:
+            self.drop()
+        return True
+
+    def discard_queue(self):
+        self._queue.clear()
+        self.queued_bytes = 0
+
+    def drop(self):
+        """Stops sending data to the client and disconnects it"""
+
+        if self.failed:
+            return
+
+        self.failed = True
+        self.discard_queue()
+
+        if self.on_drop is not None:
+            self.on_drop(self)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        while self._queue and not self._paused and not self.failed:
+            data = self._queue.popleft()
+            self.queued_bytes -= len(data)
+            self.consumer.write(data)
+
+    def stopProducing(self):
+        self.failed = True
+        self.discard_queue()
@@ -3,7 +3,7 @@ Manages incoming and outgoing connections to other peers.
 """
 
 import logging
-import itertools
+import random
 import time
 
 from twisted.internet.protocol import ServerFactory, ClientFactory
@@ -14,81 +14,248 @@ from pixtream.peer.protocol import IncomingProtocol, OutgoingProtocol
 
 __all__ = ['ConnectionManager']
 
-class ConnectionList(object):
+logger = logging.getLogger(__name__)
+
+INCOMING = 'incoming'
+OUTGOING = 'outgoing'
+
+class ConnectionIndex(object):
+    """
+    Connections by partner id, with the direction of each one.
 
-    def __init__(self, protocol_class):
+    Keeps a snapshot tuple of the connections that is only rebuilt when a
+    connection is added or removed, so it can be iterated for broadcasts
+    without allocating.
+    """
+
+    def __init__(self):
         self.on_changed = Event()
+        self.on_removed = Event()
+        self.connections = ()
         self._connections = {}
-        self._protocol_class = protocol_class
+        self._directions = {}
+        self._counts = {INCOMING: 0, OUTGOING: 0}
 
-    def add(self, connection):
-        """Adds a new item to the list of connections."""
-
-        assert isinstance(connection, self._protocol_class)
-        assert isinstance(connection.partner_id, str)
+    def add(self, connection, direction):
+        """Adds a connection. Duplicated partners are dropped."""
 
         if connection.partner_id in self._connections:
-            logging.error('Adding existent connection')
+            logger.error('Adding existent connection')
             connection.drop()
             return
 
         self._connections[connection.partner_id] = connection
+        self._directions[connection.partner_id] = direction
+        self._counts[direction] += 1
+        self._changed()
+
+    def remove(self, connection):
+        """Removes a connection"""
+
+        if self._connections.get(connection.partner_id) is not connection:
+            logger.error('Removing nonexistent connection')
+            return
+
+        del self._connections[connection.partner_id]
+        direction = self._directions.pop(connection.partner_id)
+        self._counts[direction] -= 1
+        self._changed()
+        self.on_removed.call(connection)
+
+    def get(self, partner_id):
+        return self._connections.get(partner_id, None)
+
+    def direction(self, partner_id):
+        return self._directions.get(partner_id, None)
+
+    def count(self, direction):
+        """Number of connections in a direction"""
+        return self._counts[direction]
+
+    def __contains__(self, partner_id):
+        return partner_id in self._connections
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __iter__(self):
+        return iter(self.connections)
+
+    def _changed(self):
+        self.connections = tuple(self._connections.itervalues())
         self.on_changed.call(self)
 
+class ConnectionList(object):
+    """
+    The connections of the index in one direction.
+    """
+
+    def __init__(self, index, direction, protocol_class):
+        self.direction = direction
+        self._index = index
+        self._protocol_class = protocol_class
+
+    def add(self, connection):
+        """Adds a new item to the list of connections."""
+
+        assert isinstance(connection, self._protocol_class)
+        assert isinstance(connection.partner_id, str)
+
+        self._index.add(connection, self.direction)
+
     def remove(self, connection):
         """Removes an item from the list of connections."""
 
         assert isinstance(connection, self._protocol_class)
         assert isinstance(connection.partner_id, str)
 
-        if connection.partner_id not in self._connections:
-            logging.error('Removing nonexistent connection')
-            return
-
-        del self._connections[connection.partner_id]
-        self.on_changed.call(self)
+        self._index.remove(connection)
 
     def __iter__(self):
-        return self._connections.itervalues()
+        return (connection for connection in self._index
+                if self._index.direction(connection.partner_id) ==
+                   self.direction)
 
     def __contains__(self, partner_id):
-        return partner_id in self._connections
+        return self._index.direction(partner_id) == self.direction
 
     def __getitem__(self, partner_id):
-        return self._connections[partner_id]
+        if partner_id not in self:
+            raise KeyError(partner_id)
+        return self._index.get(partner_id)
+
+    def __len__(self):
+        return self._index.count(self.direction)
 
     @property
     def ids(self):
-        return self._connections.keys()
+        return [connection.partner_id for connection in self]
 
 # TODO: Remove PeerService dependency
 class ConnectionManager(object):
     """
     Maintains a collection of incoming and outgoing connections to a peer.
+
+    Outgoing connections are opened until the target out degree is reached,
+    choosing the peers with the best utility factor and latency first. Peers
+    that fail to connect are retried with exponential backoff. Incoming
+    connections are refused above the max in degree.
     """
 
-    def __init__(self, peer_service):
+    # FIXME: use configuration system
+    TARGET_OUT_DEGREE = 8
+    MAX_IN_DEGREE = 16
+    CONNECT_TIMEOUT = 10
+    BACKOFF = 5
+    MAX_BACKOFF = 300
+
+    clock = reactor
+
+    def __init__(self, peer_service, target_out_degree=None,
+                 max_in_degree=None):
         """
         Creates a new ConnectionManager object.
+
+        :param peer_service: The PeerService of the connections.
+        :param target_out_degree: Number of outgoing connections to keep.
+        :param max_in_degree: Max number of incoming connections.
         """
         self.on_update = Event()
 
         self._peer_service = peer_service
 
-        self._connection_attempts = set()
-
-        self.incoming_connections = ConnectionList(IncomingProtocol)
-        self.incoming_connections.on_changed.add_handler(self._updated)
-
-        self.outgoing_connections = ConnectionList(OutgoingProtocol)
-        self.outgoing_connections.on_changed.add_handler(self._updated)
+        self.target_out_degree = (self.TARGET_OUT_DEGREE
+                                  if target_out_degree is None
+                                  else target_out_degree)
+        self.max_in_degree = (self.MAX_IN_DEGREE if max_in_degree is None
+                              else max_in_degree)
+
+        # Start time of the connection attempts by peer id
+        self._connection_attempts = {}
+        # Number of consecutive failures and retry time by peer id
+        self._failures = {}
+        # Connection latency by peer id
+        self._latencies = {}
+        # Latency of the connections waiting for the handshake by peer id
+        self._handshaking = {}
+
+        # Control messages and bytes sent to partners no longer connected
+        self._closed_control = (0, 0)
+        self._control_sample = (time.time(), 0, 0)
+
+        self._index = ConnectionIndex()
+        self._index.on_changed.add_handler(self._updated)
+        self._index.on_removed.add_handler(self._connection_removed)
+
+        self.incoming_connections = ConnectionList(self._index, INCOMING,
+                                                   IncomingProtocol)
+        self.outgoing_connections = ConnectionList(self._index, OUTGOING,
+                                                   OutgoingProtocol)
 
     @property
     def all_connections(self):
-        """Returns an iterator of all current connections"""
+        """
+        Returns a tuple of all current connections. The tuple is cached and
+        only changes when connections are added or removed.
+        """
+
+        return self._index.connections
 
-        return itertools.chain(self.incoming_connections,
-                               self.outgoing_connections)
+    def direction(self, partner_id):
+        """Returns 'incoming' or 'outgoing', or None if not connected"""
+        return self._index.direction(partner_id)
+
+    def control_sent(self):
+        """
+        Returns the total control messages and bytes sent, including the ones
+        sent to partners no longer connected.
+        """
+
+        messages, bytes = self._closed_control
+        for connection in self._index:
+            messages += connection.stats.control_messages_out
+            bytes += connection.stats.control_bytes_out
+        return messages, bytes
+
+    def control_rate(self):
+        """
+        Returns the control messages and bytes per second sent to all the
+        partners since the last call.
+        """
+
+        now = time.time()
+        messages, bytes = self.control_sent()
+        last_time, last_messages, last_bytes = self._control_sample
+        self._control_sample = (now, messages, bytes)
+
+        elapsed = now - last_time
+        if elapsed <= 0:
+            return 0.0, 0.0
+
+        return ((messages - last_messages) / elapsed,
+                (bytes - last_bytes) / elapsed)
+
+    def stats(self):
+        """
+        Returns a dict with the traffic counters, rates and RTT of every
+        connection by partner id.
+        """
+
+        stats = {}
+        queues = self._peer_service.piece_manager.pieces_requested_to
+
+        for connection in self._index:
+            partner_id = connection.partner_id
+            queue = queues.get(partner_id)
+
+            snapshot = connection.stats.snapshot()
+            snapshot['direction'] = self._index.direction(partner_id)
+            snapshot['rtt'] = None if queue is None else queue.rtt
+            snapshot['min_rtt'] = None if queue is None else queue.min_rtt
+            snapshot['pending_requests'] = 0 if queue is None else len(queue)
+            stats[partner_id] = snapshot
+
+        return stats
 
     def connection_allowed(self, peer_id):
         """
@@ -98,12 +265,28 @@ class ConnectionManager(object):
         """
 
         if peer_id in self._connection_attempts:
-            logging.info('Connection attempt not allowed with ' + peer_id)
-            logging.info(str(self._connection_attempts))
+            logger.info('Connection attempt not allowed with ' + peer_id)
 
-        return (peer_id not in self._connections_ids and
+        return (peer_id not in self._index and
                 peer_id not in self._connection_attempts)
 
+    def incoming_allowed(self, peer_id):
+        """Returns true if an incoming connection with a peer is allowed"""
+
+        if len(self.incoming_connections) >= self.max_in_degree:
+            logger.info('Max in degree reached. Refusing ' + peer_id)
+            return False
+
+        return self.connection_allowed(peer_id)
+
+    def backoff(self, peer_id):
+        """Seconds until a failed peer can be dialed again"""
+
+        if peer_id not in self._failures:
+            return 0
+        _, retry_at = self._failures[peer_id]
+        return max(0, retry_at - self.clock.seconds())
+
     def listen(self, port):
         """Starts listening on the given port."""
 
@@ -111,62 +294,41 @@ class ConnectionManager(object):
         reactor.listenTCP(port, factory)
 
     def get_connection(self, partner_id):
-        if partner_id in self.incoming_connections:
-            return self.incoming_connections[partner_id]
-
-        if partner_id in self.outgoing_connections:
-            return self.outgoing_connections[partner_id]
-
-        return None
+        return self._index.get(partner_id)
 
     def connect_to_peer(self, peer):
         """Establish a new connection with a given peer."""
 
-        logging.debug('Connecting to peer:' + peer.id)
-        self._connection_attempts.add(peer.id)
+        logger.debug('Connecting to peer:' + peer.id)
+        self._connection_attempts[peer.id] = self.clock.seconds()
         factory = self._create_client_factory(peer.id)
-        reactor.connectTCP(peer.ip, peer.port, factory)
+        self._dial(peer, factory)
 
     def connect_to_peers(self, peers):
         """
-        Connect to a list of peers
-        """
-
-        for peer in peers:
-            if peer.id in self._connections_ids:
-                continue
-            self.connect_to_peer(peer)
-
-    def heartbeat(self):
-        """
-        Sends heartbeats
+        Connects to the best peers of a list until the target out degree is
+        reached.
         """
 
-        for connection in self.all_connections:
-            connection.send_heartbeat()
-
-    def check_heartbeats(self):
-        """
-        Check connections for last heartbeat
-        """
+        self._expire_attempts()
+        self._forget_peers(set(peer.id for peer in peers))
 
-        #FIXME: Put this in a configuration file
-        PEER_TIMEOUT  = 30
+        free = (self.target_out_degree - len(self.outgoing_connections) -
+                len(self._connection_attempts) - len(self._handshaking))
+        if free <= 0:
+            return
 
-        for connection in self.all_connections:
-            timeout = time.time() - connection.last_heartbeat
-            cid = connection.partner_id
-            logging.info('Checking peer timeout {0}'.format(cid))
-            if timeout > PEER_TIMEOUT:
-                logging.info('Peer Connection Timeout {0}'.format(cid))
-                connection.drop()
+        candidates = [peer for peer in peers
+                      if peer.id not in self._index and
+                         peer.id not in self._connection_attempts and
+                         peer.id not in self._handshaking and
+                         self.backoff(peer.id) == 0]
 
+        candidates.sort(key=self._peer_rank)
 
-    @property
-    def _connections_ids(self):
+        for peer in candidates[:free]:
+            self.connect_to_peer(peer)
 
-        return set(self.incoming_connections.ids +
-                   self.outgoing_connections.ids)
 
     def _create_server_factory(self):
 
@@ -175,6 +337,7 @@ class ConnectionManager(object):
         factory.add_connection = self.incoming_connections.add
         factory.remove_connection = self.incoming_connections.remove
         self._init_factory(factory)
+        factory.connection_allowed = self.incoming_allowed
         return factory
 
     def _create_client_factory(self, target_id):
@@ -182,8 +345,11 @@ class ConnectionManager(object):
         factory = ClientFactory()
         factory.protocol = OutgoingProtocol
         factory.target_id = target_id
-        factory.add_connection = self.outgoing_connections.add
+        factory.add_connection = self._add_outgoing_connection
         factory.remove_connection = self.outgoing_connections.remove
+        factory.clientConnectionFailed = (lambda connector, reason:
+                                          self._connection_failed(target_id))
+        factory.outgoing_connection_lost = self._outgoing_connection_lost
         self._init_factory(factory)
         return factory
 
@@ -195,6 +361,75 @@ class ConnectionManager(object):
     def _updated(self, connection):
         self.on_update.call(self)
 
+    def _connection_removed(self, connection):
+        stats = connection.stats
+        messages, bytes = self._closed_control
+        self._closed_control = (messages + stats.control_messages_out,
+                                bytes + stats.control_bytes_out)
+
+    def _add_outgoing_connection(self, connection):
+        self.outgoing_connections.add(connection)
+
+        latency = self._handshaking.pop(connection.partner_id, None)
+        if latency is not None:
+            self._latencies[connection.partner_id] = latency
+        self._failures.pop(connection.partner_id, None)
+
+    def _outgoing_connection_lost(self, peer_id):
+        """Counts a connection lost before the handshake as a failure"""
+
+        if self._handshaking.pop(peer_id, None) is not None:
+            self._connection_failed(peer_id)
+
+    def _forget_peers(self, known_ids):
+        """Forgets the latency and failures of peers not in known_ids"""
+
+        for table in (self._latencies, self._failures):
+            for peer_id in list(table):
+                if peer_id not in known_ids:
+                    del table[peer_id]
+
+    def _dial(self, peer, factory):
+        reactor.connectTCP(peer.ip, peer.port, factory,
+                           timeout=self.CONNECT_TIMEOUT)
+
+    def _peer_rank(self, peer):
+        """Sort key: best utility factor first, then lowest latency"""
+
+        latency = self._latencies.get(peer.id, float('inf'))
+        return (-peer.utility_factor, latency, random.random())
+
+    def _expire_attempts(self):
+        """Forgets the attempts that never completed"""
+
+        now = self.clock.seconds()
+        expired = [peer_id
+                   for peer_id, start in self._connection_attempts.iteritems()
+                   if now - start > 2 * self.CONNECT_TIMEOUT]
+
+        for peer_id in expired:
+            logger.info('Connection attempt to %s timed out', peer_id)
+            self._connection_failed(peer_id)
+
+    def _connection_failed(self, peer_id):
+        """Ends an attempt and delays the next one exponentially"""
+
+        self._connection_attempts.pop(peer_id, None)
+
+        failures, _ = self._failures.get(peer_id, (0, 0))
+        failures += 1
+        delay = min(self.MAX_BACKOFF, self.BACKOFF * 2 ** (failures - 1))
+        self._failures[peer_id] = (failures, self.clock.seconds() + delay)
+
+        logger.info('Connection to %s failed. Retrying in %s s', peer_id,
+                    delay)
+
     def _end_connection_attempt(self, peer_id):
-        if peer_id in self._connection_attempts:
-            self._connection_attempts.remove(peer_id)
+        """
+        Called when the TCP connection is made. The latency is only kept if
+        the handshake succeeds.
+        """
+
+        start = self._connection_attempts.pop(peer_id, None)
+        if start is not None:
+            self._handshaking[peer_id] = self.clock.seconds() - start
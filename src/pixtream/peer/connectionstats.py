@@ -0,0 +1,98 @@
+"""
+Traffic and latency measurements of a connection
+"""
+
+import math
+import time
+
+__all__ = ['RateMeter', 'ConnectionStats']
+
+class RateMeter(object):
+    """
+    Rolling transfer rate.
+
+    Keeps an exponentially decaying sum of the bytes transferred, so the rate
+    reflects roughly the last window seconds.
+    """
+
+    # FIXME: use configuration system
+    WINDOW = 10.0
+
+    def __init__(self, window=None):
+        self.window = float(self.WINDOW if window is None else window)
+        self._total = 0.0
+        self._last = None
+
+    def add(self, size, now=None):
+        """Registers size bytes transferred"""
+
+        now = time.time() if now is None else now
+        self._total = self._decayed(now) + size
+        self._last = now
+
+    def rate(self, now=None):
+        """Returns the rate in bytes per second"""
+
+        now = time.time() if now is None else now
+        return self._decayed(now) / self.window
+
+    def _decayed(self, now):
+        if self._last is None:
+            return 0.0
+        elapsed = max(0.0, now - self._last)
+        return self._total * math.exp(-elapsed / self.window)
+
+class ConnectionStats(object):
+    """
+    Counters of a single connection.
+
+    Keeps bytes and messages in each direction, the control messages (every
+    message but data packets) sent, and rolling upload and download rates.
+    The round trip time is measured by the RequestQueue of the partner.
+    """
+
+    def __init__(self, now=None):
+        self.connected_at = time.time() if now is None else now
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = {}
+        self.messages_out = {}
+        self.control_messages_out = 0
+        self.control_bytes_out = 0
+
+        self.download = RateMeter()
+        self.upload = RateMeter()
+
+    def data_received(self, size, now=None):
+        self.bytes_in += size
+        self.download.add(size, now)
+
+    def data_sent(self, size, now=None):
+        self.bytes_out += size
+        self.upload.add(size, now)
+
+    def message_received(self, name):
+        self.messages_in[name] = self.messages_in.get(name, 0) + 1
+
+    def message_sent(self, name, size, control=False):
+        self.messages_out[name] = self.messages_out.get(name, 0) + 1
+
+        if control:
+            self.control_messages_out += 1
+            self.control_bytes_out += size
+
+    def snapshot(self, now=None):
+        """Returns a dict with the current values"""
+
+        now = time.time() if now is None else now
+
+        return {'connected_for': now - self.connected_at,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'download_rate': self.download.rate(now),
+                'upload_rate': self.upload.rate(now),
+                'messages_in': dict(self.messages_in),
+                'messages_out': dict(self.messages_out),
+                'control_messages_out': self.control_messages_out,
+                'control_bytes_out': self.control_bytes_out}
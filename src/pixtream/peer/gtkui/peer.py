@@ -10,8 +10,7 @@ from pixtream.peer import scriptutils
 from pixtream.peer.gtkui.mainwindow import MainWindow
 
 def run():
-    scriptutils.setup_logger()
-    ip, port, streaming_port, tracker = scriptutils.parse_options()
+    ip, port, streaming_port, tracker, _, _ = scriptutils.parse_options()
     window = MainWindow(ip, port, tracker, streaming_port)
     window.show_all()
     reactor.run()
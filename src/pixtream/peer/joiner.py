@@ -2,54 +2,82 @@
 Joins Pixtream data packets into a Stream
 """
 
-from itertools import takewhile, count
-
 from pixtream.util.event import Event
 
 __all__ = ['Joiner']
 
 class Joiner(object):
+    """
+    Joins packets in order.
+
+    Out of order packets wait in a reorder buffer. If the buffer grows beyond
+    max_pending packets, the missing packets are skipped and the on_gap event
+    is called with the first skipped and the next joined sequence.
+    """
 
-    def __init__(self):
+    # FIXME: use configuration system
+    MAX_PENDING = 256
+
+    def __init__(self, max_pending=None, first_sequence=0):
 
         self.on_data_joined = Event()
         self.on_end_join = Event()
+        self.on_gap = Event()
+
+        self.max_pending = (self.MAX_PENDING if max_pending is None
+                            else max_pending)
 
-        self._buffer = bytes()
-        self._current_sequence = 0
+        self._chunks = []
+        self._current_sequence = first_sequence
         self._packets = {}
-        self.sequences = set()
+
+    @property
+    def sequences(self):
+        """Sequences of the packets waiting in the reorder buffer"""
+        return set(self._packets.keys())
+
+    @property
+    def current_sequence(self):
+        """The sequence of the next packet to be joined"""
+        return self._current_sequence
 
     def push_packet(self, packet):
+        if (packet.sequence < self._current_sequence or
+            packet.sequence in self._packets):
+            return
+
         self._packets[packet.sequence] = packet.data
+
+        if len(self._packets) > self.max_pending:
+            self._skip_gap()
+
         self._join_buffer()
-        self._update_sequences()
 
     def end_join(self):
         self.on_end_join.call(self)
 
-    def pop_stream(self):
-        buffer = self._buffer
-        self._buffer = bytes()
-        return buffer
-
-    def _update_sequences(self):
-        self.sequences = set(self._packets.keys())
+    def pop_chunks(self):
+        """Returns the list of joined packet data since the last pop"""
 
-    def _join_buffer(self):
-        sequences = takewhile(lambda seq: seq in self._packets,
-                              count(self._current_sequence))
+        chunks = self._chunks
+        self._chunks = []
+        return chunks
 
-        sequences = list(sequences)
+    def pop_stream(self):
+        return ''.join(self.pop_chunks())
 
-        if len(sequences) > 0:
-            self._buffer += ''.join(self._packets[seq] for seq in sequences)
+    def _skip_gap(self):
+        first = self._current_sequence
+        self._current_sequence = min(self._packets)
+        self.on_gap.call(self, first, self._current_sequence)
 
-            for sequence in sequences:
-                del self._packets[sequence]
+    def _join_buffer(self):
+        joined = False
 
-            self._current_sequence = sequences[-1] + 1
+        while self._current_sequence in self._packets:
+            self._chunks.append(self._packets.pop(self._current_sequence))
+            self._current_sequence += 1
+            joined = True
 
+        if joined:
             self.on_data_joined.call(self)
-
-
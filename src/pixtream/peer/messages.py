@@ -7,6 +7,18 @@ import struct
 __all__ = ['Field', 'FixedLengthMessage', 'Message', 'MessageException',
            'Payload', 'VariableLengthMessage']
 
+# Source of the specialized functions generated for every message class
+_CODEC_TEMPLATE = '''
+def _parse(data):
+    self = new(message_class)
+    {attributes}, = unpack(data)
+    {payload}
+    return self
+
+def _pack_fields(self):
+    return pack({attributes})
+'''
+
 class Field(object):
     """
     Simple for to define Fields in Message specs
@@ -42,6 +54,7 @@ class Message(object):
     """
 
     message_header = '?'
+    _variable_length = False
     _header_map = {}
     _prefix_struct = struct.Struct('>I')
 
@@ -62,6 +75,7 @@ class Message(object):
 
         message_class._parse_fields()
         message_class._create_message_struct()
+        message_class._compile_codec()
 
         cls._header_map[message_class.message_header] = message_class
         return message_class
@@ -84,15 +98,11 @@ class Message(object):
         if message_class is None:
             raise MessageException('Got unregistered message', data)
 
-        message = message_class()
-
         try:
-            message._unpack(data)
+            return message_class._parse(data)
         except struct.error:
             raise MessageException('Message not well formatted', data)
 
-        return message
-
     def pack(self):
         """
         Pack the message object into a byte string.
@@ -102,8 +112,7 @@ class Message(object):
 
         if not self.is_valid():
             raise MessageException("Trying to pack an invalid message")
-        values = [getattr(self, name) for name in self.field_names]
-        return self._message_struct.pack(*values)
+        return self._pack_fields()
 
     def pack_prefixed(self):
         """
@@ -113,14 +122,30 @@ class Message(object):
         representing the size of the message
         """
 
+        return ''.join(self.pack_prefixed_parts())
+
+    def pack_prefixed_parts(self):
+        """
+        Pack the message with a prefix as a list of byte strings
+
+        The concatenation of the list is the result of pack_prefixed. Used to
+        write messages without joining them.
+        """
+
         message = self.pack()
-        return self._prefix_struct.pack(len(message)) + message
+        return [self._prefix_struct.pack(len(message)) + message]
 
     def is_valid(self):
         """Returns True if the data in the message is valid"""
+
+        if self.message_header != self.__class__.message_header:
+            return False
+
+        if self._unconditional:
+            return True
+
         try:
-            return (self.message_header == self.__class__.message_header and
-                    all(self.valid_conditions()))
+            return all(self.valid_conditions())
         except:
             return False
 
@@ -144,11 +169,6 @@ class Message(object):
         """
         return cls()
 
-    def _unpack(self, data):
-        fields = self._message_struct.unpack(data)
-        for i, name in enumerate(self.field_names):
-            setattr(self, name, fields[i])
-
     @classmethod
     def _parse_fields(cls):
         cls.field_names = ['message_header']
@@ -165,6 +185,39 @@ class Message(object):
         struct_string += ''.join(cls.field_structs)
         cls._message_struct = struct.Struct(struct_string)
 
+    @classmethod
+    def _compile_codec(cls):
+        """
+        Generates the functions to pack and unpack the fields of the class.
+
+        The functions access the attributes directly instead of looping over
+        the field names.
+        """
+
+        message_struct = cls._message_struct
+        attributes = ', '.join('self.' + name for name in cls.field_names)
+
+        if cls._variable_length:
+            # The payload follows the fields
+            unpack = message_struct.unpack_from
+            payload = 'self.unpack_payload(data[{0}:])'.format(
+                                                        message_struct.size)
+        else:
+            unpack = message_struct.unpack
+            payload = ''
+
+        namespace = dict(new=object.__new__, message_class=cls,
+                         pack=message_struct.pack, unpack=unpack)
+        exec _CODEC_TEMPLATE.format(attributes=attributes,
+                                    payload=payload) in namespace
+
+        cls._parse = staticmethod(namespace['_parse'])
+        cls._pack_fields = namespace['_pack_fields']
+
+        # Messages without conditions only need the header to be valid
+        cls._unconditional = (cls.valid_conditions.im_func is
+                              Message.valid_conditions.im_func)
+
 class FixedLengthMessage(Message):
     """
     Base class for Messages with fixed length
@@ -175,16 +228,23 @@ class VariableLengthMessage(Message):
     Base class for Messages with variable lenght
     """
 
-    def _unpack(self, data):
-        payload = data[self._message_struct.size:]
-        data = data[:self._message_struct.size]
-        super(VariableLengthMessage, self)._unpack(data)
-        self.unpack_payload(payload)
+    _variable_length = True
 
     def pack(self):
         """Packs the fixed part of the message plus a payload"""
         return super(VariableLengthMessage, self).pack() + self.pack_payload()
 
+    def pack_prefixed_parts(self):
+        """
+        Packs the prefix and the fixed part of the message in a byte string
+        followed by the payload, which is never copied.
+        """
+
+        fixed = super(VariableLengthMessage, self).pack()
+        payload = self.pack_payload()
+        prefix = self._prefix_struct.pack(len(fixed) + len(payload))
+        return [prefix + fixed, payload]
+
     def unpack_payload(self, payload):
         """
         Unpacks the payload
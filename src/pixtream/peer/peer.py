@@ -14,12 +14,12 @@ __all__ = ['run', 'run_source']
 
 def run():
     """Runs a peer program."""
-    scriptutils.setup_logger()
-    ip, port, streaming_port, tracker = scriptutils.parse_options()
-    service = PeerService(ip, port, tracker)
+    (ip, port, streaming_port, tracker,
+     service_options, server_options) = scriptutils.parse_options()
+    service = PeerService(ip, port, tracker, **service_options)
     app = PeerApplication()
     app.set_service(service)
-    app.start_http_server(streaming_port)
+    app.start_http_server(streaming_port, **server_options)
     app.listen()
     app.connect_to_tracker()
 
@@ -31,15 +31,17 @@ def run():
 def run_source():
     """Runs a peer program."""
 
-    scriptutils.setup_logger()
     (ip, port, streaming_port,
      tracker,
-     source_type, source) = scriptutils.parse_source_options()
+     source_type, source,
+     offset, packet_size, max_delay,
+     service_options, server_options) = scriptutils.parse_source_options()
 
-    service = SourcePeerService(ip, port, tracker)
+    service = SourcePeerService(ip, port, tracker, offset, packet_size,
+                                max_delay, **service_options)
     app = PeerApplication()
     app.set_service(service)
-    app.start_http_server(streaming_port)
+    app.start_http_server(streaming_port, **server_options)
     app.listen() # TODO: listen(port)
     app.connect_to_tracker() # TODO: announce(tracker)
 
@@ -54,13 +54,27 @@ class PeerApplication(object):
         self._peer.attach_stream_client(client)
         self._peer.stream_client.open_file(filename)
 
-    def start_tcp_server(self, port):
-        server = TCPStreamServer(port)
+    def start_tcp_server(self, port, replay_bytes=None, sync_pattern=None):
+        """
+        Starts a TCP stream server.
+
+        :param replay_bytes: Bytes of recent stream kept for new clients.
+        :param sync_pattern: Byte string marking where new clients can start.
+        """
+
+        server = TCPStreamServer(port, replay_bytes, sync_pattern)
         self._peer.stream_server = server
         server.start()
 
-    def start_http_server(self, port):
-        server = HTTPStreamServer(port)
+    def start_http_server(self, port, replay_bytes=None, sync_pattern=None):
+        """
+        Starts a HTTP stream server.
+
+        :param replay_bytes: Bytes of recent stream kept for new clients.
+        :param sync_pattern: Byte string marking where new clients can start.
+        """
+
+        server = HTTPStreamServer(port, replay_bytes, sync_pattern)
         self._peer.stream_server = server
         server.start()
 
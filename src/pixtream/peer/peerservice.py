@@ -8,29 +8,42 @@ import logging
 import uuid
 
 from pixtream.peer.piecemanager import PieceManager
+from pixtream.peer.choker import Choker
 from pixtream.peer.trackermanager import TrackerManager
 from pixtream.peer.connectionmanager import ConnectionManager
 from pixtream.peer.joiner import Joiner
 from pixtream.peer.splitter import Splitter
 from pixtream.peer.utilitymanager import UtilityManager
+from pixtream.peer.uploadscheduler import UploadScheduler
 from pixtream.peer.peerdatabase import PeerDatabase, Peer
 from pixtream.util.twistedrepeater import TwistedRepeater
+from pixtream.util.logconfig import MESSAGE_LOGGER
 
 __all__ = ['PeerService', 'SourcePeerService']
 
+logger = logging.getLogger(__name__)
+message_logger = logging.getLogger(MESSAGE_LOGGER)
+
 class PeerService(object):
     """
     Controls every aspect of the peer application.
     """
 
+    # FIXME: use configuration system
+    BUFFER_BYTES = 32 * 1024 * 1024
+
     # TODO: Refactor this. Use specific methods.
-    def __init__(self, ip, port, tracker_url):
+    def __init__(self, ip, port, tracker_url, selection_policy=None,
+                 max_upload_rate=None):
         """
         Inits the Peer application.
 
         :param ip: The IP address of the peer.
         :param port: The port to listen.
         :param tracker_url: The URL of the tracker.
+        :param selection_policy: The SelectionPolicy used to choose the pieces
+                                 to request. Rarest first by default.
+        :param max_upload_rate: Max upload rate in bytes per second.
         """
 
         self.port = port
@@ -38,14 +51,21 @@ class PeerService(object):
 
         self.peer_id = self._generate_peer_id()
         self.tracker_peers = PeerDatabase()
+        self.packet_size = None
+        self._deadlines_missed = 0
+        self._next_joined = None
 
         self.piece_manager = None
+        self.upload_scheduler = None
+        self.choker = None
         self.connection_manager = None
         self.tracker_manager = None
         self.joiner = None
         self.stream_server = None
 
-        self._create_piece_manager()
+        self._create_piece_manager(selection_policy)
+        self._create_upload_scheduler(max_upload_rate)
+        self._create_choker()
         self._create_utility_manager()
         self._create_connection_manager()
         self._create_tracker_manager(tracker_url)
@@ -55,92 +75,286 @@ class PeerService(object):
         self.logic_repeater = TwistedRepeater(self._peer_logic, 2)
         self.logic_repeater.start_later()
 
+        # FIXME: seconds hardcoded
+        self.choke_repeater = TwistedRepeater(self._run_choker, 10)
+        self.choke_repeater.start_later()
+
     @property
     def pieces(self):
-        return self.piece_manager.own_sequences
+        return self.piece_manager.advertised_sequences
 
     def partner_got_piece(self, partner_id, piece):
         self.piece_manager.partner_got_piece(partner_id, piece)
 
+        connection = self.connection_manager.get_connection(partner_id)
+        if (connection is not None and not connection.interested and
+            self.piece_manager.wants_piece(piece)):
+            connection.send_interested()
+
+    def piece_window(self, newest):
+        return self.piece_manager.piece_window(newest)
+
     def partner_bitset(self, partner_id, pieces):
         self.piece_manager.partner_got_pieces(partner_id, pieces)
+        self._update_interest(partner_id)
+
+    def stream_info_received(self, partner_id, packet_size):
+        if self.packet_size is not None:
+            if packet_size != self.packet_size:
+                logger.warning('Partner %s uses packet size %s instead of %s',
+                               partner_id, packet_size, self.packet_size)
+            return
+
+        logger.info('Stream packet size: %s', packet_size)
+        self.set_packet_size(packet_size)
+
+        for connection in self.connection_manager.all_connections:
+            if connection.partner_id != partner_id:
+                connection.send_stream_info()
+
+    def set_packet_size(self, packet_size):
+        """Sizes the piece and reorder buffers for the packets of the stream"""
+
+        self.packet_size = packet_size
+
+        pieces = max(1, self.BUFFER_BYTES // packet_size)
+        self.piece_manager.window_pieces = pieces
+        self.piece_manager.advertise_pieces = max(1, pieces // 2)
+        self.joiner.max_pending = max(1, pieces // 2)
+
+        for connection in self.connection_manager.all_connections:
+            connection.set_packet_size(packet_size)
+
+    def partner_connected(self, partner_id):
+        # Partners choke us until they send an unchoke message
+        self.piece_manager.partner_choked(partner_id)
+
+        if self.packet_size is not None:
+            connection = self.connection_manager.get_connection(partner_id)
+            if connection is not None:
+                connection.set_packet_size(self.packet_size)
+
+    def partner_interested(self, partner_id):
+        if not self.choker.admit(partner_id):
+            return
+
+        connection = self.connection_manager.get_connection(partner_id)
+        if connection is not None:
+            connection.send_unchoke()
+
+    def choked_by_partner(self, partner_id):
+        self.piece_manager.partner_choked(partner_id)
+        self._request_needed_pieces()
+
+    def unchoked_by_partner(self, partner_id):
+        self.piece_manager.partner_unchoked(partner_id)
+        self._request_needed_pieces()
+
+    def partner_disconnected(self, partner_id):
+        self.piece_manager.remove_partner(partner_id)
+        self.upload_scheduler.partner_removed(partner_id)
+        self.choker.remove_partner(partner_id)
 
     def receive_request(self, partner_id, sequence):
         self.piece_manager.partner_requested_piece(partner_id, sequence)
+        self.upload_scheduler.piece_requested(partner_id, sequence)
+
+    def receive_cancel_request(self, partner_id, sequence):
+        self.piece_manager.partner_cancelled_piece(partner_id, sequence)
+        self.upload_scheduler.piece_cancelled(partner_id, sequence)
 
     def receive_packet(self, packet, sender_id):
+        self._cancel_duplicated_request(packet.sequence, sender_id)
         self.joiner.push_packet(packet)
-        self.piece_manager.add_new_piece(packet.sequence, packet.data)
+        self.piece_manager.add_new_piece(packet.sequence, packet.data,
+                                         sender_id)
         if sender_id is not None:
             self.utility_manager.add_peer_utility(sender_id, len(packet.data))
 
         for connection in self.connection_manager.all_connections:
-            connection.send_got_piece(packet.sequence)
+            connection.announce_piece(packet.sequence)
+
+        self.upload_scheduler.piece_available(packet.sequence)
+
+        if sender_id is not None:
+            self._request_needed_pieces()
 
     def _peer_logic(self):
-        logging.info('Executing Peer Logic')
-        self._refresh_connections()
+        logger.info('Executing Peer Logic')
         self._contact_peers(self.tracker_peers)
+        self._expire_requests()
+        self._update_interests()
         self._request_needed_pieces()
         self._send_requested_pieces()
 
         utility = self.utility_manager.utility_by_peer
         self.tracker_manager.utility_by_peer.update(utility)
 
+        self._log_control_rate()
+        self._log_client_lag()
+        self._log_deadlines_missed()
+
+    def _run_choker(self):
+        """Chokes and unchokes partners according to their contribution"""
+
+        partners = [connection.partner_id
+                    for connection in self.connection_manager.all_connections
+                    if connection.partner_interested]
+        utility = self.utility_manager.utility_by_peer
+
+        to_choke, to_unchoke = self.choker.run(partners, utility)
+
+        for partner_id in to_choke:
+            connection = self.connection_manager.get_connection(partner_id)
+            if connection is not None:
+                connection.send_choke()
+            self.piece_manager.clear_partner_requests(partner_id)
+            self.upload_scheduler.partner_removed(partner_id)
+
+        for partner_id in to_unchoke:
+            connection = self.connection_manager.get_connection(partner_id)
+            if connection is not None:
+                connection.send_unchoke()
+
+        logger.info('Choker: %s', self.choker.stats())
+
+    def _log_deadlines_missed(self):
+        missed = self.piece_manager.policy.deadlines_missed
+        if missed > self._deadlines_missed:
+            logger.warning('Missed %s piece deadlines (%s in total)',
+                           missed - self._deadlines_missed, missed)
+            self._deadlines_missed = missed
+
+    def _log_client_lag(self):
+        if self.stream_server is None:
+            return
+
+        lag = self.stream_server.client_lag()
+        if any(lag.itervalues()):
+            logger.info('Stream clients lag (bytes): %s', lag)
+
+    def _log_control_rate(self):
+        messages, bytes = self.connection_manager.control_rate()
+        logger.info('Control messages: %.1f/s %.0f B/s', messages, bytes)
+
     def _request_needed_pieces(self):
+        """Fills the request queues of the partners with missing pieces"""
+
+        slots = self.piece_manager.free_request_slots()
+        if slots == 0:
+            return
 
-        missing_pieces = self.piece_manager.get_pieces_to_request()
+        missing_pieces = self.piece_manager.get_pieces_to_request(slots)
 
         for piece in missing_pieces:
             partner_id = self.piece_manager.best_partner_for_piece(piece)
             if partner_id is None:
-                logging.error('No partner for {0}'.format(piece))
+                message_logger.debug('No free partner for %s', piece)
                 continue
             connection = self.connection_manager.get_connection(partner_id)
             if connection is None:
-                logging.error('No connection for {0}'.format(partner_id))
+                logger.error('No connection for %s', partner_id)
                 continue
 
-            if self.piece_manager.can_request_piece(partner_id, piece):
-                connection.send_request_packet(piece)
-                self.piece_manager.mark_piece_as_requested(partner_id, piece)
+            connection.send_request_packet(piece)
+            self.piece_manager.mark_piece_as_requested(partner_id, piece)
 
-    def _send_requested_pieces(self):
-        for partner_id, sequence in self.piece_manager.get_pieces_to_send():
-            data = self.piece_manager.get_piece_data(sequence)
-            if data is None:
-                logging.error('Dont have piece {0}'.format(sequence))
-                return
+    def _update_interests(self):
+        for connection in self.connection_manager.all_connections:
+            self._update_interest(connection.partner_id)
+
+    def _update_interest(self, partner_id):
+        """Tells a partner if we are interested in its pieces or not"""
+
+        connection = self.connection_manager.get_connection(partner_id)
+        if connection is None:
+            return
+
+        needed = self.piece_manager.needs_pieces_from(partner_id)
+
+        if needed and not connection.interested:
+            connection.send_interested()
+        elif not needed and connection.interested:
+            connection.send_not_interested()
+
+    def _expire_requests(self):
+        """Cancels the stale requests so they can be sent to other partners"""
+
+        for partner_id, piece in self.piece_manager.expire_requests():
+            logger.info('Request %s to %s expired', piece, partner_id)
             connection = self.connection_manager.get_connection(partner_id)
-            if connection == None:
-                logging.error('Dont have connection {0}'.format(partner_id))
-                return
-            connection.send_data_packet(sequence, data)
-            self.piece_manager.mark_piece_as_sent(partner_id, sequence)
-            logging.info('Sending data {0} to {1}'.format(sequence, partner_id))
+            if connection is not None:
+                connection.send_cancel_request(piece)
+
+    def _cancel_duplicated_request(self, sequence, sender_id):
+        """Cancels a request of a piece that arrived from other partner"""
+
+        partner_id = self.piece_manager.requested_partner(sequence)
+        if partner_id is None or partner_id == sender_id:
+            return
+
+        connection = self.connection_manager.get_connection(partner_id)
+        if connection is not None:
+            connection.send_cancel_request(sequence)
+
+    def _send_requested_pieces(self):
+        """Queues any available requested piece the scheduler missed"""
+
+        pieces = self.piece_manager.get_pieces_to_send()
+        self.upload_scheduler.schedule(pieces)
+
+        depths = self.upload_scheduler.queue_depths()
+        logger.debug('Upload queue depths: %s', depths)
+
+    def _send_piece(self, partner_id, sequence, data):
+        connection = self.connection_manager.get_connection(partner_id)
+        if connection is None:
+            logger.error('Dont have connection %s', partner_id)
+            return False
+
+        connection.send_data_packet(sequence, data)
+        message_logger.info('Sending data %s to %s', sequence, partner_id)
+        return True
 
     def _update_peers(self, sender, peer_list):
         self.tracker_peers.update_peers(peer_list)
         self.tracker_peers.remove_peer(self.peer_id)
 
         peers = '|'.join(str(p) for p in self.tracker_manager.peer_list)
-        logging.debug('Tracker updated: {0}'.format(peers))
+        logger.debug('Tracker updated: %s', peers)
 
     def _contact_peers(self, peers):
         self.connection_manager.connect_to_peers(peers)
 
-    def _refresh_connections(self):
-        self.connection_manager.heartbeat()
-        self.connection_manager.check_heartbeats()
-
     def _data_joined(self, joiner):
+        chunks = joiner.pop_chunks()
+        first = joiner.current_sequence - len(chunks)
+
         if self.stream_server:
-            self.stream_server.send_stream(joiner.pop_stream())
+            # Stream offsets are absolute, so the stream server moves to the
+            # packet offset when the stream starts midway or skips a gap
+            if first != self._next_joined and self.packet_size is not None:
+                self.stream_server.seek(first * self.packet_size)
+            self.stream_server.send_stream(''.join(chunks))
         else:
-            logging.debug('Data joined without stream_server')
+            logger.debug('Data joined without stream_server')
+
+        self._next_joined = joiner.current_sequence
+
+    def _data_skipped(self, joiner, first, last):
+        logger.warning('Skipped pieces from %s to %s', first, last)
+        self.piece_manager.skip_to(last)
+
+    def _create_piece_manager(self, selection_policy):
+        self.piece_manager = PieceManager(policy=selection_policy)
 
-    def _create_piece_manager(self):
-        self.piece_manager = PieceManager()
+    def _create_upload_scheduler(self, max_upload_rate):
+        self.upload_scheduler = UploadScheduler(self.piece_manager,
+                                                self._send_piece,
+                                                max_upload_rate)
+
+    def _create_choker(self):
+        self.choker = Choker()
 
     def _create_connection_manager(self):
         self.connection_manager = ConnectionManager(self)
@@ -151,9 +365,10 @@ class PeerService(object):
 
         self.tracker_manager.on_updated.add_handler(self._update_peers)
 
-    def _create_joiner(self):
-        self.joiner = Joiner()
+    def _create_joiner(self, first_sequence=0):
+        self.joiner = Joiner(first_sequence=first_sequence)
         self.joiner.on_data_joined.add_handler(self._data_joined)
+        self.joiner.on_gap.add_handler(self._data_skipped)
 
     def _create_utility_manager(self):
         self.utility_manager = UtilityManager()
@@ -165,35 +380,76 @@ class PeerService(object):
         id = format(self.port, '014d')
         ## END TESTING
         peer_id = 'PX0001' +  id
-        logging.debug('Generated Peer ID: "{0}"'.format(peer_id))
+        logger.debug('Generated Peer ID: "%s"', peer_id)
         return peer_id
 
 # TODO: Move this to a config based system
 SPLIT_PACKET_SIZE = 64000
 
 class SourcePeerService(PeerService):
+    """
+    Peer that publishes a stream read from a stream client.
+
+    Several sources can publish the same stream. Their splitters number the
+    packets by their offset in the shared input, so the same data gets the
+    same sequence in every source and receivers can fetch it from any of
+    them. Sources also behave as regular peers and fetch the pieces they
+    don't have from the other sources.
+    """
 
-    def __init__(self, ip, port, tracker_url):
-        super(SourcePeerService, self).__init__(ip, port, tracker_url)
+    def __init__(self, ip, port, tracker_url, start_offset=0,
+                 packet_size=None, max_delay=None, selection_policy=None,
+                 max_upload_rate=None):
+        """
+        Inits the source peer.
+
+        :param start_offset: Offset in the shared input of the first byte
+                             read by the stream client.
+        :param packet_size: Size of the packets of the stream.
+        :param max_delay: Seconds the input can wait for a packet to be
+                          filled before a partial packet is sent.
+        :param selection_policy: The SelectionPolicy used to choose the pieces
+                                 to request from other sources.
+        :param max_upload_rate: Max upload rate in bytes per second.
+        """
 
         self.splitter = None
         self.stream_client  = None
 
-        self._create_splitter()
+        if packet_size is None:
+            packet_size = SPLIT_PACKET_SIZE
+        self._create_splitter(start_offset, packet_size, max_delay)
 
-    def _peer_logic(self):
-        self._send_requested_pieces()
+        super(SourcePeerService, self).__init__(ip, port, tracker_url,
+                                                selection_policy,
+                                                max_upload_rate)
+
+        self.set_packet_size(packet_size)
 
     def _packet_created(self, splitter):
         packet = splitter.pop_packet()
+
+        # Another source may have sent it already
+        if self.piece_manager.have_piece(packet.sequence):
+            return
+
         self.receive_packet(packet, None)
-        logging.debug('Packet created. Seq: {0}'.format(packet.sequence))
+        message_logger.debug('Packet created. Seq: %s', packet.sequence)
 
     def _input_stream_end(self, splitter):
         self.joiner.end_join()
 
-    def _create_splitter(self):
-        self.splitter = Splitter(SPLIT_PACKET_SIZE)
+    def _create_piece_manager(self, selection_policy):
+        self.piece_manager = PieceManager(
+            policy=selection_policy,
+            first_sequence=self.splitter.current_sequence)
+
+    def _create_joiner(self):
+        super(SourcePeerService, self)._create_joiner(
+            self.splitter.current_sequence)
+
+    def _create_splitter(self, start_offset, packet_size, max_delay):
+        self.splitter = Splitter(packet_size, start_offset, max_delay)
         self.splitter.on_new_packet.add_handler(self._packet_created)
         self.splitter.on_stream_end.add_handler(self._input_stream_end)
 
@@ -5,59 +5,246 @@ Piece manager
 import logging
 import itertools
 import random
+import heapq
+
+from pixtream.peer.pieceselection import RarestFirstPolicy
+from pixtream.peer.requestqueue import RequestQueue
+from pixtream.util.logconfig import MESSAGE_LOGGER
 
 __all__ = ['PieceManager']
 
+message_logger = logging.getLogger(MESSAGE_LOGGER)
+
 class PieceManager(object):
 
     # FIXME: use configuration system
-    MAX_REQUESTS = 3
+    WINDOW_PIECES = 512
+    WINDOW_BYTES = None
+    ADVERTISE_PIECES = 256
+
+    def __init__(self, window_pieces=None, window_bytes=None, policy=None,
+                 advertise_pieces=None, first_sequence=0):
+        """
+        Creates a piece manager.
+
+        :param window_pieces: Max number of pieces kept in memory.
+        :param window_bytes: Max number of bytes of pieces kept in memory.
+        :param advertise_pieces: Size of the window of pieces advertised to
+                                 the partners, ending in the newest piece.
+        :param policy: The SelectionPolicy used to choose pieces to request.
+                       Rarest first by default.
+        :param first_sequence: Sequence of the first piece of the stream.
+        """
 
-    def __init__(self):
-        self.last_continuous_piece = 0
+        self.policy = RarestFirstPolicy() if policy is None else policy
+
+        self.window_pieces = (self.WINDOW_PIECES if window_pieces is None
+                              else window_pieces)
+        self.window_bytes = (self.WINDOW_BYTES if window_bytes is None
+                             else window_bytes)
+        self.advertise_pieces = (self.ADVERTISE_PIECES
+                                 if advertise_pieces is None
+                                 else advertise_pieces)
+
+        self.last_continuous_piece = first_sequence
+        self.window_start = first_sequence
         self.own_pieces = {}
         self.pieces_by_partner = {}
         self.partners_by_piece = {}
         self.pieces_requested_to = {}
         self.pieces_requested_from = {}
+        self.choked_by = set()
+
+        self.pieces_evicted = 0
+        self.pieces_served = 0
+        self.requests_expired = 0
+
+        self._own_heap = []
+        self._own_bytes = 0
+        self._requested = {}
+        self._failed_requests = {}
+
+        # Availability index of the missing pieces not yet requested. Buckets
+        # of sequences by number of partners having them, kept as lazy heaps.
+        self._availability = {}
+        self._rarity = {}
+        self._bucket_sizes = {}
+        self._missing_heap = []
 
     @property
     def own_sequences(self):
         return set(self.own_pieces.keys())
 
+    @property
+    def advertised_sequences(self):
+        """The own sequences within the advertise window"""
+
+        if not self.own_pieces:
+            return set()
+
+        base = max(self.own_pieces) - self.advertise_pieces + 1
+        return set(sequence for sequence in self.own_pieces
+                   if sequence >= base)
+
     @property
     def partners_sequences(self):
         return set(self.partners_by_piece.keys())
 
-    def add_new_piece(self, sequence, data):
+    @property
+    def playback_position(self):
+        """The first sequence after the continuous pieces we have"""
+
+        if self.have_piece(self.last_continuous_piece):
+            return self.last_continuous_piece + 1
+        return max(self.last_continuous_piece, self.window_start)
+
+    @property
+    def own_bytes(self):
+        """Number of bytes of the pieces currently stored"""
+        return self._own_bytes
+
+    def add_new_piece(self, sequence, data, partner_id=None):
+        """
+        Adds a piece to the store.
+
+        :param partner_id: The partner that sent the piece, if any. Used to
+                           measure its request queue.
+        """
+
+        if partner_id in self.pieces_requested_to:
+            queue = self.pieces_requested_to[partner_id]
+            queue.response_received(sequence, len(data))
+
+        self._end_request(sequence)
+        self._failed_requests.pop(sequence, None)
+
+        if sequence < self.window_start or sequence in self.own_pieces:
+            return
+
         self.own_pieces[sequence] = data
+        self._own_bytes += len(data)
+        self._update_rarity(sequence)
+        heapq.heappush(self._own_heap, sequence)
+        self.policy.piece_received(sequence)
         self._update_last()
-        logging.info('Last piece: {0}'.format(self.last_continuous_piece))
+        self._evict_pieces()
+        message_logger.debug('Last piece: %s', self.last_continuous_piece)
 
     def have_piece(self, sequence):
         return sequence in self.own_pieces
 
+    def is_missing(self, sequence):
+        """
+        True if we don't have a piece that some partner has and it hasn't
+        been requested yet
+        """
+        return sequence in self._availability
+
+    def wants_piece(self, sequence):
+        """True if we don't have a piece within the window, requested or not"""
+        return (sequence not in self.own_pieces and
+                sequence >= self.window_start)
+
+    def piece_window(self, newest):
+        """
+        Returns the first and last sequence worth tracking when the newest
+        piece of a partner is newest
+        """
+        return max(self.window_start, newest - self.window_pieces + 1), newest
+
+    def skip_to(self, sequence):
+        """Moves the playback point forward skipping missing pieces"""
+
+        if sequence <= self.playback_position:
+            return
+
+        self.last_continuous_piece = sequence
+        self._update_last()
+        self.policy.playback_skipped(sequence)
+        self._evict_pieces()
+
     def partner_got_piece(self, partner_id, sequence):
+        if sequence < self.window_start:
+            return
+
         pieces = self.pieces_by_partner.setdefault(partner_id, set())
+        if sequence in pieces:
+            return
         pieces.add(sequence)
 
         partners = self.partners_by_piece.setdefault(sequence, set())
         partners.add(partner_id)
 
+        if sequence not in self.own_pieces:
+            if len(partners) == 1:
+                heapq.heappush(self._missing_heap, sequence)
+            self._update_rarity(sequence)
+
     def partner_got_pieces(self, partner_id, pieces):
         for piece in pieces:
             self.partner_got_piece(partner_id, piece)
 
+    def remove_partner(self, partner_id):
+        """Forgets every piece and request related to a partner"""
+
+        for sequence in self.pieces_by_partner.pop(partner_id, ()):
+            partners = self.partners_by_piece[sequence]
+            partners.discard(partner_id)
+
+            if not partners:
+                del self.partners_by_piece[sequence]
+
+            self._update_rarity(sequence)
+
+        for sequence in list(self.pieces_requested_to.pop(partner_id, ())):
+            self._end_request(sequence)
+
+        self.pieces_requested_from.pop(partner_id, None)
+        self.choked_by.discard(partner_id)
+
+    def partner_choked(self, partner_id):
+        """
+        Registers that a partner has choked us. Its pending requests won't
+        be served, so they are forgotten and no new ones are sent.
+        """
+
+        self.choked_by.add(partner_id)
+
+        for sequence in list(self.pieces_requested_to.get(partner_id, ())):
+            self._end_request(sequence)
+
+    def partner_unchoked(self, partner_id):
+        """Registers that a partner has unchoked us"""
+        self.choked_by.discard(partner_id)
+
+    def needs_pieces_from(self, partner_id):
+        """
+        True if a partner has some piece we are missing, including the ones
+        already requested
+        """
+
+        return any(self.wants_piece(sequence)
+                   for sequence in self.pieces_by_partner.get(partner_id, ()))
+
     def get_piece_data(self, sequence):
         return self.own_pieces.get(sequence, None)
 
     def mark_piece_as_sent(self, partner_id, sequence):
         self.pieces_requested_from[partner_id].remove(sequence)
+        self.pieces_served += 1
 
     def partner_requested_piece(self, partner_id, sequence):
         pieces = self.pieces_requested_from.setdefault(partner_id, set())
         pieces.add(sequence)
 
+    def clear_partner_requests(self, partner_id):
+        """Forgets every piece requested by a partner"""
+        self.pieces_requested_from.pop(partner_id, None)
+
+    def partner_cancelled_piece(self, partner_id, sequence):
+        pieces = self.pieces_requested_from.get(partner_id, set())
+        pieces.discard(sequence)
+
     def get_pieces_to_send(self):
         return [(partner_id, sequence)
                 for partner_id in self.pieces_requested_from
@@ -65,28 +252,97 @@ class PieceManager(object):
                 if self.have_piece(sequence)]
 
     def mark_piece_as_requested(self, partner_id, sequence):
-        pieces = self.pieces_requested_to.setdefault(partner_id, set())
-        pieces.add(sequence)
+        self._request_queue(partner_id).add(sequence)
+        self._requested[sequence] = partner_id
+        self._update_rarity(sequence)
 
     def can_request_piece(self, partner_id, sequence):
-        pieces = self.pieces_requested_to.setdefault(partner_id, set())
-        return sequence not in pieces
+        return sequence not in self._request_queue(partner_id)
+
+    def is_requested(self, sequence):
+        """True if a piece has been requested to some partner"""
+        return sequence in self._requested
+
+    def requested_partner(self, sequence):
+        """Returns the partner a piece has been requested to, if any"""
+        return self._requested.get(sequence, None)
+
+    def expire_requests(self, now=None):
+        """
+        Forgets the requests that have not been answered in time.
+
+        The pieces can be requested again, preferably to other partners.
+        Returns a list of (partner_id, sequence) of the expired requests.
+        """
+
+        expired = [(partner_id, sequence)
+                   for partner_id, queue in self.pieces_requested_to.items()
+                   for sequence in queue.expired(now)]
+
+        for partner_id, sequence in expired:
+            failed = self._failed_requests.setdefault(sequence, set())
+            failed.add(partner_id)
+            self._end_request(sequence)
+            self.requests_expired += 1
 
-    def get_pieces_to_request(self):
-        """ Implementation of the Rarest First Algorithm """
-        missing_pieces = list(self.partners_sequences - self.own_sequences)
-        missing_pieces.sort(key=lambda p: len(self.partners_by_piece[p]))
+        return expired
 
-        return missing_pieces[:self.MAX_REQUESTS]
+    def request_slots(self, partner_id):
+        """Number of requests that could be sent to a partner right now"""
+
+        if partner_id in self.choked_by:
+            return 0
+        return self._request_queue(partner_id).free_slots
+
+    def free_request_slots(self):
+        """Number of requests that could be sent to all partners"""
+        return sum(self.request_slots(partner_id)
+                   for partner_id in self.pieces_by_partner)
+
+    def get_pieces_to_request(self, limit):
+        """
+        Returns at most limit pieces to request as chosen by the selection
+        policy. Pieces already requested are not returned.
+        """
+        return self.policy.select(self, limit)
+
+    def rarest_pieces(self, limit):
+        """
+        Implementation of the Rarest First Algorithm
+
+        Reads the rarest missing pieces from the availability index, which is
+        kept up to date as pieces are announced, received and forgotten.
+        """
+
+        missing_pieces = []
+
+        for count in sorted(self._bucket_sizes):
+            needed = limit - len(missing_pieces)
+            missing_pieces.extend(self._peek_bucket(count, needed))
+            if len(missing_pieces) == limit:
+                break
+
+        return missing_pieces
 
     def best_partner_for_piece(self, piece):
-        partners = self.partners_by_piece.get(piece, [])
+        """Returns the partner with more free request slots having a piece"""
+
+        partners = [partner_id
+                    for partner_id in self.partners_by_piece.get(piece, [])
+                    if self.request_slots(partner_id) > 0]
+
+        failed = self._failed_requests.get(piece, ())
+        untried = [partner_id for partner_id in partners
+                   if partner_id not in failed]
+
+        if len(untried) > 0:
+            partners = untried
 
         if len(partners) == 0:
             return None
 
-        else:
-            return random.choice(list(partners))
+        random.shuffle(partners)
+        return max(partners, key=self.request_slots)
 
     def _update_last(self):
         for piece in itertools.count(self.last_continuous_piece):
@@ -94,3 +350,141 @@ class PieceManager(object):
                 self.last_continuous_piece = piece
             else:
                 break
+
+    def _window_exceeded(self):
+        if (self.window_pieces is not None and
+            len(self.own_pieces) > self.window_pieces):
+            return True
+
+        if (self.window_bytes is not None and
+            self._own_bytes > self.window_bytes):
+            return True
+
+        return False
+
+    def _partners_want_piece(self, sequence):
+        return any(sequence in pieces
+                   for pieces in self.pieces_requested_from.itervalues())
+
+    def _evict_pieces(self):
+        """
+        Removes the oldest pieces while the window is exceeded.
+
+        Only pieces behind the playback point that no partner has requested
+        are evicted.
+        """
+
+        while self._window_exceeded() and self._own_heap:
+            sequence = self._own_heap[0]
+
+            if sequence >= self.last_continuous_piece:
+                break
+
+            if self._partners_want_piece(sequence):
+                break
+
+            heapq.heappop(self._own_heap)
+            self._forget_piece(sequence)
+
+    def _forget_piece(self, sequence):
+        data = self.own_pieces.pop(sequence)
+        self._own_bytes -= len(data)
+        self.window_start = max(self.window_start, sequence + 1)
+        self.pieces_evicted += 1
+
+        for partner_id in self.partners_by_piece.pop(sequence, ()):
+            self.pieces_by_partner[partner_id].discard(sequence)
+
+        self._prune_missing()
+        message_logger.debug('Evicted piece %s', sequence)
+
+    def _prune_missing(self):
+        """Forgets the missing pieces that are behind the window"""
+
+        while self._missing_heap and self._missing_heap[0] < self.window_start:
+            sequence = heapq.heappop(self._missing_heap)
+            partners = self.partners_by_piece.pop(sequence, None)
+
+            if partners is None:
+                continue
+
+            self._end_request(sequence)
+            self._failed_requests.pop(sequence, None)
+            self._update_rarity(sequence)
+            self.policy.piece_dropped(sequence)
+
+            for partner_id in partners:
+                self.pieces_by_partner[partner_id].discard(sequence)
+
+    def _request_queue(self, partner_id):
+        if partner_id not in self.pieces_requested_to:
+            self.pieces_requested_to[partner_id] = RequestQueue()
+        return self.pieces_requested_to[partner_id]
+
+    def _end_request(self, sequence):
+        """Forgets the outstanding request of a piece, if any"""
+
+        partner_id = self._requested.pop(sequence, None)
+
+        if partner_id is not None:
+            if partner_id in self.pieces_requested_to:
+                self.pieces_requested_to[partner_id].remove(sequence)
+            self._update_rarity(sequence)
+
+    def _update_rarity(self, sequence):
+        """Updates the availability index for a piece"""
+
+        if (sequence in self.own_pieces or sequence in self._requested or
+            sequence < self.window_start):
+            self._set_rarity(sequence, 0)
+        else:
+            partners = self.partners_by_piece.get(sequence, ())
+            self._set_rarity(sequence, len(partners))
+
+    def _set_rarity(self, sequence, count):
+        """Moves a missing piece to the bucket of its number of partners"""
+
+        old_count = self._availability.pop(sequence, 0)
+
+        if old_count > 0:
+            self._bucket_sizes[old_count] -= 1
+            self._compact_bucket(old_count)
+
+        if count > 0:
+            self._availability[sequence] = count
+            self._bucket_sizes[count] = self._bucket_sizes.get(count, 0) + 1
+            heapq.heappush(self._rarity.setdefault(count, []), sequence)
+
+    def _peek_bucket(self, count, limit):
+        """Returns up to limit of the lowest sequences of a bucket"""
+
+        heap = self._rarity[count]
+        sequences = []
+
+        while heap and len(sequences) < limit:
+            sequence = heapq.heappop(heap)
+            if self._availability.get(sequence) != count:
+                continue
+            if sequences and sequences[-1] == sequence:
+                continue
+            sequences.append(sequence)
+
+        for sequence in sequences:
+            heapq.heappush(heap, sequence)
+
+        return sequences
+
+    def _compact_bucket(self, count):
+        """Drops a bucket when empty or rebuilds it when mostly stale"""
+
+        size = self._bucket_sizes[count]
+
+        if size == 0:
+            del self._bucket_sizes[count]
+            del self._rarity[count]
+
+        elif len(self._rarity[count]) > 2 * size + 64:
+            heap = list(set(sequence for sequence in self._rarity[count]
+                            if self._availability.get(sequence) == count))
+            heapq.heapify(heap)
+            self._rarity[count] = heap
@@ -0,0 +1,112 @@
+"""
+Piece selection policies used by the Piece Manager
+"""
+
+import time
+
+__all__ = ['SelectionPolicy', 'RarestFirstPolicy', 'DeadlinePolicy']
+
+class SelectionPolicy(object):
+    """
+    Base class for the piece selection policies.
+
+    A policy decides which missing pieces should be requested next.
+    """
+
+    def __init__(self):
+        self.deadlines_missed = 0
+
+    def select(self, piece_manager, limit):
+        """
+        Returns a list of at most limit sequences to request.
+
+        Subclasses should override this method
+        """
+        return []
+
+    def piece_received(self, sequence):
+        """Called by the piece manager when a new piece is added"""
+
+    def piece_dropped(self, sequence):
+        """Called by the piece manager when a missing piece is forgotten"""
+
+    def playback_skipped(self, sequence):
+        """Called by the piece manager when playback skips to a sequence"""
+
+class RarestFirstPolicy(SelectionPolicy):
+    """
+    Requests the pieces held by the fewest partners first.
+    """
+
+    def select(self, piece_manager, limit):
+        return piece_manager.rarest_pieces(limit)
+
+class DeadlinePolicy(SelectionPolicy):
+    """
+    Mixes urgency with rarity.
+
+    Pieces inside a window after the playback point are requested strictly in
+    order. The remaining requests are filled using rarest first. An urgent
+    piece that takes longer than the deadline to arrive, or that is dropped
+    without arriving, counts as a missed deadline.
+    """
+
+    # FIXME: use configuration system
+    DEADLINE_WINDOW = 8
+    DEADLINE = 10
+
+    def __init__(self, window=None, deadline=None):
+        """
+        Creates the policy.
+
+        :param window: Number of pieces after the playback point to fetch in
+                       order.
+        :param deadline: Seconds an urgent piece has to arrive.
+        """
+
+        super(DeadlinePolicy, self).__init__()
+        self.window = self.DEADLINE_WINDOW if window is None else window
+        self.deadline = self.DEADLINE if deadline is None else deadline
+        self._urgent_since = {}
+
+    def select(self, piece_manager, limit):
+        self._prune(piece_manager)
+
+        start = piece_manager.playback_position
+        urgent = [sequence for sequence in xrange(start, start + self.window)
+                  if piece_manager.is_missing(sequence)][:limit]
+
+        now = time.time()
+        for sequence in urgent:
+            self._urgent_since.setdefault(sequence, now)
+
+        rarest = piece_manager.rarest_pieces(limit)
+        rarest = [sequence for sequence in rarest if sequence not in urgent]
+
+        return urgent + rarest[:limit - len(urgent)]
+
+    def piece_received(self, sequence):
+        since = self._urgent_since.pop(sequence, None)
+        if since is not None and time.time() - since > self.deadline:
+            self.deadlines_missed += 1
+
+    def piece_dropped(self, sequence):
+        if self._urgent_since.pop(sequence, None) is not None:
+            self.deadlines_missed += 1
+
+    def playback_skipped(self, sequence):
+        for skipped in [skipped for skipped in self._urgent_since
+                        if skipped < sequence]:
+            self.piece_dropped(skipped)
+
+    def _prune(self, piece_manager):
+        """
+        Forgets the urgent pieces already owned and counts the ones that left
+        the window without arriving as missed.
+        """
+
+        for sequence in self._urgent_since.keys():
+            if piece_manager.have_piece(sequence):
+                del self._urgent_since[sequence]
+            elif sequence < piece_manager.window_start:
+                self.piece_dropped(sequence)
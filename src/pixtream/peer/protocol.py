@@ -3,23 +3,41 @@ Defines classes for the the Pixtream Protocol
 """
 
 import logging
-import time
+import struct
 
+from twisted.internet import reactor
 from twisted.protocols.basic import Int32StringReceiver
 
 from pixtream.peer.messages import Message, MessageException
+from pixtream.peer.bitfield import pieces_to_ranges, ranges_to_pieces
+from pixtream.peer.connectionstats import ConnectionStats
 from pixtream.peer import specs
+from pixtream.util.logconfig import MESSAGE_LOGGER
 
 __all__ = ['IncomingProtocol', 'OutgoingProtocol']
 
+logger = logging.getLogger(__name__)
+message_logger = logging.getLogger(MESSAGE_LOGGER)
+
+_PREFIX = struct.Struct('!I')
+
 class BaseProtocol(Int32StringReceiver):
     """
     Base class for the protocols of Pixtream
 
     It is based on the Int32StringReceiver class of Twister which handles
-    int 32 prefixed messages.
+    int 32 prefixed messages. The framing is done here: every complete
+    message of a received chunk is split at once and then dispatched as a
+    read-only buffer over the received data, without copying it.
     """
 
+    # FIXME: use configuration system
+    ANNOUNCE_DELAY = 0.05
+    HEARTBEAT_INTERVAL = 10
+    PEER_TIMEOUT = 30
+
+    clock = reactor
+
     def __init__(self):
         self.partner_id = None
         self.outgoing_handshaked = False
@@ -28,7 +46,23 @@ class BaseProtocol(Int32StringReceiver):
         self.interested = False
         self.partner_choked = True
         self.partner_interested = False
-        self.last_heartbeat = time.time()
+        self.partner_extensions = None
+        self.stats = ConnectionStats(self.clock.seconds())
+
+        self.last_received = self.stats.connected_at
+        self.last_sent = self.stats.connected_at
+
+        self._heartbeat_call = None
+        self._timeout_call = None
+
+        self._pending_announcements = set()
+        self._announce_call = None
+
+        self._received = []
+        self._received_bytes = 0
+        self._unaccounted_bytes = 0
+        self._frame_end = self.prefixLength
+        self.max_length = self.MAX_LENGTH
 
         self.handlers = {
             specs.HandshakeMessage: self.receive_handshake,
@@ -39,7 +73,10 @@ class BaseProtocol(Int32StringReceiver):
             specs.HeartBeatMessage: self.receive_heartbeat,
             specs.PieceBitFieldMessage: self.receive_bitfield,
             specs.GotPieceMessage: self.receive_got_piece,
+            specs.HaveRangesMessage: self.receive_have_ranges,
+            specs.StreamInfoMessage: self.receive_stream_info,
             specs.RequestDataPacketMessage: self.receive_request_packet,
+            specs.CancelRequestDataPacketMessage: self.receive_cancel_request,
             specs.DataPacketMessage: self.receive_data_packet,
         }
 
@@ -53,6 +90,20 @@ class BaseProtocol(Int32StringReceiver):
 
         return self.outgoing_handshaked and self.incoming_handshaked
 
+    @property
+    def ranges_enabled(self):
+        """True if the partner understands range lists of pieces"""
+
+        return specs.extension_supported(self.partner_extensions,
+                                         specs.RANGES_EXTENSION)
+
+    @property
+    def stream_info_enabled(self):
+        """True if the partner understands stream info messages"""
+
+        return specs.extension_supported(self.partner_extensions,
+                                         specs.STREAM_INFO_EXTENSION)
+
     @property
     def partner_address(self):
         """Returns the IP address of the partner peer"""
@@ -60,33 +111,96 @@ class BaseProtocol(Int32StringReceiver):
         return str(self.transport.getPeer())
 
     def connectionMade(self):
-        logging.debug('Connection made ' + self.partner_address)
+        logger.debug('Connection made ' + self.partner_address)
+
+        now = self.clock.seconds()
+        self.last_received = now
+        self.last_sent = now
+
+        self._heartbeat_call = self.clock.callLater(self.HEARTBEAT_INTERVAL,
+                                                    self._check_idle)
+        self._timeout_call = self.clock.callLater(self.PEER_TIMEOUT,
+                                                  self._check_timeout)
 
     def connectionLost(self, reason):
         msg = 'Connection lost: ({0}) ({1})'
         msg = msg.format(self.partner_address, str(reason))
-        logging.debug(msg)
+        logger.debug(msg)
+
+        for call in (self._announce_call, self._heartbeat_call,
+                     self._timeout_call):
+            if call is not None and call.active():
+                call.cancel()
+
+        self._announce_call = None
+        self._heartbeat_call = None
+        self._timeout_call = None
 
         if self.handshaked:
             self.factory.remove_connection(self)
+            self.peer_service.partner_disconnected(self.partner_id)
 
-    def stringReceived(self, message):
-        """Overrides method to receive a message without the prefix """
+    def dataReceived(self, data):
+        """Splits the received data in messages and dispatches them"""
+
+        now = self.clock.seconds()
+        self.last_received = now
 
-        logging.debug('Received: {0} from {1}'.format(repr(message[0]),
-                                                      self.partner_address))
+        self._received.append(data)
+        self._received_bytes += len(data)
+        self._unaccounted_bytes += len(data)
 
-        if self.handshaked and self.choked:
-            logging.info('Ignoring message because the peer is choked')
+        # Incomplete messages are only joined and accounted once they have
+        # arrived
+        if self._received_bytes < self._frame_end:
             return
 
+        self.stats.data_received(self._unaccounted_bytes, now)
+        self._unaccounted_bytes = 0
+
+        if len(self._received) == 1:
+            received = data
+        else:
+            received = ''.join(self._received)
+
+        while True:
+            messages, offset, oversized = self._split_messages(received)
+
+            received = received[offset:]
+            self._received = [received] if received else []
+            self._received_bytes = len(received)
+
+            transport = self.transport
+            string_received = self.stringReceived
+            for message in messages:
+                if transport.disconnecting:
+                    return
+                string_received(message)
+
+            if not oversized:
+                return
+
+            # A stream info message may have raised the limit
+            if not messages:
+                self.lengthLimitExceeded(oversized)
+                return
+
+    def stringReceived(self, message):
+        """Overrides method to receive a message without the prefix """
+
+        if message_logger.isEnabledFor(logging.DEBUG):
+            message_logger.debug('Received: %r from %s', message[0],
+                                 self.partner_address)
+
         try:
             message_object = Message.parse(message)
         except MessageException as error:
-            logging.error('Decoding error ' + str(error))
+            logger.error('Decoding error ' + str(error))
             self.drop()
             return
 
+        self.stats.message_received(type(message_object).__name__)
+
         handler = self.handlers.get(type(message_object), self.receive_default)
         handler(message_object)
 
@@ -96,14 +210,17 @@ class BaseProtocol(Int32StringReceiver):
     def receive_choke(self, msg):
         self._check_handshaked()
         self.partner_choked = True
+        self.peer_service.choked_by_partner(self.partner_id)
 
     def receive_unchoke(self, msg):
         self._check_handshaked()
         self.partner_choked = False
+        self.peer_service.unchoked_by_partner(self.partner_id)
 
     def receive_interested(self, msg):
         self._check_handshaked()
         self.partner_interested = True
+        self.peer_service.partner_interested(self.partner_id)
 
     def receive_not_interested(self, msg):
         self._check_handshaked()
@@ -111,39 +228,121 @@ class BaseProtocol(Int32StringReceiver):
 
     def receive_bitfield(self, msg):
         self._check_handshaked()
-        self.peer_service.partner_bitset(self.partner_id, msg.pieces)
+
+        pieces = msg.pieces
+        if pieces:
+            first, last = self.peer_service.piece_window(max(pieces))
+            pieces = set(piece for piece in pieces if piece >= first)
+
+        self.peer_service.partner_bitset(self.partner_id, pieces)
 
     def receive_got_piece(self, msg):
         self._check_handshaked()
         self.peer_service.partner_got_piece(self.partner_id, msg.sequence)
-        logging.debug('Partner {0} got piece {1}'.format(self.partner_id,
-                                                         msg.sequence))
+        message_logger.debug('Partner %s got piece %s', self.partner_id,
+                             msg.sequence)
+
+    def receive_have_ranges(self, msg):
+        self._check_handshaked()
+
+        pieces = set()
+        if msg.ranges:
+            newest = max(last for first, last in msg.ranges)
+            first, last = self.peer_service.piece_window(newest)
+            pieces = ranges_to_pieces(msg.ranges, first, last)
+
+        self.peer_service.partner_bitset(self.partner_id, pieces)
+
+    def receive_stream_info(self, msg):
+        self._check_handshaked()
+        self.peer_service.stream_info_received(self.partner_id,
+                                               msg.packet_size)
 
     def receive_heartbeat(self, msg):
         self._check_handshaked()
-        self.last_heartbeat = time.time()
 
     def receive_request_packet(self, msg):
-        logging.info('Got packet request: {0} from {1}'.format(msg.sequence, self.partner_id))
+        if self.choked:
+            message_logger.info('Ignoring request %s from choked partner %s',
+                                msg.sequence, self.partner_id)
+            return
+
+        message_logger.info('Got packet request: %s from %s', msg.sequence,
+                            self.partner_id)
         self.peer_service.receive_request(self.partner_id, msg.sequence)
 
+    def receive_cancel_request(self, msg):
+        message_logger.info('Got cancel request: %s from %s', msg.sequence,
+                            self.partner_id)
+        self.peer_service.receive_cancel_request(self.partner_id,
+                                                 msg.sequence)
+
     def receive_data_packet(self, msg):
-        logging.info('Received data packet {0}'.format(msg.sequence))
+        message_logger.info('Received data packet %s', msg.sequence)
         self.peer_service.receive_packet(msg, self.partner_id)
 
+    def set_packet_size(self, packet_size):
+        """Allows frames big enough for data packets of packet_size bytes"""
+
+        self.max_length = max(self.MAX_LENGTH,
+                              packet_size + specs.DATA_PACKET_OVERHEAD)
+
+    def _split_messages(self, received):
+        """
+        Returns the complete messages in the received data as buffers, the
+        offset where the pending data starts, and the length of the frame at
+        that offset if it exceeds the max length (0 otherwise).
+        """
+
+        size = len(received)
+        prefix_length = self.prefixLength
+        unpack_prefix = _PREFIX.unpack_from
+        max_length = self.max_length
+        view = buffer
+
+        messages = []
+        offset = 0
+        self._frame_end = prefix_length
+
+        while size - offset >= prefix_length:
+            length, = unpack_prefix(received, offset)
+
+            if length > max_length:
+                return messages, offset, length
+
+            start = offset + prefix_length
+            end = start + length
+            if end > size:
+                self._frame_end = end - offset
+                break
+
+            messages.append(view(received, start, length))
+            offset = end
+
+        return messages, offset, 0
+
     def receive_default(self, msg):
-        logging.error('Received message with no handler ' + str(type(msg)))
+        logger.error('Received message with no handler ' + str(type(msg)))
 
     def send_message(self, message_class, *args, **kwargs):
         """Sends a message object to the partner peer"""
 
         message_object = message_class.create(*args, **kwargs)
-        self.transport.write(message_object.pack_prefixed())
+        parts = message_object.pack_prefixed_parts()
+        self.transport.writeSequence(parts)
+
+        now = self.clock.seconds()
+        self.last_sent = now
+
+        size = sum(len(part) for part in parts)
+        self.stats.data_sent(size, now)
+        self.stats.message_sent(message_class.__name__, size,
+                                message_class is not specs.DataPacketMessage)
 
     def send_hanshake(self):
         """Sends a handshake message"""
 
-        logging.debug('Sending Handshake to ' + self.partner_address)
+        logger.debug('Sending Handshake to ' + self.partner_address)
 
         self.send_message(specs.HandshakeMessage, self.peer_service.peer_id)
         self.outgoing_handshaked = True
@@ -165,21 +364,91 @@ class BaseProtocol(Int32StringReceiver):
 
     def send_not_interested(self):
         self.send_message(specs.NotInterestedMessage)
-        self.choked = False
+        self.interested = False
 
     def send_bitfield(self):
+        """
+        Sends the available pieces.
+
+        If the partner supports it and it is shorter, they are sent as a
+        list of ranges instead of a bit field.
+        """
+
         pieces = self.peer_service.pieces
+
+        if self.ranges_enabled and pieces:
+            ranges = pieces_to_ranges(pieces)
+            bitfield_size = (max(pieces) - min(pieces)) // 8 + 1
+            if 8 * len(ranges) <= bitfield_size:
+                self.send_message(specs.HaveRangesMessage, ranges)
+                return
+
         self.send_message(specs.PieceBitFieldMessage, pieces)
 
+    def send_stream_info(self):
+        """Sends the stream metadata if it is known"""
+
+        packet_size = self.peer_service.packet_size
+        if self.stream_info_enabled and packet_size is not None:
+            self.send_message(specs.StreamInfoMessage, packet_size)
+
+    def send_have_ranges(self, pieces):
+        """Announces new pieces, as ranges if the partner supports it"""
+
+        if not self.ranges_enabled:
+            for sequence in sorted(pieces):
+                self.send_got_piece(sequence)
+            return
+
+        self.send_message(specs.HaveRangesMessage, pieces_to_ranges(pieces))
+
     def send_got_piece(self, sequence):
         self.send_message(specs.GotPieceMessage, sequence)
 
+    def announce_piece(self, sequence):
+        """
+        Announces a new piece to the partner.
+
+        Announcements are coalesced during ANNOUNCE_DELAY seconds and sent
+        together in a single message.
+        """
+
+        if self.ANNOUNCE_DELAY <= 0:
+            self.send_got_piece(sequence)
+            return
+
+        self._pending_announcements.add(sequence)
+
+        if self._announce_call is None:
+            self._announce_call = self.clock.callLater(self.ANNOUNCE_DELAY,
+                                                       self.flush_announcements)
+
+    def flush_announcements(self):
+        """Sends the pending piece announcements"""
+
+        if self._announce_call is not None:
+            if self._announce_call.active():
+                self._announce_call.cancel()
+            self._announce_call = None
+
+        pieces = self._pending_announcements
+        self._pending_announcements = set()
+
+        if len(pieces) == 1:
+            self.send_got_piece(pieces.pop())
+        elif pieces:
+            self.send_have_ranges(pieces)
+
     def send_request_packet(self, sequence):
-        logging.info('Requesting {0} to {1}'.format(sequence, self.partner_id))
+        message_logger.info('Requesting %s to %s', sequence, self.partner_id)
         self.send_message(specs.RequestDataPacketMessage, sequence)
 
+    def send_cancel_request(self, sequence):
+        message_logger.info('Canceling %s to %s', sequence, self.partner_id)
+        self.send_message(specs.CancelRequestDataPacketMessage, sequence)
+
     def send_data_packet(self, sequence, data):
-        logging.info('Sending data packet {0}'.format(sequence))
+        message_logger.info('Sending data packet %s', sequence)
         self.send_message(specs.DataPacketMessage, sequence, data)
 
     def drop(self):
@@ -190,23 +459,51 @@ class BaseProtocol(Int32StringReceiver):
         """Checks if a received handshake message object is valid"""
 
         if self.incoming_handshaked:
-            logging.error('Double handshake from id ' + self.partner_id)
+            logger.error('Double handshake from id ' + self.partner_id)
             return False
 
         if not msg.is_valid():
-            logging.error('Wrong handshake. Closing connection')
+            logger.error('Wrong handshake. Closing connection')
             self.drop()
             return False
 
         if not self.factory.connection_allowed(msg.peer_id):
-            logging.error('Connection not allowed with ' + msg.peer_id)
+            logger.error('Connection not allowed with ' + msg.peer_id)
             self.drop()
             return False
         return True
 
+    def _check_idle(self):
+        """Sends a heartbeat if nothing has been sent for a while"""
+
+        idle = self.clock.seconds() - self.last_sent
+
+        if idle >= self.HEARTBEAT_INTERVAL:
+            if self.handshaked:
+                self.send_heartbeat()
+            delay = self.HEARTBEAT_INTERVAL
+        else:
+            delay = self.HEARTBEAT_INTERVAL - idle
+
+        self._heartbeat_call = self.clock.callLater(delay, self._check_idle)
+
+    def _check_timeout(self):
+        """Drops the connection if nothing has been received in time"""
+
+        silence = self.clock.seconds() - self.last_received
+
+        if silence >= self.PEER_TIMEOUT:
+            logger.info('Peer Connection Timeout %s', self.partner_id)
+            self._timeout_call = None
+            self.drop()
+            return
+
+        self._timeout_call = self.clock.callLater(self.PEER_TIMEOUT - silence,
+                                                  self._check_timeout)
+
     def _check_handshaked(self):
         if not self.handshaked:
-            logging.error('Received a message before handshake')
+            logger.error('Received a message before handshake')
             self.drop()
 
 class IncomingProtocol(BaseProtocol):
@@ -217,19 +514,21 @@ class IncomingProtocol(BaseProtocol):
     def receive_handshake(self, msg):
         """Handler for a handshake message"""
 
-        logging.debug('Handshake received from ' + self.partner_address)
+        logger.debug('Handshake received from ' + self.partner_address)
 
         if not self._check_incoming_handshake(msg):
             return
 
-        logging.debug('Good handshake ' + msg.peer_id)
+        logger.debug('Good handshake ' + msg.peer_id)
 
         self.partner_id = msg.peer_id
+        self.partner_extensions = msg.extensions
         self.send_hanshake()
         self.factory.add_connection(self)
 
         self.incoming_handshaked = True
-        self.send_unchoke()
+        self.peer_service.partner_connected(self.partner_id)
+        self.send_stream_info()
         self.send_bitfield()
 
 class OutgoingProtocol(BaseProtocol):
@@ -244,31 +543,33 @@ class OutgoingProtocol(BaseProtocol):
 
     def connectionLost(self, reason):
         BaseProtocol.connectionLost(self, reason)
-        self.factory.end_connection_attempt(self.factory.target_id)
+        self.factory.outgoing_connection_lost(self.factory.target_id)
 
     def receive_handshake(self, msg):
         """Handler for a received handshake message object"""
 
-        logging.debug('Handshake received from ' + self.partner_address)
+        logger.debug('Handshake received from ' + self.partner_address)
 
         if not self._check_incoming_handshake(msg):
             return
 
         if not self.outgoing_handshaked:
-            logging.error('Unrequested handshake from ' + self.partner_address)
+            logger.error('Unrequested handshake from ' + self.partner_address)
             self.drop()
             return
 
         if msg.peer_id != self.factory.target_id:
-            logging.error('Handshake received from unexpected peer')
+            logger.error('Handshake received from unexpected peer')
             self.drop()
             return
 
-        logging.debug('Good handshake ' + msg.peer_id)
+        logger.debug('Good handshake ' + msg.peer_id)
 
         self.partner_id = msg.peer_id
+        self.partner_extensions = msg.extensions
         self.factory.add_connection(self)
 
         self.incoming_handshaked = True
-        self.send_unchoke()
+        self.peer_service.partner_connected(self.partner_id)
+        self.send_stream_info()
         self.send_bitfield()
@@ -0,0 +1,147 @@
+"""
+Bounded buffer of the most recent stream data
+"""
+
+from collections import deque
+
+__all__ = ['ReplayBuffer', 'ReplayBufferError']
+
+class ReplayBufferError(Exception):
+    pass
+
+class ReplayBuffer(object):
+    """
+    Keeps the last bytes of a stream so they can be replayed to new clients.
+
+    Offsets are absolute positions in the stream. The buffer starts at
+    offset 0 unless it is moved with seek. If a sync pattern is given
+    (for example 'OggS' for Ogg pages), the offsets where it appears are
+    recorded as safe starting points for new clients.
+    """
+
+    # FIXME: use configuration system
+    MAX_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, max_bytes=None, sync_pattern=None):
+        """
+        Creates the buffer.
+
+        :param max_bytes: Number of bytes to keep.
+        :param sync_pattern: Byte string marking safe starting points.
+        """
+
+        self.max_bytes = self.MAX_BYTES if max_bytes is None else max_bytes
+        self.sync_pattern = sync_pattern
+
+        self.start_offset = 0
+        self.end_offset = 0
+
+        self._chunks = deque()
+        self._sync_points = deque()
+        self._tail = ''
+
+    def append(self, data):
+        """Adds data at the end of the stream"""
+
+        if len(data) == 0:
+            return
+
+        self._find_sync_points(data)
+        self._chunks.append(data)
+        self.end_offset += len(data)
+
+        while self.end_offset - self.start_offset > self.max_bytes:
+            self.start_offset += len(self._chunks.popleft())
+
+        while self._sync_points and self._sync_points[0] < self.start_offset:
+            self._sync_points.popleft()
+
+    def seek(self, offset):
+        """
+        Moves the end of the stream to an absolute offset. The buffered data
+        is dropped if the stream doesn't continue from it.
+        """
+
+        if offset == self.end_offset:
+            return
+
+        self._chunks.clear()
+        self._sync_points.clear()
+        self._tail = ''
+        self.start_offset = self.end_offset = offset
+
+    @property
+    def default_offset(self):
+        """The most recent safe offset to start a new client"""
+
+        if self._sync_points:
+            return self._sync_points[-1]
+        return self.start_offset
+
+    def absolute_offset(self, offset=None):
+        """
+        Returns the absolute offset where a client asking for an offset
+        starts. The default offset is used for None and negative offsets
+        are relative to the end of the stream.
+
+        Raises ReplayBufferError if the offset is not in the buffer.
+        """
+
+        if offset is None:
+            return self.default_offset
+
+        if offset < 0:
+            offset = self.end_offset + offset
+
+        if not self.start_offset <= offset <= self.end_offset:
+            raise ReplayBufferError('Offset %d not in the buffer (%d-%d)' %
+                                    (offset, self.start_offset,
+                                     self.end_offset))
+
+        return offset
+
+    def read_from(self, offset=None):
+        """
+        Returns a list of chunks with the data from an offset to the end.
+
+        Raises ReplayBufferError if the offset is not in the buffer.
+        """
+
+        offset = self.absolute_offset(offset)
+
+        chunks = []
+        position = self.start_offset
+
+        for chunk in self._chunks:
+            end = position + len(chunk)
+            if end > offset:
+                chunks.append(chunk if position >= offset
+                              else chunk[offset - position:])
+            position = end
+
+        return chunks
+
+    def _find_sync_points(self, data):
+        pattern = self.sync_pattern
+        if not pattern:
+            return
+
+        # Patterns starting in the tail of the previous data
+        boundary = self._tail + data[:len(pattern) - 1]
+        index = boundary.find(pattern)
+        while index != -1 and index < len(self._tail):
+            self._sync_points.append(self.end_offset - len(self._tail) + index)
+            index = boundary.find(pattern, index + 1)
+
+        index = data.find(pattern)
+        while index != -1:
+            self._sync_points.append(self.end_offset + index)
+            index = data.find(pattern, index + 1)
+
+        keep = len(pattern) - 1
+        if keep == 0:
+            self._tail = ''
+        elif len(data) >= keep:
+            self._tail = data[-keep:]
+        else:
+            self._tail = (self._tail + data)[-keep:]
@@ -0,0 +1,120 @@
+"""
+Queue of outstanding piece requests to a partner
+"""
+
+import math
+import time
+
+__all__ = ['RequestQueue']
+
+class RequestQueue(object):
+    """
+    Keeps the outstanding requests sent to a single partner.
+
+    The depth of the queue adapts to the measured throughput and round trip
+    time of the partner, so that enough requests are in flight to keep the
+    link busy (the bandwidth-delay product) without flooding it.
+    """
+
+    # FIXME: use configuration system
+    MIN_DEPTH = 2
+    MAX_DEPTH = 32
+    SMOOTHING = 0.125
+    MIN_TIMEOUT = 5
+    TIMEOUT_FACTOR = 4
+
+    def __init__(self):
+        self.requests = {}
+        self.rtt = None
+        self.min_rtt = None
+        self.throughput = None
+        self.piece_size = None
+
+        self._last_response = None
+
+    def __contains__(self, sequence):
+        return sequence in self.requests
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __iter__(self):
+        return iter(self.requests)
+
+    @property
+    def depth(self):
+        """Number of requests that should be in flight"""
+
+        if self.throughput is None or not self.piece_size:
+            return self.MIN_DEPTH
+
+        in_flight = self.throughput * self.min_rtt / self.piece_size
+        depth = int(math.ceil(in_flight)) + 1
+
+        return max(self.MIN_DEPTH, min(self.MAX_DEPTH, depth))
+
+    @property
+    def timeout(self):
+        """Seconds after which an outstanding request is considered lost"""
+
+        if self.rtt is None:
+            return self.MIN_TIMEOUT
+        return max(self.MIN_TIMEOUT, self.TIMEOUT_FACTOR * self.rtt)
+
+    @property
+    def free_slots(self):
+        """Number of requests that could be sent right now"""
+        return max(0, self.depth - len(self.requests))
+
+    def add(self, sequence, now=None):
+        """Registers a request sent to the partner"""
+
+        now = time.time() if now is None else now
+        if not self.requests:
+            self._last_response = None
+        self.requests[sequence] = now
+
+    def remove(self, sequence):
+        """Forgets a request without measuring it"""
+        self.requests.pop(sequence, None)
+
+    def expired(self, now=None):
+        """Returns the sequences of the requests older than the timeout"""
+
+        now = time.time() if now is None else now
+        timeout = self.timeout
+        return [sequence for sequence, sent in self.requests.iteritems()
+                if now - sent > timeout]
+
+    def response_received(self, sequence, size, now=None):
+        """
+        Registers the arrival of a requested piece.
+
+        Updates the RTT and throughput estimations. Returns False if the
+        piece was not requested.
+        """
+
+        now = time.time() if now is None else now
+        sent = self.requests.pop(sequence, None)
+
+        if sent is None:
+            return False
+
+        rtt = max(now - sent, 1e-6)
+        self.rtt = self._average(self.rtt, rtt)
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.piece_size = self._average(self.piece_size, size)
+
+        if self._last_response is None:
+            interval = rtt
+        else:
+            interval = max(now - self._last_response, 1e-6)
+        self.throughput = self._average(self.throughput, size / interval)
+
+        self._last_response = now
+        return True
+
+    def _average(self, current, sample):
+        if current is None:
+            return float(sample)
+        return current + self.SMOOTHING * (sample - current)
@@ -3,11 +3,16 @@ Utilities for creating Pixtream Peer scripts
 """
 
 from optparse import OptionParser
-import logging
-import sys
+
+from pixtream.peer.pieceselection import RarestFirstPolicy, DeadlinePolicy
+from pixtream.peer.specs import MAX_PACKET_SIZE
+from pixtream.util.logconfig import add_logging_options, setup_logging
 
 __all__ = ['parse_options', 'parse_source_options', 'setup_logger']
 
+SELECTION_POLICIES = {'rarest': RarestFirstPolicy,
+                      'deadline': DeadlinePolicy}
+
 
 def _creat_basic_options(parser):
     parser.add_option('-i', '--ip', dest='ip',
@@ -23,6 +28,67 @@ def _creat_basic_options(parser):
                       help='Listening Port for the streaming output',
                       metavar='PORT')
 
+    parser.add_option('--selection-policy', dest='selection_policy',
+                      type='choice', default='rarest',
+                      choices=sorted(SELECTION_POLICIES),
+                      help='Piece selection policy: rarest or deadline '
+                           '[default: %default]', metavar='POLICY')
+
+    parser.add_option('--max-upload-rate', dest='max_upload_rate',
+                      type='int', default=None,
+                      help='Max upload rate. Unlimited by default',
+                      metavar='BYTES/S')
+
+    parser.add_option('--replay-bytes', dest='replay_bytes',
+                      type='int', default=None,
+                      help='Bytes of recent stream kept for new streaming '
+                           'clients', metavar='BYTES')
+
+    parser.add_option('--sync-pattern', dest='sync_pattern',
+                      type='string', default=None,
+                      help='Bytes marking where new streaming clients can '
+                           'start, with Python string escapes. For example '
+                           'OggS for Ogg streams', metavar='PATTERN')
+
+    add_logging_options(parser)
+
+def _service_options(parser, options):
+    """Returns the keyword arguments of the peer service"""
+
+    if options.max_upload_rate is not None and options.max_upload_rate <= 0:
+        parser.error('Invalid max upload rate')
+
+    policy = SELECTION_POLICIES[options.selection_policy]()
+
+    return {'selection_policy': policy,
+            'max_upload_rate': options.max_upload_rate}
+
+def _server_options(parser, options):
+    """Returns the keyword arguments of the stream server"""
+
+    if options.replay_bytes is not None and options.replay_bytes <= 0:
+        parser.error('Invalid replay bytes')
+
+    sync_pattern = options.sync_pattern
+    if sync_pattern is not None:
+        try:
+            sync_pattern = sync_pattern.decode('string_escape')
+        except ValueError:
+            parser.error('Invalid sync pattern')
+
+        if not sync_pattern:
+            parser.error('Empty sync pattern')
+
+    return {'replay_bytes': options.replay_bytes,
+            'sync_pattern': sync_pattern}
+
+def _setup_logger_from_options(parser, options):
+    try:
+        setup_logger(options.log_level, options.log_subsystems,
+                     options.message_log)
+    except ValueError as error:
+        parser.error(str(error))
+
 def parse_options():
     parser = OptionParser()
     parser.usage = "usage: %prog [options] tracker_url"
@@ -36,7 +102,12 @@ def parse_options():
     if len(args) != 1:
         parser.error('Too much arguments')
 
-    return options.ip, options.port, options.streaming_port, args[0]
+    service_options = _service_options(parser, options)
+    server_options = _server_options(parser, options)
+    _setup_logger_from_options(parser, options)
+
+    return (options.ip, options.port, options.streaming_port, args[0],
+            service_options, server_options)
 
 def parse_source_options():
     parser = OptionParser()
@@ -49,6 +120,26 @@ def parse_source_options():
 
     _creat_basic_options(parser)
 
+    parser.add_option('-o', '--offset', dest='offset',
+                      type='int', default=None,
+                      help='Offset in the input of the first byte read. '
+                           'Sources publishing the same stream must use '
+                           'offsets of the same input', metavar='BYTES')
+
+    parser.add_option('--packet-size', dest='packet_size',
+                      type='int', default=None,
+                      help='Size of the packets of the stream, up to %d'
+                           % MAX_PACKET_SIZE,
+                      metavar='BYTES')
+
+    parser.add_option('--max-delay', dest='max_delay',
+                      type='float', default=None,
+                      help='Max seconds to wait for a packet to be filled. '
+                           'Partial packets are sent after it. Only for '
+                           'streams with a single source, not valid with '
+                           '--offset',
+                      metavar='SECONDS')
+
     options, args = parser.parse_args()
 
     if len(args) == 0:
@@ -62,14 +153,38 @@ def parse_source_options():
     if source_type not in ('http', 'file', 'tcp'):
         parser.error('Invalid source type')
 
-    return (options.ip, options.port, options.streaming_port,
-            tracker_url, source_type, source)
+    if options.offset is not None and options.offset < 0:
+        parser.error('Invalid offset')
 
-def setup_logger():
-    # TODO: use configuration option for file logging
-    format = '[%(asctime)s][%(process)d][%(levelname)s][%(module)s][%(lineno)d] %(message)s'
-    logging.basicConfig(level = logging.DEBUG,
-                        format = format,
-                        stream = sys.stdout)
+    if options.packet_size is not None and options.packet_size <= 0:
+        parser.error('Invalid packet size')
 
+    if (options.packet_size is not None and
+            options.packet_size > MAX_PACKET_SIZE):
+        parser.error('Packet size must be at most %d' % MAX_PACKET_SIZE)
 
+    if options.max_delay is not None and options.max_delay <= 0:
+        parser.error('Invalid max delay')
+
+    if options.max_delay is not None and options.offset is not None:
+        parser.error('--max-delay and --offset are incompatible: partial '
+                     'packets break the numbering shared between sources')
+
+    service_options = _service_options(parser, options)
+    server_options = _server_options(parser, options)
+    _setup_logger_from_options(parser, options)
+
+    return (options.ip, options.port, options.streaming_port,
+            tracker_url, source_type, source, options.offset or 0,
+            options.packet_size, options.max_delay, service_options,
+            server_options)
+
+def setup_logger(level='INFO', subsystems=(), message_log=True):
+    """
+    Configures logging. The parse functions call it with the command line
+    options.
+    """
+
+    # TODO: use configuration option for file logging
+    format = '[%(asctime)s][%(process)d][%(levelname)s][%(name)s][%(lineno)d] %(message)s'
+    setup_logging(format, level, subsystems, message_log)
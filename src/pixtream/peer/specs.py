@@ -2,22 +2,40 @@
 Message specs of the Pixtream protocol
 """
 
+import struct
+
 from pixtream.peer.messages import FixedLengthMessage, VariableLengthMessage
 from pixtream.peer.messages import Message, Field, Payload
+from pixtream.peer.bitfield import encode_bitfield, decode_bitfield
+from pixtream.peer.bitfield import ranges_to_pieces
 
 __all__ = ['CancelRequestDataPacketMessage',
            'ChokeMessage',
            'DataPacketMessage',
            'GotPieceMessage',
            'HandshakeMessage',
+           'HaveRangesMessage',
            'HeartBeatMessage',
            'InterestedMessage',
            'NotInterestedMessage',
            'PieceBitFieldMessage',
            'RequestDataPacketMessage',
            'RequestPieceBitFieldMessage',
+           'StreamInfoMessage',
            'UnChokeMessage']
 
+# Positions of the flags in the extensions field of the handshake
+RANGES_EXTENSION = 0
+STREAM_INFO_EXTENSION = 1
+
+SUPPORTED_EXTENSIONS = (RANGES_EXTENSION, STREAM_INFO_EXTENSION)
+
+# Max size of the data of a packet
+MAX_PACKET_SIZE = 16 * 1024 * 1024
+
+def extension_supported(extensions, extension):
+    """True if the flag of an extension is set in an extensions field"""
+    return extensions is not None and extensions[extension] == '1'
 
 @Message.register
 class HandshakeMessage(FixedLengthMessage):
@@ -32,7 +50,7 @@ class HandshakeMessage(FixedLengthMessage):
              """'Pixtream Protocol' string"""),
 
         Field('8s', 'extensions',
-              """Reserved for future extensions"""),
+              """A '0' or '1' flag for every supported extension"""),
 
         Field('20s', 'peer_id',
               """Unique ID of the peer"""),
@@ -43,12 +61,13 @@ class HandshakeMessage(FixedLengthMessage):
         yield len(self.peer_id) == 20
 
     @classmethod
-    def create(cls, peer_id):
+    def create(cls, peer_id, extensions=SUPPORTED_EXTENSIONS):
         assert len(peer_id) == 20
         msg = cls()
         msg.peer_id = peer_id
         msg.protocol_id = 'Pixtream Protocol'
-        msg.extensions = '00000000'
+        msg.extensions = ''.join('1' if flag in extensions else '0'
+                                 for flag in range(8))
         return msg
 
 
@@ -84,6 +103,9 @@ class DataPacketMessage(VariableLengthMessage):
     def pack_payload(self):
         return self.data
 
+# Bytes of a data packet message besides the data
+DATA_PACKET_OVERHEAD = DataPacketMessage._message_struct.size
+
 @Message.register
 class RequestDataPacketMessage(FixedLengthMessage):
     """
@@ -124,6 +146,14 @@ class CancelRequestDataPacketMessage(FixedLengthMessage):
     def valid_conditions(self):
         yield self.sequence >= 0
 
+    @classmethod
+    def create(cls, sequence):
+        assert sequence >= 0
+
+        msg = cls()
+        msg.sequence = sequence
+        return msg
+
 @Message.register
 class HeartBeatMessage(FixedLengthMessage):
     """
@@ -240,30 +270,84 @@ class PieceBitFieldMessage(VariableLengthMessage):
 
     @staticmethod
     def _encode_bitfield(pieces):
-        if len(pieces) == 0:
-            return 0, 0, ''
-
-        first = min(pieces)
-        last = max(pieces)
-
-        byte = ''
-        bitfield = ''
-        for piece in range(first, last+1):
-            bit = '1' if piece in pieces else '0'
-            byte += bit
-            if len(byte) == 8:
-                bitfield += chr(int(byte, 2))
-                byte = ''
-        if len(byte) > 0:
-            byte += (8 - len(byte))*'0'
-            bitfield += chr(int(byte, 2))
-
-        return first, last, bitfield
+        return encode_bitfield(pieces)
 
     @staticmethod
     def _decode_bitfield(first, bitfield):
-        bitstr = ''.join(format(ord(char), '0>8b') for char in bitfield)
-        return set(first + i for i, bit in enumerate(bitstr) if bit == '1')
+        return decode_bitfield(first, bitfield)
+
+@Message.register
+class HaveRangesMessage(VariableLengthMessage):
+    """
+    Message containing ranges of available pieces of a peer
+
+    Replaces bit fields and bursts of got piece messages when the ranges
+    extension has been negotiated.
+    """
+
+    message_header = 'A'
+
+    fields = [
+        Field('I', 'count',
+              """Number of ranges in the payload""")
+    ]
+
+    payload = Payload("""First and last sequence of every range""")
+
+    def valid_conditions(self):
+        yield self.count == len(self.ranges)
+        for first, last in self.ranges:
+            yield 0 <= first <= last
+
+    @classmethod
+    def create(cls, ranges):
+        msg = cls()
+        msg.count = len(ranges)
+        msg.ranges = list(ranges)
+        return msg
+
+    @property
+    def pieces(self):
+        return ranges_to_pieces(self.ranges)
+
+    def unpack_payload(self, payload):
+        # The count comes from the partner, check it before using it
+        if len(payload) != 8 * self.count:
+            raise struct.error('Payload size does not match range count')
+
+        values = struct.unpack('>{0}I'.format(2 * self.count), payload)
+        self.ranges = zip(values[::2], values[1::2])
+
+    def pack_payload(self):
+        values = [value for pair in self.ranges for value in pair]
+        return struct.pack('>{0}I'.format(len(values)), *values)
+
+@Message.register
+class StreamInfoMessage(FixedLengthMessage):
+    """
+    Message containing the metadata of the stream
+
+    Sent after the handshake when the stream info extension has been
+    negotiated and the packet size of the stream is known.
+    """
+
+    message_header = 'S'
+
+    fields = [
+        Field('I', 'packet_size',
+              """Max size of the data of a packet""")
+    ]
+
+    @classmethod
+    def create(cls, packet_size):
+        assert 0 < packet_size <= MAX_PACKET_SIZE
+
+        msg = cls()
+        msg.packet_size = packet_size
+        return msg
+
+    def valid_conditions(self):
+        yield 0 < self.packet_size <= MAX_PACKET_SIZE
 
 @Message.register
 class RequestPieceBitFieldMessage(FixedLengthMessage):
@@ -4,38 +4,148 @@ Splits streaming data into Pixtream protocol packages
 
 from collections import deque
 
+from twisted.internet import reactor
+
 from pixtream.util.event import Event
 from pixtream.peer.specs import DataPacketMessage
 
 __all__ = ['Splitter']
 
-# TODO: Use fixed length buffer
 class Splitter(object):
+    """
+    Cuts a stream into packets of a fixed size.
+
+    Incoming data is never concatenated. Packets completely contained in the
+    received data are sliced directly from it and only the remainders are
+    copied into a fixed length buffer of the size of a packet.
+
+    Sequence numbers are derived from the absolute offset of the data in the
+    input stream, so several splitters reading the same input produce the
+    same packets even if they joined it at different offsets. The data
+    before the first packet boundary is discarded.
+
+    With a max delay, data waiting in the buffer longer than the delay is
+    sent as a partial packet. Packets are then no longer aligned to offsets,
+    so splitters with a max delay can't be combined with other sources.
+    """
+
+    clock = reactor
+
+    def __init__(self, packet_size, start_offset=0, max_delay=None):
+        """
+        Creates the splitter.
+
+        :param packet_size: Size of the packets.
+        :param start_offset: Offset in the input stream of the first byte
+                             pushed to the splitter.
+        :param max_delay: Seconds the data can wait for a packet to be
+                          filled. Unlimited if None. Can't be used with a
+                          start offset.
+        """
+
+        if max_delay is not None and start_offset != 0:
+            raise ValueError('Partial packets break the offset numbering')
 
-    def __init__(self, packet_size):
         self.packet_size = packet_size
+        self.max_delay = max_delay
         self.on_new_packet = Event()
         self.on_stream_end = Event()
 
-        self._buffer = bytes()
+        self.stream_offset = start_offset
+        self.flushes = 0
+
+        self._buffer = bytearray(packet_size)
+        self._buffer_length = 0
         self._packets = deque()
-        self._current_sequence = 0
+        self._current_sequence = self.sequence_at(start_offset)
+        self._skip = 0
+        self._flush_call = None
+
+        if start_offset % packet_size != 0:
+            self._current_sequence += 1
+            self._skip = packet_size - start_offset % packet_size
+
+    @property
+    def current_sequence(self):
+        """Sequence of the next packet"""
+        return self._current_sequence
+
+    def sequence_at(self, offset):
+        """Returns the sequence of the packet containing an input offset"""
+        return offset // self.packet_size
 
     def push_stream(self, data):
-        self._buffer = self._buffer + data
+        self.stream_offset += len(data)
+        view = memoryview(data)
+        position = 0
+
+        if self._skip > 0:
+            position = min(self._skip, len(data))
+            self._skip -= position
 
-        while len(self._buffer) >= self.packet_size:
-            packet_data = self._buffer[:self.packet_size]
-            self._buffer = self._buffer[self.packet_size:]
-            self._create_packet(packet_data)
+        if self._buffer_length > 0:
+            position += self._fill_buffer(view[position:])
+
+        while len(data) - position >= self.packet_size:
+            end = position + self.packet_size
+            self._create_packet(data[position:end])
+            position = end
+
+        if position < len(data):
+            self._fill_buffer(view[position:])
 
     def end_stream(self):
-        self._create_packet(self._buffer)
+        self._cancel_flush()
+        self._create_packet(bytes(self._buffer[:self._buffer_length]))
+        self._buffer_length = 0
         self.on_stream_end.call(self)
 
     def pop_packet(self):
         return self._packets.popleft()
 
+    def flush(self):
+        """Sends the data in the buffer as a partial packet"""
+
+        self._cancel_flush()
+
+        if self._buffer_length == 0:
+            return
+
+        data = bytes(self._buffer[:self._buffer_length])
+        self._buffer_length = 0
+        self.flushes += 1
+        self._create_packet(data)
+
+    def _fill_buffer(self, view):
+        """
+        Copies data into the buffer until it's full. Returns the number of
+        bytes used.
+        """
+
+        start = self._buffer_length
+        length = min(len(view), self.packet_size - start)
+        self._buffer[start:start + length] = view[:length]
+        self._buffer_length += length
+
+        if self._buffer_length == self.packet_size:
+            self._cancel_flush()
+            self._buffer_length = 0
+            self._create_packet(bytes(self._buffer))
+        elif start == 0 and length > 0 and self.max_delay is not None:
+            self._flush_call = self.clock.callLater(self.max_delay,
+                                                    self._delayed_flush)
+
+        return length
+
+    def _delayed_flush(self):
+        self._flush_call = None
+        self.flush()
+
+    def _cancel_flush(self):
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+
     def _create_packet(self, packet_data):
         packet = DataPacketMessage.create(self._current_sequence, packet_data)
         self._packets.append(packet)
@@ -2,65 +2,156 @@
 Takes a joined streaming data and serves it in an outgoing port
 """
 
+import logging
+import time
+
+from twisted.web2 import responsecode
 from twisted.web2.resource import Resource
 from twisted.web2.stream import ProducerStream
-from twisted.web2.http import Response
+from twisted.web2.http import Response, StatusResponse
 from twisted.web2.channel import HTTPFactory
 from twisted.web2.server import Site
 from twisted.internet.protocol import Protocol, ServerFactory
 from twisted.internet import reactor
 
+from pixtream.peer.clientqueue import ClientQueue
+from pixtream.peer.replaybuffer import ReplayBuffer, ReplayBufferError
+
 __all__ = ['TCPStreamServer', 'HTTPStreamServer', 'FileStreamServer']
 
+logger = logging.getLogger(__name__)
+
 class StreamServer(object):
-    def __init__(self):
-        # TODO: use a spooled file instead!!
-        self._current_stream = bytes()
+    """
+    Base class for stream servers.
+
+    Every client has a ClientQueue with the bytes it can't take yet. A
+    client whose queue stays over max_client_queue bytes for more than
+    LAG_TIMEOUT seconds is dropped, or fast-forwarded to the live stream
+    discarding its queue if lag_policy is SKIP.
+    """
+
+    DROP, SKIP = ClientQueue.DROP, ClientQueue.SKIP
+
+    # FIXME: use configuration system
+    MAX_CLIENT_QUEUE = 1024 * 1024
+    LAG_TIMEOUT = 10
+
+    def __init__(self, replay_bytes=None, sync_pattern=None,
+                 max_client_queue=None, lag_policy=DROP):
+        """
+        :param replay_bytes: Bytes of recent stream kept for new clients.
+        :param sync_pattern: Byte string marking where new clients can start.
+        :param max_client_queue: Bytes a client can have queued.
+        :param lag_policy: DROP or SKIP lagging clients.
+        """
+        self._replay_buffer = ReplayBuffer(replay_bytes, sync_pattern)
+        self.max_client_queue = (self.MAX_CLIENT_QUEUE
+                                 if max_client_queue is None
+                                 else max_client_queue)
+        self.lag_policy = lag_policy
+        self._clients = []
+
+    @property
+    def clients(self):
+        """List of the ClientQueue of the connected clients"""
+        return self._clients
+
+    def client_lag(self):
+        """Returns a dict with the bytes queued for every client"""
+        return dict((client.client_address, client.queued_bytes)
+                    for client in self.clients)
 
     def send_stream(self, data):
         pass
 
+    def seek(self, offset):
+        """Sets the absolute stream offset of the next data sent"""
+        self._replay_buffer.seek(offset)
+
     def start(self):
         pass
 
     def stop(self):
-        pass
+        for client in list(self._clients):
+            client.drop()
+
+    def _send_to_clients(self, data):
+        now = time.time()
+
+        for client in list(self._clients):
+            client.send_stream(data)
+            self._check_lag(client, now)
+
+        self._replay_buffer.append(data)
+
+    def _check_lag(self, client, now):
+        queued_bytes = client.queued_bytes
+        if client.check_lag(self.max_client_queue, self.LAG_TIMEOUT,
+                            self.lag_policy, now):
+            logger.warning('Stream client %s lagging %s bytes',
+                           client.client_address, queued_bytes)
+
+    def _add_client(self, client, offset=None):
+        """
+        Sends the replay buffer to a new client and starts streaming.
+        Returns the absolute offset where the client starts.
+
+        Raises ReplayBufferError if the offset is not in the replay buffer.
+        """
+
+        offset = self._replay_buffer.absolute_offset(offset)
+        for chunk in self._replay_buffer.read_from(offset):
+            client.send_stream(chunk)
+        self._clients.append(client)
+        return offset
+
+    def _remove_client(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
 
 class TCPStreamServer(StreamServer):
 
     class TCPStreamServerProtocol(Protocol):
+        """
+        Stream client writing to the transport through a ClientQueue
+        """
 
-        def connectionMade(self):
-            self.factory.connection_made(self)
-
-        def send_stream(self, stream):
-            self.transport.write(stream)
+        def __init__(self):
+            self.client = None
 
-    def __init__(self, port):
-        super(TCPStreamServer, self).__init__()
+        def connectionMade(self):
+            self.client = ClientQueue(self.transport,
+                                      str(self.transport.getPeer()),
+                                      self._client_dropped)
+            self.transport.registerProducer(self.client, True)
+            self.factory.connection_made(self.client)
+
+        def connectionLost(self, reason):
+            self.client.stopProducing()
+            self.factory.connection_lost(self.client)
+
+        def _client_dropped(self, client):
+            self.factory.connection_lost(client)
+            self.transport.loseConnection()
+
+    def __init__(self, port, replay_bytes=None, sync_pattern=None,
+                 max_client_queue=None, lag_policy=StreamServer.DROP):
+        super(TCPStreamServer, self).__init__(replay_bytes, sync_pattern,
+                                              max_client_queue, lag_policy)
         self._port = port
-        self._connections = []
 
     def send_stream(self, data):
-        for connection in self._connections:
-            connection.send_stream(data)
-        self._current_stream += data
+        self._send_to_clients(data)
 
     def start(self):
         reactor.listenTCP(self._port, self._create_factory())
 
-    def stop(self):
-        for connection in self._connections:
-            connection.loseConnection()
-
-    def _connection_made(self, connection):
-        connection.send_stream(self._current_stream)
-        self._connections.append(connection)
-
     def _create_factory(self):
         factory = ServerFactory()
         factory.protocol = self.TCPStreamServerProtocol
-        factory.connection_made = self._connection_made
+        factory.connection_made = self._add_client
+        factory.connection_lost = self._remove_client
         return factory
 
 class HTTPStreamServer(StreamServer):
@@ -72,33 +163,77 @@ class HTTPStreamServer(StreamServer):
             self.server = server
 
         def render(self, request):
-            producer = ProducerStream()
-            self.server._append_producer(producer)
-            producer.write(self.server._current_stream)
-
-            return Response(stream=producer)
-
-    def __init__(self, port):
-        super(HTTPStreamServer, self).__init__()
+            """
+            Streams from the offset given in the 'offset' argument or from
+            the default offset of the replay buffer. The absolute offset
+            where the stream starts is sent in the X-Stream-Offset header.
+            Offsets not in the replay buffer are not satisfiable.
+            """
+
+            offset = None
+            if 'offset' in request.args:
+                try:
+                    offset = int(request.args['offset'][0])
+                except ValueError:
+                    pass
+
+            stream = HTTPStreamServer.ClientStream()
+            stream.client = ClientQueue(stream, str(request.remoteAddr),
+                                        self.server._client_dropped)
+            try:
+                offset = self.server._add_client(stream.client, offset)
+            except ReplayBufferError as error:
+                return StatusResponse(
+                    responsecode.REQUESTED_RANGE_NOT_SATISFIABLE, str(error))
+
+            response = Response(stream=stream)
+            response.headers.setRawHeaders('X-Stream-Offset', [str(offset)])
+            return response
+
+    class ClientStream(ProducerStream):
+        """
+        Producer stream read by the HTTP channel. The client queue is paused
+        while the channel has unread data.
+        """
+
+        def __init__(self):
+            ProducerStream.__init__(self)
+            self.client = None
+
+        def write(self, data):
+            if self.closed or self.failed:
+                return
+
+            ProducerStream.write(self, data)
+            if self.buffer:
+                self.client.pauseProducing()
+
+        def read(self):
+            data = ProducerStream.read(self)
+            if not self.buffer and not self.closed:
+                self.client.resumeProducing()
+            return data
+
+        def close(self):
+            ProducerStream.close(self)
+            self.client.drop()
+
+    def __init__(self, port, replay_bytes=None, sync_pattern=None,
+                 max_client_queue=None, lag_policy=StreamServer.DROP):
+        super(HTTPStreamServer, self).__init__(replay_bytes, sync_pattern,
+                                               max_client_queue, lag_policy)
         self._port = port
-        self._producers = []
 
     def send_stream(self, data):
-        for producer in self._producers:
-            producer.write(data)
-        self._current_stream += data
+        self._send_to_clients(data)
 
     def start(self):
         site = Site(self.StreamingResource(self))
         reactor.listenTCP(self._port, HTTPFactory(site))
 
-    def stop(self):
-        for producer in self._producers:
-            producer.finish()
-        self._producers = []
-
-    def _append_producer(self, producer):
-        self._producers.append(producer)
+    def _client_dropped(self, client):
+        self._remove_client(client)
+        client.consumer.finish()
 
 class FileStreamServer(StreamServer):
 
@@ -116,4 +251,3 @@ class FileStreamServer(StreamServer):
 
     def stop(self):
         self._file.close()
-
@@ -17,6 +17,8 @@ from pixtream.peer.peerdatabase import Peer
 
 __all__ = ['TrackerManager', 'TrackerManagerError', 'TrackerStatus']
 
+logger = logging.getLogger(__name__)
+
 class TrackerManagerError(Exception):
     """
     Errors produced by the TrackerManager.
@@ -65,7 +67,7 @@ class TrackerManager(object):
     def announce(self):
         """Starts connection with the tracker."""
 
-        logging.debug('Announcing to tracker')
+        logger.debug('Announcing to tracker')
         deferred = client.getPage(self._create_announce_url())
         deferred.addCallback(self._on_announce_response)
         deferred.addErrback(self._on_tracker_error)
@@ -100,13 +102,13 @@ class TrackerManager(object):
         return urlparse.urlunsplit(parts)
 
     def _on_tracker_error(self, error):
-        logging.error('Unable to contact the tracker: ' + str(error.value))
+        logger.error('Unable to contact the tracker: ' + str(error.value))
         self._change_status(TrackerStatus.ERROR,
                             'Unable to contact the tracker')
 
     def _on_announce_response(self, content):
         try:
-            logging.debug('Received tracker announce response')
+            logger.debug('Received tracker announce response')
             response = json.loads(content)
 
             if 'failure_reason' in response:
@@ -125,11 +127,11 @@ class TrackerManager(object):
             self._on_announce_failure(str(e))
 
     def _on_announce_failure(self, error):
-        logging.error('Tracker announce failure: ' + error)
+        logger.error('Tracker announce failure: ' + error)
         self._change_status(TrackerStatus.ERROR, error)
 
     def _on_utility_response(self, content):
-        logging.debug('Received tracker utility response')
+        logger.debug('Received tracker utility response')
         response = json.loads(content)
 
         if 'failure_reason' in response:
@@ -137,7 +139,7 @@ class TrackerManager(object):
             return
 
     def _on_utility_failure(self, error):
-        logging.error('Tracker utility failure: ' + error)
+        logger.error('Tracker utility failure: ' + error)
         self._change_status(TrackerStatus.ERROR, error)
 
     def _update_peers(self, peer_list):
@@ -0,0 +1,193 @@
+"""
+Schedules the upload of the pieces requested by the partners
+"""
+
+import logging
+from collections import deque, OrderedDict
+
+from twisted.internet import reactor
+
+from pixtream.util.logconfig import MESSAGE_LOGGER
+
+__all__ = ['UploadScheduler']
+
+message_logger = logging.getLogger(MESSAGE_LOGGER)
+
+class UploadScheduler(object):
+    """
+    Sends requested pieces as soon as they are requested and available.
+
+    Every partner has a queue of pieces ready to be sent. Partners are served
+    round-robin, one piece at a time, so a partner with many requests can't
+    starve the others. The upload rate can be limited with a token bucket.
+    """
+
+    # FIXME: use configuration system
+    MAX_RATE = None
+
+    clock = reactor
+
+    def __init__(self, piece_manager, send_piece, max_rate=None):
+        """
+        Creates the scheduler.
+
+        :param piece_manager: The PieceManager with the requests and data.
+        :param send_piece: Function called with partner_id, sequence and data
+                           to send a piece. Returns False if it couldn't be
+                           sent.
+        :param max_rate: Max upload rate in bytes per second. Unlimited if
+                         None.
+        """
+
+        self.piece_manager = piece_manager
+        self.send_piece = send_piece
+        self.max_rate = self.MAX_RATE if max_rate is None else max_rate
+
+        self.bytes_sent = 0
+        self.pieces_sent = 0
+        self.peak_queue_depth = {}
+
+        self._queues = {}
+        self._ready = deque()
+        self._allowance = 0
+        self._last_refill = None
+        self._call = None
+
+    def queue_depth(self, partner_id):
+        """Number of pieces ready to be sent to a partner"""
+        return len(self._queues.get(partner_id, ()))
+
+    def queue_depths(self):
+        """Returns the upload queue depth of every partner"""
+        return dict((partner_id, len(queue))
+                    for partner_id, queue in self._queues.iteritems())
+
+    def piece_requested(self, partner_id, sequence):
+        """Called when a partner requests a piece"""
+
+        if self.piece_manager.have_piece(sequence):
+            self._enqueue(partner_id, sequence)
+            self.run()
+
+    def piece_available(self, sequence):
+        """Called when a new piece is added to the piece manager"""
+
+        requests = self.piece_manager.pieces_requested_from
+        for partner_id, pieces in requests.iteritems():
+            if sequence in pieces:
+                self._enqueue(partner_id, sequence)
+        self.run()
+
+    def piece_cancelled(self, partner_id, sequence):
+        """Called when a partner cancels a request"""
+
+        queue = self._queues.get(partner_id)
+        if queue is not None:
+            queue.pop(sequence, None)
+
+    def partner_removed(self, partner_id):
+        """Forgets the queue of a partner"""
+
+        self._queues.pop(partner_id, None)
+        self.peak_queue_depth.pop(partner_id, None)
+        self._ready = deque(ready for ready in self._ready
+                            if ready != partner_id)
+
+    def schedule(self, requests):
+        """Queues a list of (partner_id, sequence) and sends them"""
+
+        for partner_id, sequence in requests:
+            self._enqueue(partner_id, sequence)
+        self.run()
+
+    def run(self):
+        """Sends ready pieces round-robin while the rate allows it"""
+
+        if self._call is not None:
+            return
+
+        while self._ready:
+            if not self._refill():
+                return
+
+            partner_id = self._ready.popleft()
+            queue = self._queues.get(partner_id)
+            if not queue:
+                continue
+
+            sequence, _ = queue.popitem(last=False)
+            if queue:
+                self._ready.append(partner_id)
+
+            self._send(partner_id, sequence)
+
+    def stop(self):
+        """Cancels a delayed run"""
+
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _send(self, partner_id, sequence):
+        requested = self.piece_manager.pieces_requested_from.get(partner_id)
+        if requested is None or sequence not in requested:
+            return
+
+        data = self.piece_manager.get_piece_data(sequence)
+        if data is None:
+            message_logger.debug('Dont have piece %s', sequence)
+            return
+
+        if not self.send_piece(partner_id, sequence, data):
+            return
+
+        self.piece_manager.mark_piece_as_sent(partner_id, sequence)
+        self.bytes_sent += len(data)
+        self.pieces_sent += 1
+        self._allowance -= len(data)
+
+    def _enqueue(self, partner_id, sequence):
+        queue = self._queues.get(partner_id)
+        if queue is None:
+            queue = self._queues[partner_id] = OrderedDict()
+
+        if sequence in queue:
+            return
+
+        if not queue:
+            self._ready.append(partner_id)
+        queue[sequence] = None
+
+        depth = len(queue)
+        if depth > self.peak_queue_depth.get(partner_id, 0):
+            self.peak_queue_depth[partner_id] = depth
+
+    def _refill(self):
+        """
+        Refills the token bucket. Returns False and delays the run if the
+        rate has been exceeded.
+        """
+
+        if self.max_rate is None:
+            return True
+
+        now = self.clock.seconds()
+        if self._last_refill is not None:
+            elapsed = now - self._last_refill
+            self._allowance = min(self.max_rate,
+                                  self._allowance + elapsed * self.max_rate)
+        else:
+            self._allowance = self.max_rate
+        self._last_refill = now
+
+        if self._allowance > 0:
+            return True
+
+        # Waits until at least one byte is allowed
+        delay = (1 - self._allowance) / float(self.max_rate)
+        self._call = self.clock.callLater(delay, self._delayed_run)
+        return False
+
+    def _delayed_run(self):
+        self._call = None
+        self.run()
@@ -4,6 +4,10 @@ Utility Manager. Manages utility factor for every peer
 
 import logging
 
+from pixtream.util.logconfig import MESSAGE_LOGGER
+
+message_logger = logging.getLogger(MESSAGE_LOGGER)
+
 class UtilityManager(object):
 
     def __init__(self):
@@ -12,4 +16,5 @@ class UtilityManager(object):
     def add_peer_utility(self, peer_id, utility):
         self.utility_by_peer.setdefault(peer_id, 0)
         self.utility_by_peer[peer_id] += utility
-        logging.info('Utility Factors {0}'.format(self.utility_by_peer))
+        message_logger.debug('Utility factor of %s: %s', peer_id,
+                             self.utility_by_peer[peer_id])
@@ -5,13 +5,12 @@ use run() to launch the program
 """
 
 from optparse import OptionParser
-import logging
-import sys
 
 from twisted.web import server
 from twisted.internet import reactor
 
 from pixtream.tracker.resource import RootResource
+from pixtream.util.logconfig import add_logging_options, setup_logging
 
 def _parse_options():
     parser = OptionParser()
@@ -25,17 +24,24 @@ def _parse_options():
                       help='Interval in seconds for peers to make requests',
                       metavar='INTERVAL')
 
-    return parser.parse_args()
+    add_logging_options(parser)
 
-def _setup_logger():
-    format = '%(asctime)s:%(levelname)s:%(module)s:%(lineno)d: %(message)s'
-    logging.basicConfig(level = logging.DEBUG,
-                        format = format,
-                        stream = sys.stdout)
+    options, args = parser.parse_args()
+
+    try:
+        _setup_logger(options)
+    except ValueError as error:
+        parser.error(str(error))
+
+    return options, args
+
+def _setup_logger(options):
+    format = '%(asctime)s:%(levelname)s:%(name)s:%(lineno)d: %(message)s'
+    setup_logging(format, options.log_level, options.log_subsystems,
+                  options.message_log)
 
 def run():
     """Runs the tracker application"""
-    _setup_logger()
     options, _ = _parse_options()
 
     site = server.Site(RootResource(options.interval))
@@ -0,0 +1,63 @@
+"""
+Logging configuration of the Pixtream scripts
+
+Every module logs to a logger named after it, so the level of each subsystem
+(for example pixtream.peer.protocol) can be set on its own. Logs of every
+message and packet go to the MESSAGE_LOGGER, which can be turned off on busy
+peers.
+"""
+
+import logging
+import sys
+
+__all__ = ['MESSAGE_LOGGER', 'add_logging_options', 'setup_logging']
+
+MESSAGE_LOGGER = 'pixtream.messages'
+
+def add_logging_options(parser):
+    """Adds the logging options to an OptionParser"""
+
+    parser.add_option('-l', '--log-level', dest='log_level',
+                      type='string', default='INFO',
+                      help='Default log level', metavar='LEVEL')
+
+    parser.add_option('--log', dest='log_subsystems',
+                      action='append', default=[],
+                      help='Log level of a subsystem, for example '
+                           'peer.protocol=DEBUG. Can be repeated',
+                      metavar='SUBSYSTEM=LEVEL')
+
+    parser.add_option('--no-message-log', dest='message_log',
+                      action='store_false', default=True,
+                      help='Disable the logs of every message and packet')
+
+def setup_logging(format, level='INFO', subsystems=(), message_log=True):
+    """
+    Configures the root logger and the level of every subsystem.
+
+    :param format: Format of the log records.
+    :param level: Name of the default log level.
+    :param subsystems: List of 'subsystem=LEVEL' strings. Subsystems are
+                       logger names relative to pixtream.
+    :param message_log: If False, the logs of every message are disabled.
+
+    Raises ValueError with unknown levels.
+    """
+
+    logging.basicConfig(level=_parse_level(level),
+                        format=format,
+                        stream=sys.stdout)
+
+    for subsystem in subsystems:
+        name, _, subsystem_level = subsystem.partition('=')
+        logger = logging.getLogger('pixtream.' + name.strip())
+        logger.setLevel(_parse_level(subsystem_level))
+
+    if not message_log:
+        logging.getLogger(MESSAGE_LOGGER).setLevel(logging.CRITICAL + 1)
+
+def _parse_level(name):
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError('Unknown log level: ' + repr(name))
+    return level
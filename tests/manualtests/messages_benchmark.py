@@ -0,0 +1,97 @@
+"""
+Micro benchmark of the message codec
+
+Measures pack and parse for every message in specs.py, next to the legacy
+generic implementation based on getattr/setattr loops.
+"""
+
+import os
+import sys
+
+current_path = os.path.abspath(__file__)
+current_path = os.path.dirname(current_path)
+pixtream_path = os.path.join(current_path, '../../src')
+
+sys.path.append(pixtream_path)
+
+import timeit
+
+from pixtream.peer import specs
+from pixtream.peer.messages import Message, VariableLengthMessage
+
+NUMBER = 20000
+
+SAMPLES = {
+    specs.HandshakeMessage: lambda: specs.HandshakeMessage.create('P' * 20),
+    specs.DataPacketMessage: lambda: specs.DataPacketMessage.create(
+                                                           1, 'x' * 64000),
+    specs.RequestDataPacketMessage:
+                          lambda: specs.RequestDataPacketMessage.create(1),
+    specs.CancelRequestDataPacketMessage:
+                    lambda: specs.CancelRequestDataPacketMessage.create(1),
+    specs.GotPieceMessage: lambda: specs.GotPieceMessage.create(1),
+    specs.PieceBitFieldMessage: lambda: specs.PieceBitFieldMessage.create(
+                                                          set(range(100))),
+    specs.HaveRangesMessage: lambda: specs.HaveRangesMessage.create(
+                                       [(0, 99), (150, 199), (300, 300)]),
+    specs.StreamInfoMessage: lambda: specs.StreamInfoMessage.create(64000),
+}
+
+def message_classes():
+    """The message classes defined in specs.py, sorted by name"""
+
+    classes = []
+    for name in sorted(specs.__all__):
+        value = getattr(specs, name)
+        if isinstance(value, type) and issubclass(value, Message):
+            classes.append(value)
+    return classes
+
+def legacy_is_valid(message):
+    try:
+        return (message.message_header == message.__class__.message_header
+                and all(message.valid_conditions()))
+    except:
+        return False
+
+def legacy_pack(message):
+    assert legacy_is_valid(message)
+    values = [getattr(message, name) for name in message.field_names]
+    data = message._message_struct.pack(*values)
+    if isinstance(message, VariableLengthMessage):
+        data += message.pack_payload()
+    return data
+
+def legacy_parse(data):
+    message = Message._header_map[data[0]]()
+    size = message._message_struct.size
+    fields = message._message_struct.unpack(data[:size])
+    for i, name in enumerate(message.field_names):
+        setattr(message, name, fields[i])
+    if isinstance(message, VariableLengthMessage):
+        message.unpack_payload(data[size:])
+    return message
+
+def measure(function):
+    seconds = min(timeit.repeat(function, number=NUMBER, repeat=3))
+    return seconds / NUMBER * 10**6
+
+def main():
+    print '{0:<32} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+        'message (us/op)', 'pack', 'old pack', 'parse', 'old parse')
+
+    for message_class in message_classes():
+        name = message_class.__name__
+        sample = SAMPLES.get(message_class, message_class.create)
+        message = sample()
+        data = message.pack()
+
+        print '{0:<32} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>10.2f}'.format(
+            name,
+            measure(message.pack),
+            measure(lambda: legacy_pack(message)),
+            measure(lambda: Message.parse(data)),
+            measure(lambda: legacy_parse(data)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark of the piece selection of the PieceManager
+
+Measures the cost of a logic tick (get_pieces_to_request) while the history
+of the stream grows. The legacy full recomputation is measured as reference.
+"""
+
+import os
+import sys
+
+current_path = os.path.abspath(__file__)
+current_path = os.path.dirname(current_path)
+pixtream_path = os.path.join(current_path, '../../src')
+
+sys.path.append(pixtream_path)
+
+import timeit
+
+from pixtream.peer.piecemanager import PieceManager
+
+PARTNERS = ['partner{0}'.format(i) for i in range(4)]
+HISTORY_SIZES = [10**3, 10**4, 10**5, 10**6]
+MISSING = 50
+REQUESTS = 3
+TICKS = 20
+
+def legacy_pieces_to_request(manager):
+    missing_pieces = list(manager.partners_sequences - manager.own_sequences)
+    missing_pieces.sort(key=lambda p: len(manager.partners_by_piece[p]))
+    return missing_pieces[:REQUESTS]
+
+def create_manager(history):
+    manager = PieceManager(window_pieces=history)
+
+    for sequence in xrange(history):
+        for partner_id in PARTNERS[:sequence % len(PARTNERS) + 1]:
+            manager.partner_got_piece(partner_id, sequence)
+
+    for sequence in xrange(history - MISSING):
+        manager.add_new_piece(sequence, '')
+
+    return manager
+
+def measure(function):
+    return min(timeit.repeat(function, number=TICKS, repeat=3)) / TICKS
+
+def main():
+    print '{0:>10} {1:>15} {2:>15}'.format('history', 'index (ms)',
+                                            'legacy (ms)')
+    for history in HISTORY_SIZES:
+        manager = create_manager(history)
+        index = measure(lambda: manager.get_pieces_to_request(REQUESTS))
+        legacy = measure(lambda: legacy_pieces_to_request(manager))
+        print '{0:>10} {1:>15.4f} {2:>15.4f}'.format(history, index * 1000,
+                                                      legacy * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of the message receive path of a single connection
+
+Measures the messages per second parsed and dispatched by BaseProtocol, using
+its batched framing and the framing of Int32StringReceiver. Both keep the
+same traffic statistics. Data arrives in chunks of CHUNK_SIZE bytes, like
+reads from a socket.
+"""
+
+import os
+import sys
+
+current_path = os.path.abspath(__file__)
+current_path = os.path.dirname(current_path)
+pixtream_path = os.path.join(current_path, '../../src')
+
+sys.path.append(pixtream_path)
+
+import logging
+import time
+
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.test.proto_helpers import StringTransport
+
+from pixtream.peer import specs
+from pixtream.peer.protocol import BaseProtocol
+
+CHUNK_SIZE = 4096
+MESSAGES = 20000
+REPEAT = 5
+
+class NullPeerService(object):
+    """Peer service ignoring everything"""
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+class NullFactory(object):
+    peer_service = NullPeerService()
+
+class LegacyProtocol(BaseProtocol):
+    """BaseProtocol with the framing of Int32StringReceiver"""
+
+    def dataReceived(self, data):
+        now = self.clock.seconds()
+        self.last_received = now
+        self.stats.data_received(len(data), now)
+        Int32StringReceiver.dataReceived(self, data)
+
+def create_connection(protocol_class):
+    connection = protocol_class()
+    connection.factory = NullFactory()
+    connection.makeConnection(StringTransport())
+    connection.partner_id = 'partner'
+    connection.outgoing_handshaked = True
+    connection.incoming_handshaked = True
+    connection.choked = False
+    return connection
+
+def create_stream(message_count, data_size):
+    if data_size:
+        message = specs.DataPacketMessage.create(1, 'x' * data_size)
+    else:
+        message = specs.GotPieceMessage.create(1)
+    data = message.pack_prefixed() * message_count
+    return [data[i:i + CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE)]
+
+def messages_per_second(protocol_class, chunks, message_count):
+    best = None
+    for _ in xrange(REPEAT):
+        connection = create_connection(protocol_class)
+        start = time.time()
+        for chunk in chunks:
+            connection.dataReceived(chunk)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return message_count / best
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    cases = [('got piece', MESSAGES, 0),
+             ('data 1KB', MESSAGES, 1000),
+             ('data 64KB', MESSAGES // 20, 64000)]
+
+    print '{0:<12} {1:>16} {2:>16}'.format('messages', 'batched msg/s',
+                                            'legacy msg/s')
+    for name, count, size in cases:
+        chunks = create_stream(count, size)
+        batched = messages_per_second(BaseProtocol, chunks, count)
+        legacy = messages_per_second(LegacyProtocol, chunks, count)
+        print '{0:<12} {1:>16.0f} {2:>16.0f}'.format(name, batched, legacy)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark of the data packet send path
+
+Counts the bytes copied and the time spent to send a cached piece to many
+partners, using the scatter-gather path (pack_prefixed_parts and
+writeSequence) and the legacy path (pack_prefixed and write).
+"""
+
+import os
+import sys
+
+current_path = os.path.abspath(__file__)
+current_path = os.path.dirname(current_path)
+pixtream_path = os.path.join(current_path, '../../src')
+
+sys.path.append(pixtream_path)
+
+import timeit
+
+from pixtream.peer.specs import DataPacketMessage
+
+PIECE_SIZE = 64000
+PARTNERS = 50
+
+class CountingTransport(object):
+    """Transport counting the bytes that are not the cached piece"""
+
+    def __init__(self, piece):
+        self.piece = piece
+        self.copied = 0
+
+    def write(self, data):
+        if data is not self.piece:
+            self.copied += len(data)
+
+    def writeSequence(self, parts):
+        for part in parts:
+            self.write(part)
+
+def send_legacy(transport, sequence, piece):
+    message = DataPacketMessage.create(sequence, piece)
+    packed = message.pack()
+    transport.copied += len(packed)
+    prefixed = message._prefix_struct.pack(len(packed)) + packed
+    transport.write(prefixed)
+
+def send_parts(transport, sequence, piece):
+    message = DataPacketMessage.create(sequence, piece)
+    transport.writeSequence(message.pack_prefixed_parts())
+
+def fan_out(send, transport, piece):
+    for _ in xrange(PARTNERS):
+        send(transport, 1, piece)
+
+def main():
+    piece = 'x' * PIECE_SIZE
+
+    print '{0:<10} {1:>22} {2:>22}'.format('path', 'bytes copied / piece',
+                                            'ms / fan-out')
+    for name, send in [('parts', send_parts), ('legacy', send_legacy)]:
+        transport = CountingTransport(piece)
+        fan_out(send, transport, piece)
+        copied = transport.copied / PARTNERS
+
+        seconds = min(timeit.repeat(lambda: fan_out(send, transport, piece),
+                                    number=100, repeat=3)) / 100
+
+        print '{0:<10} {1:>22} {2:>22.4f}'.format(name, copied,
+                                                   seconds * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of the Splitter throughput
+
+Compares the fixed buffer Splitter against the legacy implementation that
+concatenated and sliced the whole buffer on every packet.
+"""
+
+import os
+import sys
+
+current_path = os.path.abspath(__file__)
+current_path = os.path.dirname(current_path)
+pixtream_path = os.path.join(current_path, '../../src')
+
+sys.path.append(pixtream_path)
+
+import timeit
+
+from pixtream.peer.splitter import Splitter
+from pixtream.peer.specs import DataPacketMessage
+
+PACKET_SIZE = 64000
+READ_SIZES = [1000, 64000, 1000000, 10000000]
+TOTAL = 20000000
+
+class LegacySplitter(object):
+
+    def __init__(self, packet_size):
+        self.packet_size = packet_size
+        self._buffer = bytes()
+        self._current_sequence = 0
+
+    def push_stream(self, data):
+        self._buffer = self._buffer + data
+
+        while len(self._buffer) >= self.packet_size:
+            packet_data = self._buffer[:self.packet_size]
+            self._buffer = self._buffer[self.packet_size:]
+            DataPacketMessage.create(self._current_sequence, packet_data)
+            self._current_sequence += 1
+
+def feed(splitter_class, read_size):
+    splitter = splitter_class(PACKET_SIZE)
+    if hasattr(splitter, 'on_new_packet'):
+        splitter.on_new_packet.add_handler(lambda sender: sender.pop_packet())
+
+    chunk = 'x' * read_size
+    for _ in xrange(TOTAL // read_size):
+        splitter.push_stream(chunk)
+
+def measure(splitter_class, read_size):
+    seconds = min(timeit.repeat(lambda: feed(splitter_class, read_size),
+                                number=1, repeat=3))
+    return TOTAL / seconds / 2**20
+
+def main():
+    print '{0:>10} {1:>15} {2:>15}'.format('read size', 'new (MB/s)',
+                                            'legacy (MB/s)')
+    for read_size in READ_SIZES:
+        print '{0:>10} {1:>15.1f} {2:>15.1f}'.format(
+            read_size,
+            measure(Splitter, read_size),
+            measure(LegacySplitter, read_size))
+
+if __name__ == '__main__':
+    main()
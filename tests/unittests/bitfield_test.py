@@ -0,0 +1,69 @@
+import unittest
+import random
+
+from pixtream.peer import bitfield
+from pixtream.peer.bitfield import encode_bitfield, decode_bitfield
+from pixtream.peer.bitfield import pieces_to_ranges, ranges_to_pieces
+
+class BitFieldTest(unittest.TestCase):
+
+    def check_backend(self, use_numpy):
+        samples = [set([0]),
+                   set([1, 10, 100, 1000]),
+                   set(range(5, 21)),
+                   set(range(3, 1000)) - set([7, 500]),
+                   set(random.sample(xrange(100000), 300))]
+
+        for pieces in samples:
+            first, last, code = encode_bitfield(pieces, use_numpy)
+
+            self.assertEqual(first, min(pieces))
+            self.assertEqual(last, max(pieces))
+            self.assertEqual(len(code), (last - first + 8) // 8)
+            self.assertEqual(decode_bitfield(first, code, use_numpy), pieces)
+
+    def test_python(self):
+        self.check_backend(False)
+
+    def test_numpy(self):
+        if bitfield.numpy is None:
+            return
+        self.check_backend(True)
+
+    def test_backends_match(self):
+        if bitfield.numpy is None:
+            return
+        pieces = set(range(0, 5000, 3))
+        self.assertEqual(encode_bitfield(pieces, False),
+                         encode_bitfield(pieces, True))
+
+    def test_empty(self):
+        self.assertEqual(encode_bitfield(set()), (0, 0, ''))
+        self.assertEqual(decode_bitfield(0, ''), set())
+
+    def test_format(self):
+        self.assertEqual(encode_bitfield(set([0, 9]), False),
+                         (0, 9, '\x80\x40'))
+
+class RangesTest(unittest.TestCase):
+
+    def test_ranges(self):
+        pieces = set(range(10, 20)) | set([25]) | set(range(30, 33))
+        ranges = pieces_to_ranges(pieces)
+
+        self.assertEqual(ranges, [(10, 19), (25, 25), (30, 32)])
+        self.assertEqual(ranges_to_pieces(ranges), pieces)
+
+    def test_clamped_ranges(self):
+        ranges = [(0, 5), (8, 2 ** 32 - 1)]
+
+        self.assertEqual(ranges_to_pieces(ranges, 4, 10),
+                         set([4, 5, 8, 9, 10]))
+        self.assertEqual(ranges_to_pieces(ranges, 6, 7), set())
+
+    def test_empty(self):
+        self.assertEqual(pieces_to_ranges(set()), [])
+        self.assertEqual(ranges_to_pieces([]), set())
+
+if __name__ == '__main__':
+    unittest.main()
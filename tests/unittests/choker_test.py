@@ -0,0 +1,75 @@
+import unittest
+
+from pixtream.peer.choker import Choker
+
+class ChokerTest(unittest.TestCase):
+
+    def test_admit(self):
+        choker = Choker(slots=1)
+
+        self.assert_(choker.admit('a'))
+        self.assert_(choker.admit('b'))
+        self.failIf(choker.admit('c'))
+
+    def test_top_contributors(self):
+        choker = Choker(slots=2)
+        partners = ['a', 'b', 'c', 'd', 'e']
+        utility = {'a': 100, 'b': 500, 'c': 300}
+
+        to_choke, to_unchoke = choker.run(partners, utility)
+
+        self.assertEqual(to_choke, set())
+        self.assertEqual(len(to_unchoke), 3)
+        self.assert_(set(['b', 'c']) <= to_unchoke)
+        self.assert_(choker.optimistic in ('a', 'd', 'e'))
+
+    def test_recent_contribution(self):
+        choker = Choker(slots=1, optimistic_rounds=100)
+        partners = ['a', 'b']
+
+        choker.run(partners, {'a': 1000, 'b': 0})
+        self.assert_('a' in choker.unchoked)
+        self.assertEqual(choker.optimistic, 'b')
+
+        choker.run(partners, {'a': 1000, 'b': 10})
+        self.assertEqual(choker.contributions, {'a': 0, 'b': 10})
+        self.assertEqual(choker.unchoked, set(['a', 'b']))
+
+    def test_choke(self):
+        choker = Choker(slots=1)
+        choker.admit('a')
+        choker.admit('b')
+
+        to_choke, to_unchoke = choker.run('abc', {'a': 10, 'c': 20})
+
+        self.assertEqual(len(to_choke), 1)
+        self.assertEqual(to_unchoke, set(['c']))
+        self.assertEqual(choker.chokes, 1)
+        self.assertEqual(len(choker.unchoked), 2)
+
+    def test_optimistic_rotation(self):
+        choker = Choker(slots=1, optimistic_rounds=2)
+        partners = ['a', 'b', 'c']
+        utility = {'a': 0}
+
+        optimistic = []
+        for _ in range(4):
+            utility['a'] += 100
+            choker.run(partners, utility)
+            optimistic.append(choker.optimistic)
+
+        self.assertEqual(optimistic[0], optimistic[1])
+        self.assertNotEqual(optimistic[1], optimistic[2])
+        self.assertEqual(optimistic[2], optimistic[3])
+        self.assertEqual(choker.stats()['rotations'], 2)
+
+    def test_remove_partner(self):
+        choker = Choker(slots=1)
+        choker.run(['a', 'b'], {'a': 10})
+        choker.remove_partner('b')
+
+        self.assertEqual(choker.optimistic, None)
+        self.assertEqual(choker.unchoked, set(['a']))
+
+if __name__ == '__main__':
+    unittest.main()
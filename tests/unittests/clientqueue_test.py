@@ -0,0 +1,81 @@
+import unittest
+
+from pixtream.peer.clientqueue import ClientQueue
+
+class FakeConsumer(object):
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+class ClientQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = FakeConsumer()
+        self.dropped = []
+        self.client = ClientQueue(self.consumer, 'client',
+                                  self.dropped.append)
+
+    def test_queue_while_paused(self):
+        self.client.send_stream('a')
+        self.client.pauseProducing()
+        self.client.send_stream('bc')
+        self.client.send_stream('d')
+
+        self.assertEqual(self.consumer.data, ['a'])
+        self.assertEqual(self.client.queued_bytes, 3)
+
+        self.client.resumeProducing()
+
+        self.assertEqual(self.consumer.data, ['a', 'bc', 'd'])
+        self.assertEqual(self.client.queued_bytes, 0)
+
+    def test_drop_lagging_client(self):
+        self.client.pauseProducing()
+        self.client.send_stream('x' * 20)
+
+        self.failIf(self.client.check_lag(10, 5, ClientQueue.DROP, 0))
+        self.failIf(self.client.check_lag(10, 5, ClientQueue.DROP, 4))
+        self.assert_(self.client.check_lag(10, 5, ClientQueue.DROP, 5))
+
+        self.assertEqual(self.dropped, [self.client])
+        self.assert_(self.client.failed)
+        self.assertEqual(self.client.queued_bytes, 0)
+
+        self.client.resumeProducing()
+        self.client.send_stream('y')
+        self.assertEqual(self.consumer.data, [])
+
+    def test_skip_lagging_client(self):
+        self.client.pauseProducing()
+        self.client.send_stream('x' * 20)
+
+        self.client.check_lag(10, 5, ClientQueue.SKIP, 0)
+        self.assert_(self.client.check_lag(10, 5, ClientQueue.SKIP, 5))
+
+        self.assertEqual(self.dropped, [])
+        self.assertEqual(self.client.queued_bytes, 0)
+
+        self.client.resumeProducing()
+        self.client.send_stream('y')
+        self.assertEqual(self.consumer.data, ['y'])
+
+    def test_lag_reset_when_drained(self):
+        self.client.pauseProducing()
+        self.client.send_stream('x' * 20)
+        self.client.check_lag(10, 5, ClientQueue.DROP, 0)
+
+        self.client.resumeProducing()
+        self.failIf(self.client.check_lag(10, 5, ClientQueue.DROP, 10))
+        self.assertEqual(self.client.lagging_since, None)
+
+    def test_stopped_client(self):
+        self.client.stopProducing()
+        self.client.send_stream('a')
+
+        self.assertEqual(self.consumer.data, [])
+
+if __name__ == '__main__':
+    unittest.main()
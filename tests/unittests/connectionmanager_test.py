@@ -0,0 +1,168 @@
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from pixtream.peer.connectionmanager import ConnectionManager
+from pixtream.peer.peerdatabase import Peer
+from pixtream.peer.protocol import IncomingProtocol, OutgoingProtocol
+
+def create_connection(protocol_class, partner_id):
+    connection = protocol_class()
+    connection.partner_id = partner_id
+    connection.transport = StringTransport()
+    return connection
+
+class ConnectionIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = ConnectionManager(None)
+        self.incoming = create_connection(IncomingProtocol, 'a')
+        self.outgoing = create_connection(OutgoingProtocol, 'b')
+        self.manager.incoming_connections.add(self.incoming)
+        self.manager.outgoing_connections.add(self.outgoing)
+
+    def test_lookup(self):
+        self.assert_(self.manager.get_connection('a') is self.incoming)
+        self.assert_(self.manager.get_connection('b') is self.outgoing)
+        self.assertEqual(self.manager.get_connection('c'), None)
+
+        self.assertEqual(self.manager.direction('a'), 'incoming')
+        self.assertEqual(self.manager.direction('b'), 'outgoing')
+        self.assertEqual(self.manager.incoming_connections.ids, ['a'])
+        self.assert_('b' in self.manager.outgoing_connections)
+        self.failIf('b' in self.manager.incoming_connections)
+
+    def test_cached_snapshot(self):
+        snapshot = self.manager.all_connections
+        self.assert_(self.manager.all_connections is snapshot)
+        self.assertEqual(set(snapshot), set([self.incoming, self.outgoing]))
+
+        self.manager.incoming_connections.remove(self.incoming)
+        self.assertEqual(self.manager.all_connections, (self.outgoing,))
+
+    def test_duplicated_partner(self):
+        duplicated = create_connection(OutgoingProtocol, 'a')
+        self.manager.outgoing_connections.add(duplicated)
+
+        self.assert_(duplicated.transport.disconnecting)
+        self.assert_(self.manager.get_connection('a') is self.incoming)
+
+        self.manager.outgoing_connections.remove(duplicated)
+        self.assert_(self.manager.get_connection('a') is self.incoming)
+
+    def test_control_counters(self):
+        self.incoming.stats.message_sent('ChokeMessage', 5, control=True)
+        self.outgoing.stats.message_sent('ChokeMessage', 5, control=True)
+        self.outgoing.stats.message_sent('DataPacketMessage', 100)
+
+        self.assertEqual(self.manager.control_sent(), (2, 10))
+
+        self.manager.incoming_connections.remove(self.incoming)
+        self.assertEqual(self.manager.control_sent(), (2, 10))
+
+    def test_connection_allowed(self):
+        self.failIf(self.manager.connection_allowed('a'))
+        self.assert_(self.manager.connection_allowed('c'))
+
+class DialingConnectionManager(ConnectionManager):
+
+    def __init__(self, *args, **kwargs):
+        ConnectionManager.__init__(self, None, *args, **kwargs)
+        self.clock = Clock()
+        self.dialed = []
+        self.factories = {}
+
+    def _dial(self, peer, factory):
+        self.dialed.append(peer.id)
+        self.factories[peer.id] = factory
+
+def create_peers(count):
+    return [Peer('peer{0:016d}'.format(i), '127.0.0.1', 60000 + i, uf=i)
+            for i in range(count)]
+
+class AdmissionTest(unittest.TestCase):
+
+    def test_target_out_degree(self):
+        manager = DialingConnectionManager(target_out_degree=3)
+        peers = create_peers(10)
+
+        manager.connect_to_peers(peers)
+        self.assertEqual(manager.dialed, [peer.id for peer in peers[:-4:-1]])
+
+        manager.connect_to_peers(peers)
+        self.assertEqual(len(manager.dialed), 3)
+
+    def test_backoff(self):
+        manager = DialingConnectionManager(target_out_degree=1)
+        peer = create_peers(1)[0]
+
+        manager.connect_to_peers([peer])
+        manager.factories[peer.id].clientConnectionFailed(None, None)
+        self.assertEqual(manager.backoff(peer.id), manager.BACKOFF)
+
+        manager.connect_to_peers([peer])
+        self.assertEqual(len(manager.dialed), 1)
+
+        manager.clock.advance(manager.BACKOFF)
+        manager.connect_to_peers([peer])
+        self.assertEqual(len(manager.dialed), 2)
+
+        manager.factories[peer.id].clientConnectionFailed(None, None)
+        self.assertEqual(manager.backoff(peer.id), 2 * manager.BACKOFF)
+
+    def test_attempt_timeout(self):
+        manager = DialingConnectionManager(target_out_degree=1)
+        peers = create_peers(2)
+
+        manager.connect_to_peers(peers)
+        manager.clock.advance(3 * manager.CONNECT_TIMEOUT)
+        manager.connect_to_peers(peers)
+
+        self.assertEqual(manager.dialed, [peers[1].id, peers[0].id])
+        self.assert_(manager.backoff(peers[1].id) > 0)
+
+    def test_rejected_handshake(self):
+        manager = DialingConnectionManager(target_out_degree=1)
+        peers = create_peers(2)
+
+        manager.connect_to_peers(peers)
+        factory = manager.factories[peers[1].id]
+        factory.end_connection_attempt(peers[1].id)
+
+        manager.connect_to_peers(peers)
+        self.assertEqual(len(manager.dialed), 1)
+
+        factory.outgoing_connection_lost(peers[1].id)
+
+        self.assertEqual(manager.backoff(peers[1].id), manager.BACKOFF)
+        self.failIf(peers[1].id in manager._latencies)
+
+        manager.connect_to_peers(peers)
+        self.assertEqual(manager.dialed, [peers[1].id, peers[0].id])
+
+    def test_latency_kept_after_handshake(self):
+        manager = DialingConnectionManager(target_out_degree=1)
+        peer = create_peers(1)[0]
+
+        manager.connect_to_peers([peer])
+        manager.clock.advance(0.5)
+        factory = manager.factories[peer.id]
+        factory.end_connection_attempt(peer.id)
+        factory.add_connection(create_connection(OutgoingProtocol, peer.id))
+
+        self.assertEqual(manager._latencies, {peer.id: 0.5})
+
+        manager.connect_to_peers([])
+        self.assertEqual(manager._latencies, {})
+
+    def test_max_in_degree(self):
+        manager = DialingConnectionManager(max_in_degree=1)
+        manager.incoming_connections.add(create_connection(IncomingProtocol,
+                                                           'a'))
+
+        self.failIf(manager.incoming_allowed('b'))
+        self.assert_(manager.connection_allowed('b'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from pixtream.peer import specs
+from pixtream.peer.connectionstats import RateMeter, ConnectionStats
+from pixtream.peer.protocol import BaseProtocol
+
+class RateMeterTest(unittest.TestCase):
+
+    def test_steady_rate(self):
+        meter = RateMeter(window=5)
+        for second in range(100):
+            meter.add(1000, now=second)
+
+        self.assertAlmostEqual(meter.rate(now=99), 1000, delta=150)
+
+    def test_decay(self):
+        meter = RateMeter(window=5)
+        meter.add(1000, now=0)
+
+        self.assert_(meter.rate(now=10) < meter.rate(now=1))
+        self.assertEqual(RateMeter().rate(now=0), 0)
+
+class ConnectionStatsTest(unittest.TestCase):
+
+    def test_control_messages(self):
+        stats = ConnectionStats(now=0)
+        stats.message_sent('GotPieceMessage', 9, control=True)
+        stats.message_sent('DataPacketMessage', 1000)
+        stats.message_sent('GotPieceMessage', 9, control=True)
+
+        self.assertEqual(stats.messages_out, {'GotPieceMessage': 2,
+                                              'DataPacketMessage': 1})
+        self.assertEqual(stats.control_messages_out, 2)
+        self.assertEqual(stats.control_bytes_out, 18)
+
+class FakePeerService(object):
+
+    def receive_packet(self, packet, sender_id):
+        pass
+
+class FakeFactory(object):
+    peer_service = FakePeerService()
+
+class ProtocolStatsTest(unittest.TestCase):
+
+    def test_counters(self):
+        connection = BaseProtocol()
+        connection.clock = Clock()
+        connection.factory = FakeFactory()
+        connection.makeConnection(StringTransport())
+
+        connection.send_request_packet(7)
+        connection.clock.advance(0.5)
+
+        data = specs.DataPacketMessage.create(7, 'x' * 100).pack_prefixed()
+        connection.dataReceived(data)
+
+        stats = connection.stats.snapshot(now=connection.clock.seconds())
+
+        self.assertEqual(stats['bytes_in'], len(data))
+        self.assertEqual(stats['bytes_out'],
+                         len(connection.transport.value()))
+        self.assertEqual(stats['messages_in'], {'DataPacketMessage': 1})
+        self.assertEqual(stats['messages_out'],
+                         {'RequestDataPacketMessage': 1})
+        self.assertEqual(stats['control_messages_out'], 1)
+        self.assert_(stats['download_rate'] > 0)
+
+if __name__ == '__main__':
+    unittest.main()
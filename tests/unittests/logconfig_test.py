@@ -0,0 +1,36 @@
+import logging
+import unittest
+
+from pixtream.util.logconfig import MESSAGE_LOGGER, setup_logging
+
+class LogConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_handlers = logging.root.handlers[:]
+        self.root_level = logging.root.level
+
+    def tearDown(self):
+        logging.root.handlers[:] = self.root_handlers
+        logging.root.setLevel(self.root_level)
+        for name in (MESSAGE_LOGGER, 'pixtream.peer.protocol'):
+            logging.getLogger(name).setLevel(logging.NOTSET)
+
+    def test_subsystem_levels(self):
+        logging.root.handlers[:] = []
+        setup_logging('%(message)s', 'warning',
+                      ['peer.protocol=DEBUG'], message_log=False)
+
+        protocol = logging.getLogger('pixtream.peer.protocol')
+        messages = logging.getLogger(MESSAGE_LOGGER)
+
+        self.assertEqual(logging.root.level, logging.WARNING)
+        self.assert_(protocol.isEnabledFor(logging.DEBUG))
+        self.failIf(logging.getLogger('pixtream.peer').isEnabledFor(
+                    logging.INFO))
+        self.failIf(messages.isEnabledFor(logging.CRITICAL))
+
+    def test_unknown_level(self):
+        self.assertRaises(ValueError, setup_logging, '%(message)s', 'LOUD')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@ import random
 import string
 
 from pixtream.peer import specs
-from pixtream.peer.messages import Message
+from pixtream.peer.messages import Message, MessageException
 
 class HandShakeMessageTest(unittest.TestCase):
     def test_iomessage(self):
@@ -39,6 +39,29 @@ class HandShakeMessageTest(unittest.TestCase):
 
         self.assert_(isinstance(new_handshake, specs.HandshakeMessage))
 
+    def test_extensions(self):
+        peer_id = ''.join(random.choice(string.letters) for _ in range(20))
+
+        handshake = specs.HandshakeMessage.create(peer_id)
+        extensions = Message.parse(handshake.pack()).extensions
+        self.assert_(specs.extension_supported(extensions,
+                                               specs.RANGES_EXTENSION))
+
+        handshake = specs.HandshakeMessage.create(peer_id, extensions=())
+        extensions = Message.parse(handshake.pack()).extensions
+        self.assertEqual(extensions, '00000000')
+        self.failIf(specs.extension_supported(extensions,
+                                              specs.RANGES_EXTENSION))
+
+class StreamInfoMessageTest(unittest.TestCase):
+
+    def test_iomessage(self):
+        message = specs.StreamInfoMessage.create(4096)
+        new_message = Message.parse(message.pack())
+
+        self.assert_(new_message.is_valid())
+        self.assertEqual(new_message.packet_size, 4096)
+
 class PieceBitFieldMessageTest(unittest.TestCase):
 
     def test_bitencoding(self):
@@ -60,6 +83,72 @@ class PieceBitFieldMessageTest(unittest.TestCase):
         self.assert_(isinstance(object, PieceBitFieldMessage))
         self.assertEqual(object.pieces, pieces)
 
+class HaveRangesMessageTest(unittest.TestCase):
+
+    def test_iomessage(self):
+        ranges = [(0, 1000), (1002, 1002), (5000, 6000)]
+        message = specs.HaveRangesMessage.create(ranges)
+        object = Message.parse(message.pack())
+
+        self.assert_(isinstance(object, specs.HaveRangesMessage))
+        self.assert_(object.is_valid())
+        self.assertEqual(object.ranges, ranges)
+        self.assertEqual(len(object.pieces), 2003)
+
+    def test_wrong_payload(self):
+        message = specs.HaveRangesMessage.create([(0, 10)])
+        self.assertRaises(MessageException, Message.parse,
+                          message.pack()[:-1])
+
+    def test_huge_count(self):
+        message = specs.HaveRangesMessage.create([(0, 10)])
+        data = message.pack()
+        data = data[0] + '\x80\x00\x00\x00' + data[5:]
+
+        self.assertRaises(MessageException, Message.parse, data)
+
+class CancelRequestDataPacketMessageTest(unittest.TestCase):
+
+    def test_iomessage(self):
+        message = specs.CancelRequestDataPacketMessage.create(42)
+        object = Message.parse(message.pack())
+
+        self.assert_(isinstance(object, specs.CancelRequestDataPacketMessage))
+        self.assertEqual(object.sequence, 42)
+class MessageCodecTest(unittest.TestCase):
+
+    def test_wrong_length(self):
+        data = specs.GotPieceMessage.create(7).pack()
+
+        self.assertRaises(MessageException, Message.parse, data + 'x')
+        self.assertRaises(MessageException, Message.parse, data[:-1])
+        self.assertRaises(MessageException, Message.parse, 'D12')
+
+    def test_invalid_message(self):
+        message = specs.GotPieceMessage.create(7)
+        message.sequence = -1
+
+        self.assertFalse(message.is_valid())
+        self.assertRaises(MessageException, message.pack)
+
+    def test_fields(self):
+        message = Message.parse(specs.DataPacketMessage.create(3, 'abc').pack())
+
+        self.assertEqual(message.message_header, 'D')
+        self.assertEqual(message.sequence, 3)
+        self.assertEqual(message.data, 'abc')
+        self.assert_(Message.parse(specs.HeartBeatMessage.create().pack())
+                     .is_valid())
+
+    def test_prefixed_parts(self):
+        data = 'x' * 1000
+        message = specs.DataPacketMessage.create(3, data)
+        parts = message.pack_prefixed_parts()
+
+        self.assertEqual(''.join(parts), message.pack_prefixed())
+        self.assert_(parts[-1] is data)
+        self.assertEqual(Message.parse(''.join(parts)[4:]).data, data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from pixtream.peer.peerservice import SourcePeerService
+
+class FakeStreamServer(object):
+
+    def __init__(self):
+        self.offsets = []
+        self.data = ''
+
+    def seek(self, offset):
+        self.offsets.append(offset)
+
+    def send_stream(self, data):
+        self.data += data
+
+class SourceOffsetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = SourcePeerService('127.0.0.1', 0, 'http://tracker/',
+                                         start_offset=1000 * 100,
+                                         packet_size=100)
+        self.service.piece_manager.window_pieces = 10
+
+    def tearDown(self):
+        self.service.logic_repeater.stop()
+        self.service.choke_repeater.stop()
+
+    def test_pieces_start_at_offset(self):
+        self.assertEqual(self.service.piece_manager.playback_position, 1000)
+
+    def test_pieces_evicted(self):
+        self.service._stream_received('x' * 100 * 100)
+
+        manager = self.service.piece_manager
+        self.assertEqual(manager.own_sequences, set(range(1090, 1100)))
+        self.assertEqual(manager.pieces_evicted, 90)
+
+    def test_stream_offsets(self):
+        server = FakeStreamServer()
+        self.service.stream_server = server
+
+        self.service._stream_received('x' * 250)
+        self.service._stream_received('y' * 50)
+
+        self.assertEqual(server.offsets, [1000 * 100])
+        self.assertEqual(server.data, 'x' * 250 + 'y' * 50)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+import unittest
+
+from pixtream.peer.piecemanager import PieceManager
+from pixtream.peer.pieceselection import DeadlinePolicy
+
+class PieceManagerWindowTest(unittest.TestCase):
+
+    def test_window_pieces(self):
+        manager = PieceManager(window_pieces=10)
+
+        for sequence in range(100):
+            manager.add_new_piece(sequence, 'x' * 10)
+
+        self.assertEqual(len(manager.own_sequences), 10)
+        self.assertEqual(manager.pieces_evicted, 90)
+        self.assertEqual(manager.own_bytes, 100)
+        self.assert_(manager.have_piece(99))
+        self.assertFalse(manager.have_piece(0))
+        self.assertEqual(manager.get_piece_data(95), 'x' * 10)
+        self.assertEqual(manager.get_piece_data(5), None)
+
+    def test_window_bytes(self):
+        manager = PieceManager(window_pieces=1000, window_bytes=50)
+
+        for sequence in range(20):
+            manager.add_new_piece(sequence, 'x' * 10)
+
+        self.assertEqual(manager.own_bytes, 50)
+        self.assertEqual(manager.own_sequences, set(range(15, 20)))
+
+    def test_first_sequence(self):
+        manager = PieceManager(window_pieces=10, first_sequence=1000)
+        self.assertEqual(manager.playback_position, 1000)
+        self.assertFalse(manager.wants_piece(999))
+
+        for sequence in range(1000, 1100):
+            manager.add_new_piece(sequence, 'x' * 10)
+
+        self.assertEqual(manager.own_sequences, set(range(1090, 1100)))
+        self.assertEqual(manager.pieces_evicted, 90)
+
+    def test_requested_pieces_are_kept(self):
+        manager = PieceManager(window_pieces=5)
+        manager.partner_requested_piece('partner', 2)
+
+        for sequence in range(10):
+            manager.add_new_piece(sequence, 'x')
+
+        self.assert_(manager.have_piece(2))
+
+        manager.mark_piece_as_sent('partner', 2)
+        manager.add_new_piece(10, 'x')
+
+        self.assertFalse(manager.have_piece(2))
+        self.assertEqual(manager.pieces_served, 1)
+        self.assertEqual(len(manager.own_sequences), 5)
+
+    def test_pieces_ahead_of_playback_are_kept(self):
+        manager = PieceManager(window_pieces=5)
+
+        for sequence in range(1, 11):
+            manager.add_new_piece(sequence, 'x')
+
+        self.assertEqual(manager.own_sequences, set(range(1, 11)))
+        self.assertEqual(manager.pieces_evicted, 0)
+
+    def test_evicted_pieces_are_not_requested(self):
+        manager = PieceManager(window_pieces=5)
+
+        for sequence in range(10):
+            manager.add_new_piece(sequence, 'x')
+
+        manager.partner_got_pieces('partner', range(12))
+
+        self.assertEqual(set(manager.get_pieces_to_request(3)), set([10, 11]))
+
+    def test_advertised_window(self):
+        manager = PieceManager(window_pieces=100, advertise_pieces=4)
+        self.assertEqual(manager.advertised_sequences, set())
+
+        for sequence in range(1, 11):
+            manager.add_new_piece(sequence, 'x')
+
+        self.assertEqual(manager.advertised_sequences, set(range(7, 11)))
+
+class PieceManagerRarestFirstTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = PieceManager()
+        self.manager.partner_got_pieces('a', [1, 2, 3, 4])
+        self.manager.partner_got_pieces('b', [2, 3, 4])
+        self.manager.partner_got_pieces('c', [3, 4])
+
+    def test_rarest_first(self):
+        self.assertEqual(self.manager.get_pieces_to_request(3), [1, 2, 3])
+
+    def test_own_pieces_are_not_requested(self):
+        self.manager.add_new_piece(1, 'x')
+        self.manager.add_new_piece(3, 'x')
+
+        self.assertEqual(set(self.manager.get_pieces_to_request(3)),
+                         set([2, 4]))
+
+    def test_partner_disconnected(self):
+        self.manager.partner_got_pieces('d', [1, 2])
+        self.manager.remove_partner('c')
+        self.manager.remove_partner('d')
+
+        self.assertEqual(self.manager.get_pieces_to_request(3)[0], 1)
+        self.assertEqual(self.manager.partners_by_piece[4], set(['a', 'b']))
+        self.assertFalse('c' in self.manager.pieces_by_partner)
+
+    def test_duplicated_announcements(self):
+        self.manager.partner_got_pieces('a', [1, 1, 1])
+
+        self.assertEqual(self.manager.get_pieces_to_request(3)[0], 1)
+
+class DeadlinePolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = DeadlinePolicy(window=3, deadline=10)
+        self.manager = PieceManager(policy=self.policy)
+        self.manager.partner_got_pieces('a', range(20))
+        self.manager.partner_got_pieces('b', range(10))
+
+    def test_urgent_pieces_first(self):
+        self.manager.add_new_piece(0, 'x')
+        self.manager.add_new_piece(2, 'x')
+
+        self.assertEqual(self.manager.get_pieces_to_request(3), [1, 3, 10])
+
+    def test_deadline_missed(self):
+        self.manager.get_pieces_to_request(3)
+        self.policy._urgent_since[1] -= 60
+
+        self.manager.add_new_piece(0, 'x')
+        self.manager.add_new_piece(1, 'x')
+
+        self.assertEqual(self.policy.deadlines_missed, 1)
+
+    def test_urgent_pieces_pruned(self):
+        self.manager.get_pieces_to_request(3)
+        self.assertEqual(sorted(self.policy._urgent_since), [0, 1, 2])
+
+        self.manager.window_start = 2
+        self.manager.get_pieces_to_request(3)
+
+        self.assertEqual(sorted(self.policy._urgent_since), [2, 3, 4])
+        self.assertEqual(self.policy.deadlines_missed, 2)
+
+    def test_skipped_pieces_miss_deadline(self):
+        self.manager.get_pieces_to_request(3)
+        self.manager.skip_to(2)
+
+        self.assertEqual(self.policy.deadlines_missed, 2)
+        self.assertEqual(self.manager.playback_position, 2)
+
+class PieceManagerRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = PieceManager()
+        self.manager.partner_got_pieces('a', range(10))
+        self.manager.partner_got_pieces('b', range(5))
+
+    def test_requested_pieces_are_not_selected(self):
+        self.manager.mark_piece_as_requested('a', 5)
+        self.manager.mark_piece_as_requested('a', 6)
+
+        self.assertEqual(self.manager.get_pieces_to_request(3), [7, 8, 9])
+        self.assert_(self.manager.is_requested(5))
+        self.assertFalse(self.manager.can_request_piece('a', 5))
+
+    def test_request_slots(self):
+        slots = self.manager.request_slots('a')
+        self.manager.mark_piece_as_requested('a', 5)
+
+        self.assertEqual(self.manager.request_slots('a'), slots - 1)
+        self.assertEqual(self.manager.best_partner_for_piece(0), 'b')
+
+    def test_piece_arrival_frees_slot(self):
+        self.manager.mark_piece_as_requested('a', 5)
+        self.manager.add_new_piece(5, 'x', 'a')
+
+        self.assertFalse(self.manager.is_requested(5))
+        self.assertEqual(len(self.manager.pieces_requested_to['a']), 0)
+        self.assert_(self.manager.pieces_requested_to['a'].rtt is not None)
+
+    def test_partner_disconnected_releases_requests(self):
+        self.manager.mark_piece_as_requested('a', 1)
+        self.manager.remove_partner('a')
+
+        self.assertFalse(self.manager.is_requested(1))
+        self.assertEqual(self.manager.get_pieces_to_request(10),
+                         range(5))
+
+    def test_expired_requests_go_to_other_partner(self):
+        self.manager.mark_piece_as_requested('a', 1)
+        sent = self.manager.pieces_requested_to['a'].requests[1]
+
+        self.assertEqual(self.manager.expire_requests(sent + 1), [])
+        self.assertEqual(self.manager.expire_requests(sent + 60), [('a', 1)])
+        self.assertFalse(self.manager.is_requested(1))
+        self.assertEqual(self.manager.requests_expired, 1)
+        self.assertEqual(self.manager.best_partner_for_piece(1), 'b')
+
+    def test_cancelled_pieces_are_not_sent(self):
+        self.manager.add_new_piece(1, 'x')
+        self.manager.partner_requested_piece('a', 1)
+        self.manager.partner_cancelled_piece('a', 1)
+
+        self.assertEqual(self.manager.get_pieces_to_send(), [])
+
+class PieceManagerInterestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = PieceManager()
+        self.manager.partner_got_pieces('a', range(10))
+        self.manager.partner_got_pieces('b', range(5))
+
+    def test_needs_pieces(self):
+        self.assert_(self.manager.needs_pieces_from('b'))
+        self.assertFalse(self.manager.needs_pieces_from('c'))
+
+        for sequence in range(5):
+            self.manager.add_new_piece(sequence, 'x')
+
+        self.assertFalse(self.manager.needs_pieces_from('b'))
+        self.assert_(self.manager.needs_pieces_from('a'))
+
+    def test_interest_kept_while_requested(self):
+        for sequence in range(5):
+            self.manager.mark_piece_as_requested('b', sequence)
+
+        self.assertFalse(any(self.manager.is_missing(sequence)
+                             for sequence in range(5)))
+        self.assert_(self.manager.needs_pieces_from('b'))
+
+        for sequence in range(5):
+            self.manager.add_new_piece(sequence, 'x', 'b')
+
+        self.assertFalse(self.manager.needs_pieces_from('b'))
+
+    def test_choked_partner_is_not_requested(self):
+        self.manager.mark_piece_as_requested('b', 3)
+        self.manager.partner_choked('b')
+
+        self.assertEqual(self.manager.request_slots('b'), 0)
+        self.assertFalse(self.manager.is_requested(3))
+        self.assertEqual(self.manager.best_partner_for_piece(3), 'a')
+
+        self.manager.partner_choked('a')
+        self.assertEqual(self.manager.free_request_slots(), 0)
+        self.assertEqual(self.manager.best_partner_for_piece(3), None)
+
+        self.manager.partner_unchoked('b')
+        self.assertEqual(self.manager.best_partner_for_piece(3), 'b')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from pixtream.peer import specs
+from pixtream.peer.protocol import BaseProtocol
+
+class FakeFactory(object):
+    pass
+
+class AnnouncementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = BaseProtocol()
+        self.connection.clock = Clock()
+        self.connection.factory = FakeFactory()
+        self.connection.makeConnection(StringTransport())
+
+    def sent_headers(self):
+        data = self.connection.transport.value()
+        headers = []
+        while data:
+            size = int(data[:4].encode('hex'), 16)
+            headers.append(data[4])
+            data = data[4 + size:]
+        return headers
+
+    def test_coalesced_ranges(self):
+        self.connection.partner_extensions = '10000000'
+
+        for sequence in range(10):
+            self.connection.announce_piece(sequence)
+
+        self.assertEqual(self.sent_headers(), [])
+
+        self.connection.clock.advance(self.connection.ANNOUNCE_DELAY)
+
+        self.assertEqual(self.sent_headers(),
+                         [specs.HaveRangesMessage.message_header])
+        self.assertEqual(self.connection.stats.control_messages_out, 1)
+
+    def test_single_announcement(self):
+        self.connection.partner_extensions = '10000000'
+        self.connection.announce_piece(5)
+        self.connection.clock.advance(self.connection.ANNOUNCE_DELAY)
+
+        self.assertEqual(self.sent_headers(),
+                         [specs.GotPieceMessage.message_header])
+
+    def test_without_extension(self):
+        self.connection.partner_extensions = '00000000'
+
+        for sequence in range(3):
+            self.connection.announce_piece(sequence)
+        self.connection.clock.advance(self.connection.ANNOUNCE_DELAY)
+
+        self.assertEqual(self.sent_headers(),
+                         [specs.GotPieceMessage.message_header] * 3)
+
+class InterestTest(unittest.TestCase):
+
+    def test_interest_state(self):
+        connection = BaseProtocol()
+        connection.factory = FakeFactory()
+        connection.makeConnection(StringTransport())
+
+        connection.send_interested()
+        self.assert_(connection.interested)
+
+        connection.send_not_interested()
+        self.assertFalse(connection.interested)
+        self.assert_(connection.choked)
+
+class LivenessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = BaseProtocol()
+        self.connection.clock = Clock()
+        self.connection.factory = FakeFactory()
+        self.connection.makeConnection(StringTransport())
+        self.connection.outgoing_handshaked = True
+        self.connection.incoming_handshaked = True
+
+    def heartbeats(self):
+        return self.connection.stats.messages_out.get('HeartBeatMessage', 0)
+
+    def test_heartbeat_only_when_idle(self):
+        interval = self.connection.HEARTBEAT_INTERVAL
+
+        for _ in range(4):
+            self.connection.clock.advance(interval / 2.0)
+            self.connection.send_got_piece(1)
+        self.assertEqual(self.heartbeats(), 0)
+
+        self.connection.clock.advance(interval)
+        self.assertEqual(self.heartbeats(), 1)
+
+    def test_traffic_keeps_connection_alive(self):
+        data = specs.HeartBeatMessage.create().pack_prefixed()
+        timeout = self.connection.PEER_TIMEOUT
+
+        for _ in range(4):
+            self.connection.clock.advance(timeout / 2.0)
+            self.connection.dataReceived(data)
+        self.failIf(self.connection.transport.disconnecting)
+
+        self.connection.clock.advance(timeout)
+        self.assert_(self.connection.transport.disconnecting)
+
+    def test_timers_cancelled_on_lost_connection(self):
+        self.connection.incoming_handshaked = False
+        self.connection.connectionLost(None)
+        self.assertEqual(self.connection.clock.getDelayedCalls(), [])
+
+class FakeService(object):
+
+    def __init__(self, packet_size=None):
+        self.packet_size = packet_size
+        self.stream_info = []
+        self.bitsets = []
+
+    def piece_window(self, newest):
+        return newest - 9, newest
+
+    def partner_bitset(self, partner_id, pieces):
+        self.bitsets.append(pieces)
+
+    def stream_info_received(self, partner_id, packet_size):
+        self.stream_info.append((partner_id, packet_size))
+
+class StreamInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = BaseProtocol()
+        self.connection.clock = Clock()
+        self.connection.factory = FakeFactory()
+        self.connection.factory.peer_service = FakeService()
+        self.connection.makeConnection(StringTransport())
+        self.connection.outgoing_handshaked = True
+        self.connection.incoming_handshaked = True
+        self.connection.partner_id = 'partner'
+        self.connection.partner_extensions = '01000000'
+
+    def sent_messages(self):
+        return self.connection.stats.messages_out.get('StreamInfoMessage', 0)
+
+    def test_send_when_known(self):
+        self.connection.send_stream_info()
+        self.assertEqual(self.sent_messages(), 0)
+
+        self.connection.factory.peer_service.packet_size = 1000
+        self.connection.send_stream_info()
+        self.assertEqual(self.sent_messages(), 1)
+
+    def test_send_without_extension(self):
+        self.connection.factory.peer_service.packet_size = 1000
+        self.connection.partner_extensions = '10000000'
+        self.connection.send_stream_info()
+        self.assertEqual(self.sent_messages(), 0)
+
+    def test_receive(self):
+        data = specs.StreamInfoMessage.create(4096).pack_prefixed()
+        self.connection.dataReceived(data)
+
+        self.assertEqual(self.connection.factory.peer_service.stream_info,
+                         [('partner', 4096)])
+
+    def test_ranges_clamped_to_window(self):
+        message = specs.HaveRangesMessage.create([(0, 2 ** 32 - 1)])
+        self.connection.dataReceived(message.pack_prefixed())
+
+        self.assertEqual(self.connection.factory.peer_service.bitsets,
+                         [set(range(2 ** 32 - 10, 2 ** 32))])
+
+    def test_bitfield_clamped_to_window(self):
+        message = specs.PieceBitFieldMessage.create(set(range(100)))
+        self.connection.dataReceived(message.pack_prefixed())
+
+        self.assertEqual(self.connection.factory.peer_service.bitsets,
+                         [set(range(90, 100))])
+
+class RecordingProtocol(BaseProtocol):
+
+    def __init__(self):
+        BaseProtocol.__init__(self)
+        self.messages = []
+
+    def stringReceived(self, message):
+        self.messages.append(str(message))
+
+class FramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = RecordingProtocol()
+        self.connection.makeConnection(StringTransport())
+        self.messages = ['a', '', 'b' * 1000, 'c' * 70000, 'd']
+        self.data = ''.join(specs.GotPieceMessage._prefix_struct.pack(len(m)) +
+                            m for m in self.messages)
+
+    def test_single_chunk(self):
+        self.connection.dataReceived(self.data)
+        self.assertEqual(self.connection.messages, self.messages)
+
+    def test_small_chunks(self):
+        for size in (1, 3, 4096):
+            self.connection.messages = []
+            for start in range(0, len(self.data), size):
+                self.connection.dataReceived(self.data[start:start + size])
+            self.assertEqual(self.connection.messages, self.messages)
+
+    def test_length_limit(self):
+        data = specs.GotPieceMessage._prefix_struct.pack(10 ** 6) + 'x'
+        self.connection.dataReceived(data)
+
+        self.assertEqual(self.connection.messages, [])
+        self.assert_(self.connection.transport.disconnecting)
+
+    def test_large_data_packet(self):
+        packet = specs.DataPacketMessage.create(7, 'x' * 200000)
+        data = packet.pack_prefixed()
+
+        self.connection.dataReceived(data)
+        self.assert_(self.connection.transport.disconnecting)
+
+        self.connection = RecordingProtocol()
+        self.connection.makeConnection(StringTransport())
+        self.connection.set_packet_size(200000)
+        for start in range(0, len(data), 4096):
+            self.connection.dataReceived(data[start:start + 4096])
+
+        self.assertEqual(len(self.connection.messages), 1)
+        self.assert_(self.connection.messages[0] == packet.pack())
+        self.failIf(self.connection.transport.disconnecting)
+
+    def test_limit_raised_by_previous_message(self):
+        info = specs.StreamInfoMessage.create(200000).pack_prefixed()
+        packet = specs.DataPacketMessage.create(0, 'x' * 200000)
+
+        def string_received(message):
+            self.connection.messages.append(str(message))
+            self.connection.set_packet_size(200000)
+
+        self.connection.stringReceived = string_received
+        self.connection.dataReceived(info + packet.pack_prefixed())
+
+        self.assertEqual(len(self.connection.messages), 2)
+        self.assert_(self.connection.messages[1] == packet.pack())
+        self.failIf(self.connection.transport.disconnecting)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from pixtream.peer.replaybuffer import ReplayBuffer, ReplayBufferError
+
+class ReplayBufferTest(unittest.TestCase):
+
+    def test_bounded(self):
+        buffer = ReplayBuffer(max_bytes=10)
+
+        for char in 'abcdefghij':
+            buffer.append(char * 3)
+
+        self.assertEqual(buffer.end_offset, 30)
+        self.assertEqual(buffer.start_offset, 21)
+        self.assertEqual(''.join(buffer.read_from()), 'hhhiiijjj')
+
+    def test_offsets(self):
+        buffer = ReplayBuffer(max_bytes=100)
+        buffer.append('0123')
+        buffer.append('4567')
+
+        self.assertEqual(''.join(buffer.read_from(2)), '234567')
+        self.assertEqual(''.join(buffer.read_from(-3)), '567')
+        self.assertEqual(''.join(buffer.read_from(8)), '')
+        self.assertEqual(''.join(buffer.read_from(0)), '01234567')
+
+    def test_offsets_out_of_buffer(self):
+        buffer = ReplayBuffer(max_bytes=4)
+        buffer.append('0123')
+        buffer.append('4567')
+
+        self.assertRaises(ReplayBufferError, buffer.read_from, 2)
+        self.assertRaises(ReplayBufferError, buffer.read_from, 50)
+        self.assertRaises(ReplayBufferError, buffer.read_from, -5)
+        self.assertEqual(''.join(buffer.read_from(4)), '4567')
+
+    def test_seek(self):
+        buffer = ReplayBuffer(max_bytes=100)
+        buffer.seek(1000)
+        buffer.append('0123')
+        buffer.seek(1004)
+        buffer.append('4567')
+
+        self.assertEqual(''.join(buffer.read_from(1002)), '234567')
+
+        buffer.seek(2000)
+        buffer.append('89')
+
+        self.assertEqual(buffer.start_offset, 2000)
+        self.assertEqual(''.join(buffer.read_from()), '89')
+        self.assertRaises(ReplayBufferError, buffer.read_from, 1002)
+
+    def test_sync_points(self):
+        buffer = ReplayBuffer(max_bytes=100, sync_pattern='OggS')
+        buffer.append('xxOggSaaaOg')
+        buffer.append('gSbbb')
+        buffer.append('cc')
+
+        self.assertEqual(buffer.default_offset, 9)
+        self.assertEqual(''.join(buffer.read_from()), 'OggSbbbcc')
+
+    def test_sync_points_out_of_buffer(self):
+        buffer = ReplayBuffer(max_bytes=5, sync_pattern='S')
+        buffer.append('Saaaa')
+        buffer.append('bbbbb')
+
+        self.assertEqual(buffer.default_offset, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+from pixtream.peer.requestqueue import RequestQueue
+
+class RequestQueueTest(unittest.TestCase):
+
+    def test_initial_depth(self):
+        queue = RequestQueue()
+
+        self.assertEqual(queue.depth, RequestQueue.MIN_DEPTH)
+        queue.add(1, now=0)
+        self.assertEqual(queue.free_slots, RequestQueue.MIN_DEPTH - 1)
+        self.assert_(1 in queue)
+
+    def test_unrequested_response(self):
+        queue = RequestQueue()
+
+        self.assertFalse(queue.response_received(1, 1000, now=0))
+        self.assertEqual(queue.rtt, None)
+
+    def test_depth_follows_bandwidth_delay(self):
+        queue = RequestQueue()
+        now = 0.0
+
+        # 1 second of latency and a piece every 0.1 seconds
+        for sequence in range(200):
+            queue.add(sequence, now=now)
+            now += 0.1
+            if sequence >= 9:
+                queue.response_received(sequence - 9, 1000, now=now)
+
+        self.assertAlmostEqual(queue.rtt, 1.0)
+        self.assertAlmostEqual(queue.throughput, 10000, places=3)
+        self.assertEqual(queue.depth, 11)
+
+    def test_max_depth(self):
+        queue = RequestQueue()
+
+        for sequence in range(100):
+            queue.add(sequence, now=0)
+
+        for sequence in range(100):
+            queue.response_received(sequence, 1000, now=1 + sequence * 0.001)
+
+        self.assertEqual(queue.depth, RequestQueue.MAX_DEPTH)
+
+    def test_expired(self):
+        queue = RequestQueue()
+        queue.add(1, now=0)
+        queue.add(2, now=10)
+
+        self.assertEqual(queue.expired(now=12), [1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,11 @@ import unittest
 import string
 import random
 
+from twisted.internet.task import Clock
+
 from pixtream.peer.splitter import Splitter
 from pixtream.peer.joiner import Joiner
+from pixtream.peer.specs import DataPacketMessage
 
 class SplitterJoinerTest(unittest.TestCase):
 
@@ -44,6 +47,150 @@ class SplitterJoinerTest(unittest.TestCase):
             splitter.push_stream(char)
         splitter.end_stream()
 
+    def test_splitter_chunks(self):
+        PACKET_SIZE = 100
+        data = ''.join(random.choice(string.letters) for _ in range(5000))
+
+        splitter = Splitter(PACKET_SIZE)
+        packets = []
+
+        def on_new_packet(sender):
+            packets.append(sender.pop_packet())
+
+        splitter.on_new_packet.add_handler(on_new_packet)
+
+        position = 0
+        while position < len(data):
+            size = random.randint(1, 3 * PACKET_SIZE)
+            splitter.push_stream(data[position:position + size])
+            position += size
+        splitter.end_stream()
+
+        self.assertEqual(''.join(packet.data for packet in packets), data)
+        self.assertEqual([packet.sequence for packet in packets],
+                         range(len(packets)))
+        for packet in packets[:-1]:
+            self.assertEqual(len(packet.data), PACKET_SIZE)
+            self.assert_(isinstance(packet.data, str))
+
+    def test_joiner_gap(self):
+        joiner = Joiner(max_pending=3)
+        gaps = []
+
+        def on_gap(sender, first, last):
+            gaps.append((first, last))
+
+        joiner.on_gap.add_handler(on_gap)
+
+        for sequence in [2, 3, 1, 5, 6, 7]:
+            joiner.push_packet(DataPacketMessage.create(sequence, str(sequence)))
+
+        self.assertEqual(gaps, [(0, 1)])
+        self.assertEqual(joiner.pop_stream(), '123')
+        self.assertEqual(joiner.sequences, set([5, 6, 7]))
+
+        joiner.push_packet(DataPacketMessage.create(8, '8'))
+
+        self.assertEqual(gaps, [(0, 1), (4, 5)])
+        self.assertEqual(joiner.pop_chunks(), ['5', '6', '7', '8'])
+        self.assertEqual(joiner.current_sequence, 9)
+
+    def test_joiner_ignores_old_packets(self):
+        joiner = Joiner()
+        joiner.push_packet(DataPacketMessage.create(0, 'a'))
+        joiner.push_packet(DataPacketMessage.create(0, 'b'))
+
+        self.assertEqual(joiner.pop_stream(), 'a')
+
+    def test_splitters_share_sequences(self):
+        PACKET_SIZE = 100
+        data = ''.join(random.choice(string.letters) for _ in range(2000))
+
+        def split(start_offset):
+            splitter = Splitter(PACKET_SIZE, start_offset)
+            packets = {}
+
+            def on_new_packet(sender):
+                packet = sender.pop_packet()
+                packets[packet.sequence] = packet.data
+
+            splitter.on_new_packet.add_handler(on_new_packet)
+
+            position = start_offset
+            while position < len(data):
+                size = random.randint(1, 3 * PACKET_SIZE)
+                splitter.push_stream(data[position:position + size])
+                position += size
+            splitter.end_stream()
+
+            self.assertEqual(splitter.stream_offset, len(data))
+            return packets
+
+        first = split(0)
+        second = split(250)
+
+        self.assertEqual(sorted(second.keys()), range(3, 21))
+        for sequence, packet_data in second.iteritems():
+            self.assertEqual(packet_data, first[sequence])
+
+    def test_splitter_start_offset(self):
+        splitter = Splitter(10, 25)
+        self.assertEqual(splitter.current_sequence, 3)
+        self.assertEqual(splitter.sequence_at(25), 2)
+
+        splitter.push_stream('x' * 5)
+        self.assertEqual(splitter.current_sequence, 3)
+
+        splitter.push_stream('y' * 10)
+        self.assertEqual(splitter.pop_packet().sequence, 3)
+
+        aligned = Splitter(10, 30)
+        self.assertEqual(aligned.current_sequence, 3)
+
+    def test_splitter_flush(self):
+        splitter = Splitter(10, max_delay=0.5)
+        splitter.clock = Clock()
+        packets = []
+
+        def on_new_packet(sender):
+            packets.append(sender.pop_packet())
+
+        splitter.on_new_packet.add_handler(on_new_packet)
+
+        splitter.push_stream('abc')
+        splitter.clock.advance(0.4)
+        splitter.push_stream('de')
+        self.assertEqual(packets, [])
+
+        splitter.clock.advance(0.1)
+        self.assertEqual([(p.sequence, p.data) for p in packets],
+                         [(0, 'abcde')])
+        self.assertEqual(splitter.flushes, 1)
+
+        splitter.push_stream('f' * 25)
+        self.assertEqual([p.data for p in packets[1:]], ['f' * 10] * 2)
+
+        self.assertEqual(len(splitter.clock.getDelayedCalls()), 1)
+
+        splitter.push_stream('f' * 5)
+        self.assertEqual(packets[-1].data, 'f' * 10)
+        self.assertEqual(splitter.clock.getDelayedCalls(), [])
+
+        splitter.push_stream('g')
+        splitter.end_stream()
+        self.assertEqual(packets[-1].data, 'g')
+        self.assertEqual(splitter.clock.getDelayedCalls(), [])
+
+    def test_flush_with_offset(self):
+        self.assertRaises(ValueError, Splitter, 10, 25, 0.5)
+
+    def test_joiner_first_sequence(self):
+        joiner = Joiner(first_sequence=3)
+        joiner.push_packet(DataPacketMessage.create(2, 'old'))
+        joiner.push_packet(DataPacketMessage.create(3, 'a'))
+
+        self.assertEqual(joiner.pop_stream(), 'a')
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
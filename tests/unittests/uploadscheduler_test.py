@@ -0,0 +1,116 @@
+import unittest
+
+from twisted.internet.task import Clock
+
+from pixtream.peer.piecemanager import PieceManager
+from pixtream.peer.uploadscheduler import UploadScheduler
+
+class UploadSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = PieceManager()
+        self.sent = []
+        self.connected = set(['a', 'b'])
+        self.scheduler = UploadScheduler(self.manager, self.send_piece)
+        self.scheduler.clock = Clock()
+
+    def send_piece(self, partner_id, sequence, data):
+        if partner_id not in self.connected:
+            return False
+        self.sent.append((partner_id, sequence))
+        return True
+
+    def request(self, partner_id, sequence):
+        self.manager.partner_requested_piece(partner_id, sequence)
+        self.scheduler.piece_requested(partner_id, sequence)
+
+    def add_piece(self, sequence, data='x'):
+        self.manager.add_new_piece(sequence, data)
+        self.scheduler.piece_available(sequence)
+
+    def test_send_on_request(self):
+        self.add_piece(0)
+        self.request('a', 0)
+
+        self.assertEqual(self.sent, [('a', 0)])
+        self.assertEqual(self.manager.pieces_served, 1)
+
+    def test_send_on_available(self):
+        self.request('a', 0)
+        self.request('b', 0)
+        self.assertEqual(self.sent, [])
+
+        self.add_piece(0)
+        self.assertEqual(sorted(self.sent), [('a', 0), ('b', 0)])
+
+    def test_round_robin(self):
+        for sequence in range(3):
+            self.manager.add_new_piece(sequence, 'x')
+            self.manager.partner_requested_piece('a', sequence)
+            self.manager.partner_requested_piece('b', sequence)
+
+        self.scheduler.schedule(self.manager.get_pieces_to_send())
+
+        partners = [partner_id for partner_id, _ in self.sent]
+        self.assertEqual(len(partners), 6)
+        for first, second in zip(partners[::2], partners[1::2]):
+            self.assertNotEqual(first, second)
+
+    def test_missing_connection_does_not_stop_batch(self):
+        self.connected.discard('a')
+        self.manager.add_new_piece(0, 'x')
+        self.manager.partner_requested_piece('a', 0)
+        self.manager.partner_requested_piece('b', 0)
+
+        self.scheduler.schedule([('a', 0), ('b', 0)])
+
+        self.assertEqual(self.sent, [('b', 0)])
+
+    def test_cancel(self):
+        self.scheduler.max_rate = 1
+        self.add_piece(0)
+        self.add_piece(1)
+        self.request('a', 0)
+        self.request('a', 1)
+
+        self.manager.partner_cancelled_piece('a', 1)
+        self.scheduler.piece_cancelled('a', 1)
+        self.scheduler.clock.advance(10)
+
+        self.assertEqual(self.sent, [('a', 0)])
+
+    def test_rate_limit(self):
+        self.scheduler.max_rate = 100
+        for sequence in range(4):
+            self.manager.add_new_piece(sequence, 'x' * 100)
+            self.manager.partner_requested_piece('a', sequence)
+
+        self.scheduler.schedule(self.manager.get_pieces_to_send())
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.scheduler.queue_depth('a'), 3)
+        self.assertEqual(self.scheduler.peak_queue_depth['a'], 4)
+
+        self.scheduler.clock.pump([0.1] * 10)
+        self.assertEqual(len(self.sent), 2)
+
+        self.scheduler.clock.pump([0.1] * 10)
+        self.assertEqual(len(self.sent), 3)
+
+        self.scheduler.clock.pump([0.1] * 10)
+        self.assertEqual(len(self.sent), 4)
+        self.assertEqual(self.scheduler.bytes_sent, 400)
+
+    def test_partner_removed(self):
+        self.scheduler.max_rate = 100
+        for sequence in range(2):
+            self.manager.add_new_piece(sequence, 'x' * 100)
+            self.manager.partner_requested_piece('a', sequence)
+
+        self.scheduler.schedule(self.manager.get_pieces_to_send())
+        self.scheduler.partner_removed('a')
+
+        self.assertEqual(self.scheduler.queue_depth('a'), 0)
+        self.failIf('a' in self.scheduler.peak_queue_depth)
+
+if __name__ == '__main__':
+    unittest.main()